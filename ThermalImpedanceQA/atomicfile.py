@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+'''
+atomicfile.py
+
+About: Writing files atomically. The data goes into a temporary file next to the target, which is moved into place
+  once it is complete, so that a reader (or another analysis running in parallel) never sees a half-written file.
+'''
+
+import os
+import tempfile
+import contextlib
+
+def _umask():
+    # the umask can only be read by setting it
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+@contextlib.contextmanager
+def atomic_output(path, mode="w"):
+    directory, name = os.path.split(os.path.abspath(path))
+    handle, tmpPath = tempfile.mkstemp(prefix="." + name + ".", suffix=".tmp", dir=directory)
+    try:
+        # mkstemp creates the file readable by its owner only; give it the permissions open() would
+        os.chmod(tmpPath, 0o666 & ~_umask())
+        with os.fdopen(handle, mode) as f:
+            yield f
+        os.replace(tmpPath, path)
+    except BaseException:
+        os.remove(tmpPath)
+        raise
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+
+'''
+batch.py
+
+About: Analyses whole directories (or glob patterns) of runs in parallel. The files are scheduled on a pool of
+  worker processes, each of which imports the analysis once and then analyses one file after the other.
+  A file that fails, crashes its worker or runs longer than the timeout is reported and the batch carries on.
+  A worker reports the numbers of a file before it renders its plots (-g, -d), so that the results are never held
+  up by the PNG encoding. With -d and --contact-sheet, the debug images of the batch are also tiled into contact
+  sheets in the debug_output directory of the outputs.
+  With --trial-geometry, the first file of every directory is analysed before its other files, so that the stave
+  edges of a trial are found once; --invalidate-geometry forgets the saved edges of the trials once, before the batch.
+  With --results-db, the workers send their results back and the batch inserts them into the results database
+  (see results.py) in bulk, one transaction per chunk of files.
+
+  Usage: python batch.py <config> <files, directories or globs> [-j N] [--timeout SECONDS] [impedanceFromCSV.py options]
+  e.g.   python batch.py ../npz-template.cfg ../trial13/ -j 32 -g -1f --orientation L
+'''
+
+import os
+import sys
+import glob
+import time
+import argparse
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+
+from frames import is_csv_sidecar
+
+INPUT_SUFFIXES = ('.npz', '.npy', '.csv')
+
+def expand_inputs(patterns):
+    # directories are searched for input files (not recursively), everything else is treated as a glob
+    # pattern, as the Windows shell does not expand them for us
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern)) if name.endswith(INPUT_SUFFIXES)]
+            # leave out the .npy copies that --csv-cache keeps next to CSV inputs
+            matches = [match for match in matches if not is_csv_sidecar(match)]
+        else:
+            matches = sorted(glob.glob(pattern))
+            if not matches and os.path.isfile(pattern):
+                matches = [pattern]
+        for match in matches:
+            if match not in files:
+                files.append(match)
+    return files
+
+# the number of results inserted into the results database in one transaction
+RESULTS_CHUNK = 64
+
+# the number of debug images on one contact sheet
+CONTACT_SHEET_SIZE = 48
+
+# the message of the files of a cancelled batch that were not (or not completely) analysed
+CANCELLED = "cancelled"
+
+# the messages of a worker: it started the file it was sent, or is done with it (followed by the error and the record)
+STARTED = 'started'
+DONE = 'done'
+
+def analyze_job(path, configFile, analysisArgs, plots=None):
+    '''
+    Analyses one file; returns its record for the results database if --results-db is given, None otherwise.
+    The plots go to the plots.PlotQueue `plots`, if given.
+    '''
+    import impedanceFromCSV
+    options = impedanceFromCSV.make_parser().parse_args([path, configFile] + analysisArgs)
+    # the results are inserted by the batch, not one by one by every worker
+    database, options.results_db = options.results_db, None
+    result = impedanceFromCSV.analyze_file(options, plots=plots)
+    if database:
+        from results import result_record
+        options.results_db = database
+        return result_record(result, options, path)
+    return None
+
+def _worker_loop(conn):
+    # runs in the worker process: analyse the files sent by the scheduler until it sends None
+    from plots import PlotQueue
+    plots = PlotQueue('deferred')
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        # the plots of the previous file are done: the time of this file starts now
+        conn.send((STARTED,))
+        try:
+            record = analyze_job(*job, plots=plots)
+            conn.send((DONE, None, record))
+        except BaseException:
+            plots.discard()
+            conn.send((DONE, traceback.format_exc(), None))
+            continue
+        # the numbers are reported, now the plots of the file
+        try:
+            plots.flush()
+        except Exception:
+            print("[plots FAILED] {}".format(job[0]))
+            traceback.print_exc()
+
+class _Worker:
+    def __init__(self, context):
+        self.conn, childConn = context.Pipe()
+        self.process = context.Process(target=_worker_loop, args=(childConn,), daemon=True)
+        self.process.start()
+        childConn.close()
+        self.job = None
+        self.path = None
+        # the file before, whose plots the worker renders before it starts the next one
+        self.previous = None
+        self.submitted = None
+        self.started = None
+
+    def submit(self, job):
+        self.job = job
+        self.path = job[0]
+        self.submitted = time.time()
+        self.started = None
+        self.conn.send(job)
+
+    def finish(self):
+        path, seconds = self.path, 0. if self.started is None else time.time() - self.started
+        self.previous = self.path
+        self.job = None
+        self.path = None
+        self.started = None
+        return path, seconds
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+class JobResult:
+    def __init__(self, path, ok, seconds, message="", record=None):
+        self.path = path
+        self.ok = ok
+        self.seconds = seconds
+        self.message = message
+        # the record for the results database (see analyze_job)
+        self.record = record
+
+def _trial(path):
+    # the files of a trial are the files of one directory (see geometry.py)
+    return os.path.dirname(os.path.abspath(path))
+
+def run_batch(files, configFile, analysisArgs=(), jobs=None, timeout=None, callback=None, cancel=None, trials=False):
+    '''
+    Analyses the files on `jobs` worker processes and returns one JobResult per file, in the order of `files`.
+    `timeout` is the maximum number of seconds one file may take; its plots are rendered after it is reported, and a
+    file whose worker is stuck on the plots of the file before goes to a new worker. `callback` is called with every JobResult
+    as soon as the file is done. Once the threading.Event `cancel` is set, the files being analysed are abandoned
+    and they and the files not started yet are reported as CANCELLED. With `trials` (for --trial-geometry), the
+    other files of a directory are only sent out once its first file is done, so that the stave edges of a trial
+    are found once and saved for all of its files.
+    '''
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(files)))
+    context = multiprocessing.get_context()
+    pending = [(path, configFile, list(analysisArgs)) for path in files]
+    # the files waiting for the first file of their trial, by the path of that file
+    waiting = {}
+    if trials:
+        firsts = {}
+        for job in pending:
+            first = firsts.setdefault(_trial(job[0]), job)
+            if first is not job:
+                waiting.setdefault(first[0], []).append(job)
+        pending = list(firsts.values())
+    pending.reverse()
+    results = {}
+    workers = [_Worker(context) for i in range(jobs)]
+
+    def record(result):
+        results[result.path] = result
+        # the later files of the trial go after the first files of the other trials
+        pending[:0] = reversed(waiting.pop(result.path, []))
+        if callback is not None:
+            callback(result)
+
+    finished = False
+    try:
+        while pending or any(worker.path is not None for worker in workers):
+            if cancel is not None and cancel.is_set():
+                for worker in workers:
+                    if worker.path is not None:
+                        path, seconds = worker.finish()
+                        worker.stop()
+                        record(JobResult(path, False, seconds, CANCELLED))
+                while pending:
+                    record(JobResult(pending.pop()[0], False, 0., CANCELLED))
+                break
+
+            for worker in workers:
+                if worker.path is None and pending:
+                    worker.submit(pending.pop())
+
+            busy = [worker for worker in workers if worker.path is not None]
+            ready = wait([worker.conn for worker in busy] + [worker.process.sentinel for worker in busy], timeout=0.5)
+
+            for i, worker in enumerate(workers):
+                if worker.path is None:
+                    continue
+                reply = None
+                if worker.conn in ready:
+                    try:
+                        reply = worker.conn.recv()
+                    except EOFError:
+                        worker.process.join(1)
+                    if reply is not None and reply[0] == STARTED:
+                        worker.started = time.time()
+                        continue
+                if reply is not None:
+                    error, resultRecord = reply[1:]
+                    path, seconds = worker.finish()
+                    record(JobResult(path, error is None, seconds, error or "", resultRecord))
+                    if error is None or worker.process.is_alive():
+                        continue
+                elif worker.process.is_alive() and (timeout is None or time.time() - (worker.started or worker.submitted) < timeout):
+                    continue
+                elif worker.started is None:
+                    # the worker never got to the file: the plots of the file before hung or killed it. The file
+                    # goes to a new worker.
+                    print("[plots FAILED] {}: the worker {} while rendering them".format(
+                        worker.previous, "hung" if worker.process.is_alive() else "died"))
+                    pending.append(worker.job)
+                    worker.finish()
+                else:
+                    path, seconds = worker.finish()
+                    if worker.process.is_alive():
+                        message = "timed out after {:.1f} s".format(seconds)
+                    else:
+                        message = "worker process died (exit code {})".format(worker.process.exitcode)
+                    record(JobResult(path, False, seconds, message))
+                # the worker is hung or dead: replace it, so that the remaining files still get analysed
+                worker.stop()
+                workers[i] = _Worker(context)
+        finished = cancel is None or not cancel.is_set()
+    finally:
+        for worker in workers:
+            if worker.process.is_alive() and worker.path is None:
+                worker.conn.send(None)
+                # a worker may still be rendering the plots of its last file
+                worker.process.join(timeout if finished else 1)
+            worker.stop()
+
+    return [results[path] for path in files]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyses many files in parallel. Any further options are passed to impedanceFromCSV.py.")
+    parser.add_argument("config", help="The path to the configuration file")
+    parser.add_argument("inputs", nargs='+', help="Input files, directories or glob patterns")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--timeout", type=float, default=600., help="Maximum number of seconds for one file (default: 600)")
+    parser.add_argument("--contact-sheet", action="store_true", help="With -d: also tile the debug images of the batch into contact sheets")
+    args, analysisArgs = parser.parse_known_args(argv)
+
+    # check the analysis options once here rather than failing in every worker
+    import impedanceFromCSV
+    options = impedanceFromCSV.make_parser().parse_args(["input.npz", args.config] + analysisArgs)
+
+    files = expand_inputs(args.inputs)
+    if not files:
+        print("No input files found.")
+        return 1
+
+    # two inputs with the same name would write the same output files
+    outputs = {}
+    for path in files:
+        outputs.setdefault(impedanceFromCSV.output_filename(path, options.outpath), []).append(path)
+    clashes = [paths for paths in outputs.values() if len(paths) > 1]
+    if clashes:
+        for paths in clashes:
+            print("These inputs would write the same outputs: " + ", ".join(paths))
+        return 1
+
+    os.makedirs(options.outpath, exist_ok=True)
+
+    if options.invalidate_geometry:
+        # once per trial here, rather than in every worker (which would find the edges once per file)
+        from geometry import TrialGeometry
+        for trial in sorted(set(_trial(path) for path in files)):
+            TrialGeometry(trial).invalidate()
+            print("Invalidated the stave geometry of " + trial)
+        analysisArgs = [arg for arg in analysisArgs if arg != "--invalidate-geometry"] + ["--trial-geometry"]
+        options.trial_geometry = True
+
+    database = None
+    records = []
+    if options.results_db:
+        from results import ResultsDB
+        database = ResultsDB(options.results_db)
+
+    def report(result):
+        status = "done" if result.ok else "FAILED"
+        print("[{}] {} ({:.1f} s)".format(status, result.path, result.seconds))
+        if not result.ok:
+            print(result.message)
+        if result.record is not None:
+            records.append(result.record)
+            if len(records) >= RESULTS_CHUNK:
+                database.add_many(records)
+                del records[:]
+
+    print("Analysing {} files on {} workers".format(len(files), max(1, min(args.jobs, len(files)))))
+    startTime = time.time()
+    try:
+        results = run_batch(files, args.config, analysisArgs, jobs=args.jobs, timeout=args.timeout, callback=report,
+                            trials=options.trial_geometry)
+    finally:
+        if database is not None:
+            if records:
+                database.add_many(records)
+            database.close()
+
+    if args.contact_sheet and options.debug:
+        from plots import contact_sheet
+        images = [impedanceFromCSV.debug_filename(result.path, options.outpath) for result in results if result.ok]
+        images = [image for image in images if os.path.isfile(image)]
+        for page, first in enumerate(range(0, len(images), CONTACT_SHEET_SIZE)):
+            sheet = os.path.join(options.outpath, "debug_output", "contact_sheet_{:03d}.png".format(page))
+            contact_sheet(images[first:first+CONTACT_SHEET_SIZE], sheet)
+            print("Contact sheet of the debug images: " + sheet)
+
+    failed = [result for result in results if not result.ok]
+    print("{} of {} files analysed in {:.1f} s".format(len(results)-len(failed), len(results), time.time()-startTime))
+    for result in failed:
+        print("  failed: {} ({})".format(result.path, result.message.strip().splitlines()[-1]))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+'''
+benchmark.py
+
+About: Times the stages of the analysis on synthetic captures (see synthetic.py), so that a change can be compared
+  with a baseline and regressions are caught.
+
+  Every case (regime, one or two faces, resolution, number of frames) is written once and then analysed --repeat
+  times, each time through the stages of impedanceFromCSV.analyze_file taken one by one: reading the frames
+  ('load'), converting them to temperature ('ADC conversion'), averaging them ('frame averaging'), the flips,
+  the stages of analyze_image ('config', 'ScaleImage', 'FindStaveWithin', 'killShiny' with --kill-shiny,
+  'regions', 'getImpedances'), writing the outputs ('output') and rendering the plots. The stave is scaled lazily:
+  the scaled image is made in 'FindStaveWithin', not in 'ScaleImage'. 'load_image' is the streamed loading the
+  command line does, which reads, converts and averages the frames in one pass; it is timed on its own and not
+  part of the total.
+
+  The results go to a JSON file: for every case and stage the time of the first repeat (with the caches of the
+  process still cold), the minimum and the median, in seconds, and how far the stave edges found are from the
+  true ones. With --compare, the medians are checked against those of an earlier run.
+
+  Usage: python benchmark.py [-o benchmark.json] [--regimes hot cold] [--faces 1 2] [--resolutions 640x480 1280x960]
+                             [--frames 5] [--repeat 5] [--compare baseline.json] [--tolerance 0.25]
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import itertools
+import contextlib
+import subprocess
+import numpy as np
+
+import impedanceFromCSV
+from impedanceFromCSV import IMAGE_SCALE
+from synthetic import REGIMES, synthetic_capture, write_capture, parse_resolution
+
+FORMAT_VERSION = 1
+
+# the stages in the order they run; load_image is timed on its own
+STAGES = ('load', 'ADC conversion', 'frame averaging', 'flips', 'config', 'ScaleImage', 'FindStaveWithin', 'killShiny',
+          'regions', 'getImpedances', 'output', 'plot impedances', 'plot debug')
+
+class Stopwatch:
+    '''
+    Adds the time since the previous lap (or start()) to the stage of every lap.
+    '''
+    def __init__(self):
+        self.laps = {}
+        self.start()
+
+    def start(self):
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.laps[stage] = self.laps.get(stage, 0.) + now - self.last
+        self.last = now
+
+def case_name(regime, faces, shape, frames):
+    return "{}-{}f-{}x{}-{}fr".format(regime, faces, shape[1], shape[0], frames)
+
+def run_stages(path, options, plots=True):
+    '''
+    Analyses the capture at path with the options like analyze_file does, stage by stage. Returns the times of
+    the stages and the ImpedanceResult.
+    '''
+    from frames import iter_frames, temperature_frames, reduce_frames
+    watch = Stopwatch()
+    frames = [(np.array(frame), meta) for frame, meta in iter_frames(path)]
+    processVariables = impedanceFromCSV.load_process_variables(path)
+    watch.lap('load')
+    # the converter reuses its buffer, keep a copy of every frame
+    temperatures = [temperature.copy() for temperature, meta in temperature_frames(frames, emissivity=options.emissivity, lut=options.lut)]
+    watch.lap('ADC conversion')
+    image = reduce_frames(temperatures, options.frame_average)
+    watch.lap('frame averaging')
+    image = impedanceFromCSV.prepare_image(image, options)
+    watch.lap('flips')
+
+    config = impedanceFromCSV.load_config(options.config, processVariables)
+    result = impedanceFromCSV.analyze_image(image, config, options, prepared=True, timer=watch.lap)
+
+    outputFilename = impedanceFromCSV.output_filename(path, options.outpath)
+    impedanceFromCSV.save_outputs(result, outputFilename)
+    watch.lap('output')
+    if plots:
+        impedanceFromCSV.plot_impedances(result, outputFilename)
+        watch.lap('plot impedances')
+        impedanceFromCSV.plot_debug(result, impedanceFromCSV.debug_filename(path, options.outpath))
+        watch.lap('plot debug')
+
+    watch.start()
+    impedanceFromCSV.load_image(path, emissivity=options.emissivity, frameAverage=options.frame_average, lut=options.lut)
+    watch.lap('load_image')
+    return watch.laps, result
+
+def _statistics(times):
+    return {'first': times[0], 'min': float(np.min(times)), 'median': float(np.median(times))}
+
+def benchmark_case(regime, faces, shape, frames, workdir, config, repeat=5, noise=0.05, seed=0, analysisArgs=(), plots=True):
+    '''
+    Writes the synthetic capture of one case into workdir and analyses it repeat times. Returns the entry of the
+    case in the results.
+    '''
+    twoFace = faces == 2
+    orientation = None if twoFace else 'L'
+    name = case_name(regime, faces, shape, frames)
+    startTime = time.perf_counter()
+    stack, meta, process, boundaries = synthetic_capture(shape, regime, twoFace, orientation, frames, noise, seed)
+    path = write_capture(os.path.join(workdir, name + ".npz"), stack, meta, process)
+    generated = time.perf_counter() - startTime
+
+    argv = [path, config, '-o', os.path.join(workdir, "output")] + ([] if twoFace else ['-1f', '--orientation', orientation]) + list(analysisArgs)
+    options = impedanceFromCSV.make_parser().parse_args(argv)
+    os.makedirs(options.outpath, exist_ok=True)
+
+    runs = []
+    for i in range(repeat):
+        # the analysis prints a lot; the benchmark only reports the times
+        with contextlib.redirect_stdout(io.StringIO()):
+            laps, result = run_stages(path, options, plots)
+        runs.append(laps)
+
+    staves = [result.staveTop] if not twoFace else [result.staveTop, result.staveBottom]
+    edgeError = max(abs(found/IMAGE_SCALE - true) for stave, truth in zip(staves, boundaries) for found, true in zip(stave.boundaries, truth))
+    stages = {stage: _statistics([laps[stage] for laps in runs]) for stage in STAGES + ('load_image',) if stage in runs[0]}
+    totals = [sum(laps[stage] for stage in STAGES if stage in laps) for laps in runs]
+    return {'name': name, 'regime': regime, 'faces': faces, 'resolution': [shape[1], shape[0]], 'frames': frames, 'noise': noise,
+            'seed': seed, 'repeat': repeat, 'generate': generated, 'stages': stages, 'total': _statistics(totals),
+            'edgeError': float(edgeError), 'earImpedanceTop': float(result.earImpedanceTop),
+            'meanLargeTop': float(np.mean(result.largeTop))}
+
+def environment():
+    # what the times depend on besides the code
+    import cv2
+    import matplotlib
+    commit = None
+    with contextlib.suppress(OSError, subprocess.CalledProcessError):
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True,
+                                text=True, check=True).stdout.strip()
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__, 'matplotlib': matplotlib.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(), 'commit': commit}
+
+def print_case(case):
+    print("{}  (edge error {:.2f} px, Z_earTop {:.3f})".format(case['name'], case['edgeError'], case['earImpedanceTop']))
+    for stage, times in list(case['stages'].items()) + [('total', case['total'])]:
+        print("  {:18} first {:9.2f} ms   median {:9.2f} ms   min {:9.2f} ms".format(stage, 1e3*times['first'], 1e3*times['median'], 1e3*times['min']))
+
+def compare(results, baseline, tolerance=0.25, minimum=1e-3):
+    '''
+    The stages (and totals) whose median got slower than in the baseline by more than the fraction tolerance;
+    stages that take less than minimum seconds in both are left out, their times are mostly noise.
+    '''
+    regressions = []
+    cases = {case['name']: case for case in baseline['cases']}
+    for case in results['cases']:
+        if case['name'] not in cases:
+            continue
+        old = dict(cases[case['name']]['stages'], total=cases[case['name']]['total'])
+        for stage, times in list(case['stages'].items()) + [('total', case['total'])]:
+            if stage not in old or max(times['median'], old[stage]['median']) < minimum:
+                continue
+            ratio = times['median']/max(old[stage]['median'], 1e-9)
+            if ratio > 1 + tolerance:
+                regressions.append((case['name'], stage, old[stage]['median'], times['median']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Times the stages of the analysis on synthetic captures. Any further options are passed to impedanceFromCSV.py.")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="The JSON file of the results (default: benchmark.json)")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "npz-template.cfg"),
+                        help="The configuration file (default: npz-template.cfg)")
+    parser.add_argument("--regimes", nargs='+', choices=sorted(REGIMES), default=['hot', 'cold'])
+    parser.add_argument("--faces", nargs='+', type=int, choices=[1, 2], default=[1, 2])
+    parser.add_argument("--resolutions", nargs='+', type=parse_resolution, default=[(480, 640)], help="Width x height of the images (default: 640x480)")
+    parser.add_argument("--frames", nargs='+', type=int, default=[5], help="Numbers of frames per capture (default: 5)")
+    parser.add_argument("--noise", type=float, default=0.05, help="Noise of a pixel in one frame, in K (default: 0.05)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5, help="Number of analyses of every case (default: 5)")
+    parser.add_argument("--no-plots", action="store_true", help="Leave out the plots")
+    parser.add_argument("--workdir", default=None, help="Where the captures and outputs go (default: a temporary directory, removed afterwards)")
+    parser.add_argument("--compare", default=None, help="A JSON file of an earlier run to compare the medians with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="With --compare: the fraction a stage may get slower (default: 0.25)")
+    args, analysisArgs = parser.parse_known_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="thermal_qa_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    results = {'version': FORMAT_VERSION, 'created': time.strftime("%Y-%m-%dT%H:%M:%S"), 'environment': environment(),
+               'settings': {'config': args.config, 'repeat': args.repeat, 'plots': not args.no_plots, 'analysisArgs': analysisArgs},
+               'cases': []}
+    try:
+        for regime, faces, shape, frames in itertools.product(args.regimes, args.faces, args.resolutions, args.frames):
+            case = benchmark_case(regime, faces, shape, frames, workdir, args.config, args.repeat, args.noise, args.seed, analysisArgs,
+                                  plots=not args.no_plots)
+            results['cases'].append(case)
+            print_case(case)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    from atomicfile import atomic_output
+    with atomic_output(args.output) as f:
+        json.dump(results, f, indent=1)
+    print("Wrote the results to " + args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, stage, old, new in regressions:
+            print("SLOWER: {} {}: {:.2f} ms -> {:.2f} ms ({:+.0f}%)".format(name, stage, 1e3*old, 1e3*new, 100*(new/old - 1)))
+        print("{} regressions against {}".format(len(regressions), args.compare))
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,22 @@
 import os
+import sys
 import time
-import subprocess
+import queue
+import threading
+import multiprocessing
 from tkinter import *
 from tkinter import filedialog
 from PIL import Image, ImageTk
 from itertools import compress
 
+#the analysis code lives one folder up; the files are analysed on worker processes (see batch.py), or by the
+#analysis server if one is running (see server.py)
+ANALYSIS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ANALYSIS_DIR)
+from server import connect
+from batch import run_batch, JobResult, CANCELLED
+from geometry import TrialGeometry
+
 global fileList
 global dirmemory
 global confirmToken
@@ -13,6 +24,28 @@ global confirmToken
 fileList = []
 dirmemory = "/"
 confirmToken = False
+analysisClient = None
+
+#the batch runs in a background thread, which reports every file through batchQueue; the window polls it
+#every POLL_INTERVAL milliseconds, so that it stays responsive
+POLL_INTERVAL = 100
+batchThread = None
+batchQueue = queue.Queue()
+batchCancel = threading.Event()
+batchFiles = []
+batchArguments = []
+batchResults = []
+batchStart = 0.
+
+def getAnalysisClient():
+    #the analysis server if one is running (see server.py), otherwise None
+    global analysisClient
+    if analysisClient is None:
+        try:
+            analysisClient = connect(fallback=False)
+        except Exception:
+            return None
+    return analysisClient
 
 def browseFiles():
     global fileList
@@ -34,47 +67,19 @@ def browseFiles():
     label_file_explorer.configure(text= str(len(fileList)) + " Files Opened at: " + dirmemory)
 
 def analyze():
-    if confirmToken and len(fileList) > 0:
-        to_execute0, to_execute1 = parseVars()
-        starting_directory = r"C:\Users\ATLAS STAVE QC\Desktop\Thermal Analysis\AtlStaveQAInfraRedAnalysis\ThermalImpedanceQA" #starting directory SPECIFICALLY FOR THERMAL COMPUTER IN LAB
-        startTime = time.time()
-        numFiles = len(fileList)
-        average = 0
-
-        for i in fileList:
-            startwatch = time.time()
-            executable_command = to_execute0 + '"' + i + '"' + to_execute1
+    if batchThread is not None:
+        label_file_explorer.configure(text="Please wait for the running batch to finish, or cancel it.")
 
-            fileName = i[i.rindex("/"):]
+    elif confirmToken and len(fileList) > 0:
+        arguments = parseVars()
 
-            print("\nCOMMAND TO EXECUTE: ")
-            print(executable_command + "\n")
+        #the stave edges are found once per trial and saved next to its files; find them again if asked to
+        if refindEdges.get():
+            for trialDirectory in sorted(set(os.path.dirname(os.path.abspath(i)) for i in fileList)):
+                TrialGeometry(trialDirectory).invalidate()
+                print("Invalidated the stave geometry of " + trialDirectory)
 
-            label_file_explorer.configure(text= " Analyzing file: " + fileName)
-            label_file_explorer.update()
-
-            process = subprocess.run(
-                ["powershell", "-ExecutionPolicy", "Bypass", "-Command", executable_command],
-                cwd=starting_directory,
-                capture_output=True,  # Capture output for further processing (optional)
-            )
-
-            # Check for errors
-            if process.returncode == 0:
-                # Access captured output if needed
-                output = process.stdout.decode()
-                print(output)
-            else:
-                print(f"Error running Powershell command: {process.stderr.decode()}")
-            
-            average += (time.time() - startwatch)/numFiles
-
-        average = round(average, 3)
-        timeElapsed = round(time.time() - startTime, 3)
-        label_file_explorer.configure(text=
-                                      "All files done and ready for next batch. Time elapsed: " + str(timeElapsed) + " seconds. Average time per file: " + str(average) + " seconds.")
-        
-        reenable()
+        startBatch(list(fileList), arguments)
 
     elif not confirmToken:
         label_file_explorer.configure(text="Please confirm your settings first. ")
@@ -82,16 +87,152 @@ def analyze():
     elif not len(fileList) > 0:
         label_file_explorer.configure(text="Please select some files to analyze!")
 
+def runBatch(files, arguments, jobs, cancel, results):
+    #runs in the background thread: everything it has to tell the window goes through the queue results
+    global analysisClient
+    try:
+        client = getAnalysisClient()
+        if client is None:
+            run_batch(files, arguments[0], arguments[1:], jobs=jobs, cancel=cancel, callback=lambda result: results.put(('result', result)),
+                      trials=True)
+            return
+
+        #the server analyses one file after the other
+        for n, i in enumerate(files):
+            if cancel.is_set():
+                results.put(('result', JobResult(i, False, 0., CANCELLED)))
+                continue
+            startwatch = time.time()
+            try:
+                response = client.analyze([i] + arguments)
+            except Exception as error:
+                #e.g. the server was stopped: this file and the remaining ones are analysed here
+                print(f"Lost the analysis server ({error!r}), analysing the remaining files here")
+                analysisClient = None
+                run_batch(files[n:], arguments[0], arguments[1:], jobs=jobs, cancel=cancel, callback=lambda result: results.put(('result', result)),
+                          trials=True)
+                return
+            sys.stdout.write(response['output'])
+            results.put(('result', JobResult(i, response['ok'], time.time() - startwatch, response['error'] or "")))
+    except Exception as error:
+        results.put(('error', repr(error)))
+    finally:
+        results.put(('done', None))
+
+def startBatch(files, arguments):
+    global batchThread
+    global batchFiles
+    global batchArguments
+    global batchResults
+    global batchStart
+
+    print("\nARGUMENTS: ")
+    print(' '.join(arguments) + "\n")
+
+    batchFiles = files
+    batchArguments = arguments
+    batchResults = []
+    batchStart = time.time()
+    batchCancel.clear()
+    timings_list.delete(0, END)
+
+    analyze_button.configure(state='disabled')
+    cancel_button.configure(state='normal')
+    retry_button.configure(state='disabled')
+
+    batchThread = threading.Thread(target=runBatch, args=(files, arguments, workers.get(), batchCancel, batchQueue), daemon=True)
+    batchThread.start()
+    showProgress()
+    root.after(POLL_INTERVAL, pollBatch)
+
+def pollBatch():
+    #takes what the background thread reported since the last poll; keeps polling until the batch is done
+    done = False
+    while True:
+        try:
+            kind, value = batchQueue.get_nowait()
+        except queue.Empty:
+            break
+        if kind == 'result':
+            showResult(value)
+        elif kind == 'error':
+            print("Error running the batch: " + value)
+        elif kind == 'done':
+            done = True
+
+    if done:
+        finishBatch()
+    else:
+        showProgress()
+        root.after(POLL_INTERVAL, pollBatch)
+
+def showResult(result):
+    batchResults.append(result)
+    fileName = os.path.basename(result.path)
+    if result.ok:
+        status = "done"
+    elif result.message == CANCELLED:
+        status = "cancelled"
+    else:
+        status = "FAILED"
+        print(f"Error analyzing {fileName}: {result.message}")
+    timings_list.insert(END, f"{result.seconds:8.2f} s   {status:10} {fileName}")
+    timings_list.see(END)
+
+def showProgress():
+    failed = sum(not i.ok for i in batchResults)
+    text = " Analyzing: " + str(len(batchResults)) + " of " + str(len(batchFiles)) + " files done"
+    if failed:
+        text += ", " + str(failed) + " failed"
+    if batchCancel.is_set():
+        text += ", cancelling"
+    label_file_explorer.configure(text=text + ". Time elapsed: " + str(round(time.time() - batchStart, 1)) + " seconds.")
+
+def finishBatch():
+    global batchThread
+
+    batchThread = None
+    timeElapsed = round(time.time() - batchStart, 3)
+    analysed = [i for i in batchResults if i.ok]
+    failed = [i for i in batchResults if not i.ok]
+    average = round(sum(i.seconds for i in analysed)/len(analysed), 3) if analysed else 0
+
+    text = "All files done and ready for next batch."
+    if batchCancel.is_set():
+        text = "Batch cancelled."
+    text += " Time elapsed: " + str(timeElapsed) + " seconds. Average time per file: " + str(average) + " seconds."
+    if failed:
+        text += " " + str(len(failed)) + " files failed or were cancelled."
+    label_file_explorer.configure(text=text)
+
+    cancel_button.configure(state='disabled')
+    retry_button.configure(state='normal' if failed else 'disabled')
+
+    reenable()
+
+def cancelBatch():
+    if batchThread is not None:
+        batchCancel.set()
+        cancel_button.configure(state='disabled')
+        showProgress()
+
+def retryFailed():
+    #analyses the files that failed or were cancelled again, with the settings of their batch
+    if batchThread is None:
+        failed = [i.path for i in batchResults if not i.ok]
+        if failed:
+            startBatch(failed, batchArguments)
+
 def parseVars():
-    initialParams0 = ['python', 'impedanceFromCSV.py']
-    initialParams1 = ['"../npz-template.cfg"']
+    #keep the converted temperature maps, so that re-analysing the same files with other settings is quick
+    initialParams1 = [os.path.join(ANALYSIS_DIR, '..', 'npz-template.cfg'), "--cache", "--trial-geometry"]
     initialParams2 = ["-g", "-1f", "-d", "--kill-shiny", "--adc"]
 
-    orientationMod = [[''], ['--orientation', 'L'], ['--orientation', 'J'], ['--orientation', 'K']]
+    orientationMod = [[], ['--orientation', 'L'], ['--orientation', 'J'], ['--orientation', 'K']]
     initialParams1.extend(orientationMod[orientation.get()])
 
     if directory.get() != "./output":
-        initialParams1.extend(["-o", '"' + directory.get() + '"'])
+        initialParams1.extend(["-o", directory.get()])
 
     if float(emissivity.get()) != 0.92:
         initialParams1.extend(["--emissivity", str(emissivity.get())])
@@ -113,19 +254,15 @@ def parseVars():
         elif l_boundsFull:
             bounds = left_boundaries
 
-        boundaries = ' '.join([i.get() for i in bounds])
+        boundaries = [i.get() for i in bounds]
 
-        initialParams1.extend(["--manual_boundaries", boundaries])
+        initialParams1.extend(["--manual_boundaries"] + boundaries)
 
     initialParams1 = initialParams1 + initialParams2
 
-    to_execute0 = ' ' + ' '.join([str(i) for i in initialParams0]) + ' '
-    to_execute1 = ' ' + ' '.join([str(i) for i in initialParams1])
-
-    #print(initialParams0, initialParams1)
-    #print(to_execute0, to_execute1)
+    #print(initialParams1)
 
-    return to_execute0, to_execute1
+    return [str(i) for i in initialParams1]
 
 def reenable():
     widgetList = borders_frame.winfo_children() + trim_frame.winfo_children() + orientation_frame.winfo_children() + emissivity_frame.winfo_children() + [textbox_outpath, label_outpath, button_debug, textbox_emissivity]
@@ -239,6 +376,7 @@ def reset():
     killEmissivity.set(value=False)
     debug.set(value=False)
     manualBoundaries.set(value=False)
+    refindEdges.set(value=False)
     ntrim.set(value='0')
     adc.set(value=False)
     directory.set(value='\\')
@@ -253,142 +391,170 @@ def reset():
 #######################################################################
 #TKINTER STUFF BELOW
 
-root = Tk()
-#getting screen width and height of display
-width= 1200
-height= 500
-#setting tkinter window size
-root.geometry("%dx%d" % (width, height))
-
-###################################################################
-#TKINTER VARIABLES
-
-directory = StringVar(value=dirmemory)
-
-orientation = IntVar(value=0)
-singleFace = BooleanVar(value=False)
-emissivity = StringVar(value="0.92")
-killEmissivity = BooleanVar(value=False)
-debug = BooleanVar(value=False)
-manualBoundaries = BooleanVar(value=False)
-ntrim = StringVar(value='0')
-adc = BooleanVar(value=False)
-
-left_boundaries = [StringVar(value="0") for i in range(4)]
-right_boundaries = [StringVar(value="0") for i in range(4)]
-#for i in range(4):
-#    var_l = StringVar(value="0") 
-#    var_r = StringVar(value="0") 
-#    left_boundaries.append(var_l)
-#    right_boundaries.append(var_r)
-
-#############################################
-#SCARY TKINTER THINGY DEFINITIONS AND PLACEMENT ooooooOOOOOOOOOoooo
-
-label_file_explorer = Label(root, height=1, width = 100, text="Batch Calculate Impedance for Thermal QC.", foreground="blue")
-
-organization_frame = Frame(root)
-
-controls_frame=LabelFrame(organization_frame, text="Controls")
-button_explore = Button(controls_frame, text = "Browse Files", command = browseFiles, width=10, height=1, cursor= "hand2")
-label_outpath = Label(controls_frame, text="Files writing to:", width=20, height=1)
-textbox_outpath = Entry(controls_frame, textvariable = directory, width=20)
-button_debug = Checkbutton(controls_frame, text="Run in debug mode", var=debug, width=20, height=1)
-button_reset = Button(controls_frame, text = "Reset", command=reset, width=10, height=1, cursor = "hand2")
-button_exit = Button(controls_frame, text = "Exit", command = exit, width=10, height=1, cursor= "hand2")
-
-orientation_frame = LabelFrame(organization_frame, text="Orientation")
-button_orientation_L = Radiobutton(orientation_frame, text="L-side", value=1, var=orientation, height=1)
-button_orientation_J = Radiobutton(orientation_frame, text="J-side", value=2, var=orientation, height=1)
-button_orientation_K = Radiobutton(orientation_frame, text="K-side", value=3, var=orientation, height=1)
-button_singleFace = Checkbutton(orientation_frame, text="Single face", var=singleFace, height=1)
-
-borders_frame=LabelFrame(organization_frame, text="Boundaries", width=1000, height=1200)
-button_manual_boundaries = Checkbutton(borders_frame, text="use manual boundaries", width=20, height=1, var=manualBoundaries)
-
-LeftSide_left = Entry(borders_frame, textvariable=left_boundaries[0], width=4)
-LeftSide_top = Entry(borders_frame, textvariable=left_boundaries[2], width=4)
-LeftSide_right = Entry(borders_frame, textvariable=left_boundaries[1], width=4)
-LeftSide_bottom = Entry(borders_frame, textvariable=left_boundaries[3], width=4)
-
-RightSide_left = Entry(borders_frame, textvariable=right_boundaries[0], width=4)
-RightSide_top = Entry(borders_frame, textvariable=right_boundaries[2], width=4)
-RightSide_right = Entry(borders_frame, textvariable=right_boundaries[1], width=4)
-RightSide_bottom = Entry(borders_frame, textvariable=right_boundaries[3], width=4)
-
-trim_frame = Frame(borders_frame)
-n_trim = Entry(trim_frame, textvariable = ntrim, width=4)
-trim_label = Label(trim_frame, text = "nTrim parameter", height=1)
-trim_label.grid(column=0,padx=[0,5], row=0, sticky=E)
-n_trim.grid(column=1,padx=[5,0],row=0, sticky=W)
-
-pictures = [ImageTk.PhotoImage(Image.open(r'AtlStaveQAInfraRedAnalysis\ThermalImpedanceQA\build\assets\PXL_20240628_200312264.jpg').resize([80,160])), 
-            ImageTk.PhotoImage(Image.open(r'AtlStaveQAInfraRedAnalysis\ThermalImpedanceQA\build\assets\PXL_20240628_200312264.jpg').resize([80,160]))]
-
-RightSide_label = Label(borders_frame, image= pictures[0], width=100, height=175)
-LeftSide_label = Label(borders_frame, image= pictures[1], width=100, height=175)
-for i in range(7):
-    borders_frame.columnconfigure(i)
-for j in range(7):
-    borders_frame.rowconfigure(j)
-
-for i in range(5):
-    organization_frame.columnconfigure(i)
-
-emissivity_frame = LabelFrame(organization_frame, text="Emissivity")
-button_normalize = Checkbutton(emissivity_frame, text="Normalize shininess", var = killEmissivity, height=1)
-emissivity_val_frame = Frame(emissivity_frame)
-textbox_emissivity = Entry(emissivity_val_frame, textvariable = emissivity, width=5)
-label_emissivity = Label(emissivity_val_frame, text='Emissivity value: ')
-button_adc = Checkbutton(emissivity_frame, text="ADC variables", var = adc, height=1)
-
-processes_frame = Frame(organization_frame)
-confirm_button = Button(processes_frame, text="Confirm Arguments", width=20,height=8, command = confirm, bg='orange red')
-analyze_button = Button(processes_frame, text="Analyze!", width=20, height=8, command=analyze, bg="dark slate gray", fg='white', relief=SUNKEN, state='disabled')
-
-label_file_explorer.pack(side=TOP, pady=[70,40])
-
-organization_frame.pack(side=TOP)
-
-controls_frame.grid(column=1, row=1, rowspan=2, sticky=E, padx=[0,5])
-button_explore.pack(side=TOP, pady=[20,0])
-button_reset.pack(side=TOP, pady=[0,5])
-label_outpath.pack(side=TOP)
-textbox_outpath.pack(side=TOP, pady=5)
-button_debug.pack(side=TOP, pady=[0,5])
-button_exit.pack(side=TOP, pady=[0,69])
-
-orientation_frame.grid(column=2, row=1, sticky=S, padx=[5,5], pady=[0,5])
-button_orientation_L.grid(row=0, pady=[10,0], sticky=W, padx=[30,76])
-button_orientation_J.grid(row=1, sticky=W, padx=[30,75])
-button_orientation_K.grid(row=2, sticky=W, padx=[30,75])
-button_singleFace.grid(row=3, sticky=W, pady=[0,17], padx=[30,0])
-
-emissivity_frame.grid(column=2, row=2, sticky=N, padx=[5,5], pady=[5,0])
-emissivity_val_frame.grid(row=0, pady=[10,0])
-button_normalize.grid(row=1, sticky=W, padx=[15,19])
-button_adc.grid(row=2, pady=[0,15], sticky=W, padx=[15,0])
-
-label_emissivity.pack(side=LEFT)
-textbox_emissivity.pack(side=LEFT)
-
-borders_frame.grid(column=3, row=1, columnspan=4, rowspan=2, sticky=W, padx=[5,5])
-button_manual_boundaries.grid(column=3, row=0, columnspan=3)
-LeftSide_label.grid(column=1, row=3, rowspan=4)
-RightSide_label.grid(column=6, row=3, rowspan=4)
-
-LeftSide_left.grid(column=0, row=4, padx=[10,0], sticky=SE)
-LeftSide_right.grid(column=2, row=4, sticky=SW)
-LeftSide_top.grid(column=1, row=2)
-LeftSide_bottom.grid(column=1, row=8, pady=[0,10])
-RightSide_left.grid(column=5, row=4, sticky=SE)
-RightSide_right.grid(column=7, row=4, padx=[0,10], sticky=SW)
-RightSide_top.grid(column=6, row=2)
-RightSide_bottom.grid(column=6, row=8, pady=[0,10])
-trim_frame.grid(column=3, row=8)
-
-processes_frame.grid(column=7, row=1, rowspan=2, sticky=W, padx=[5,0])
-confirm_button.pack(side=TOP, pady=[5,0])
-analyze_button.pack(side=TOP, pady=[0,0])
-
-root.mainloop()
\ No newline at end of file
+#the worker processes of the batch import this file again: only the window that was started builds the GUI
+if __name__ == "__main__":
+    #for the packaged executable
+    multiprocessing.freeze_support()
+
+    root = Tk()
+    #getting screen width and height of display
+    width= 1200
+    height= 760
+    #setting tkinter window size
+    root.geometry("%dx%d" % (width, height))
+
+    ###################################################################
+    #TKINTER VARIABLES
+
+    directory = StringVar(value=dirmemory)
+
+    orientation = IntVar(value=0)
+    singleFace = BooleanVar(value=False)
+    emissivity = StringVar(value="0.92")
+    killEmissivity = BooleanVar(value=False)
+    debug = BooleanVar(value=False)
+    manualBoundaries = BooleanVar(value=False)
+    refindEdges = BooleanVar(value=False)
+    ntrim = StringVar(value='0')
+    adc = BooleanVar(value=False)
+    workers = IntVar(value=os.cpu_count() or 1)
+
+    left_boundaries = [StringVar(value="0") for i in range(4)]
+    right_boundaries = [StringVar(value="0") for i in range(4)]
+    #for i in range(4):
+    #    var_l = StringVar(value="0") 
+    #    var_r = StringVar(value="0") 
+    #    left_boundaries.append(var_l)
+    #    right_boundaries.append(var_r)
+
+    #############################################
+    #SCARY TKINTER THINGY DEFINITIONS AND PLACEMENT ooooooOOOOOOOOOoooo
+
+    label_file_explorer = Label(root, height=1, width = 100, text="Batch Calculate Impedance for Thermal QC.", foreground="blue")
+
+    organization_frame = Frame(root)
+
+    controls_frame=LabelFrame(organization_frame, text="Controls")
+    button_explore = Button(controls_frame, text = "Browse Files", command = browseFiles, width=10, height=1, cursor= "hand2")
+    label_outpath = Label(controls_frame, text="Files writing to:", width=20, height=1)
+    textbox_outpath = Entry(controls_frame, textvariable = directory, width=20)
+    button_debug = Checkbutton(controls_frame, text="Run in debug mode", var=debug, width=20, height=1)
+    button_reset = Button(controls_frame, text = "Reset", command=reset, width=10, height=1, cursor = "hand2")
+    button_exit = Button(controls_frame, text = "Exit", command = exit, width=10, height=1, cursor= "hand2")
+
+    orientation_frame = LabelFrame(organization_frame, text="Orientation")
+    button_orientation_L = Radiobutton(orientation_frame, text="L-side", value=1, var=orientation, height=1)
+    button_orientation_J = Radiobutton(orientation_frame, text="J-side", value=2, var=orientation, height=1)
+    button_orientation_K = Radiobutton(orientation_frame, text="K-side", value=3, var=orientation, height=1)
+    button_singleFace = Checkbutton(orientation_frame, text="Single face", var=singleFace, height=1)
+
+    borders_frame=LabelFrame(organization_frame, text="Boundaries", width=1000, height=1200)
+    button_manual_boundaries = Checkbutton(borders_frame, text="use manual boundaries", width=20, height=1, var=manualBoundaries)
+    button_refind_edges = Checkbutton(borders_frame, text="find edges again", width=20, height=1, var=refindEdges)
+
+    LeftSide_left = Entry(borders_frame, textvariable=left_boundaries[0], width=4)
+    LeftSide_top = Entry(borders_frame, textvariable=left_boundaries[2], width=4)
+    LeftSide_right = Entry(borders_frame, textvariable=left_boundaries[1], width=4)
+    LeftSide_bottom = Entry(borders_frame, textvariable=left_boundaries[3], width=4)
+
+    RightSide_left = Entry(borders_frame, textvariable=right_boundaries[0], width=4)
+    RightSide_top = Entry(borders_frame, textvariable=right_boundaries[2], width=4)
+    RightSide_right = Entry(borders_frame, textvariable=right_boundaries[1], width=4)
+    RightSide_bottom = Entry(borders_frame, textvariable=right_boundaries[3], width=4)
+
+    trim_frame = Frame(borders_frame)
+    n_trim = Entry(trim_frame, textvariable = ntrim, width=4)
+    trim_label = Label(trim_frame, text = "nTrim parameter", height=1)
+    trim_label.grid(column=0,padx=[0,5], row=0, sticky=E)
+    n_trim.grid(column=1,padx=[5,0],row=0, sticky=W)
+
+    pictures = [ImageTk.PhotoImage(Image.open(r'AtlStaveQAInfraRedAnalysis\ThermalImpedanceQA\build\assets\PXL_20240628_200312264.jpg').resize([80,160])), 
+                ImageTk.PhotoImage(Image.open(r'AtlStaveQAInfraRedAnalysis\ThermalImpedanceQA\build\assets\PXL_20240628_200312264.jpg').resize([80,160]))]
+
+    RightSide_label = Label(borders_frame, image= pictures[0], width=100, height=175)
+    LeftSide_label = Label(borders_frame, image= pictures[1], width=100, height=175)
+    for i in range(7):
+        borders_frame.columnconfigure(i)
+    for j in range(7):
+        borders_frame.rowconfigure(j)
+
+    for i in range(5):
+        organization_frame.columnconfigure(i)
+
+    emissivity_frame = LabelFrame(organization_frame, text="Emissivity")
+    button_normalize = Checkbutton(emissivity_frame, text="Normalize shininess", var = killEmissivity, height=1)
+    emissivity_val_frame = Frame(emissivity_frame)
+    textbox_emissivity = Entry(emissivity_val_frame, textvariable = emissivity, width=5)
+    label_emissivity = Label(emissivity_val_frame, text='Emissivity value: ')
+    button_adc = Checkbutton(emissivity_frame, text="ADC variables", var = adc, height=1)
+
+    processes_frame = Frame(organization_frame)
+    confirm_button = Button(processes_frame, text="Confirm Arguments", width=20,height=8, command = confirm, bg='orange red')
+    analyze_button = Button(processes_frame, text="Analyze!", width=20, height=8, command=analyze, bg="dark slate gray", fg='white', relief=SUNKEN, state='disabled')
+
+    batch_frame = LabelFrame(root, text="Batch")
+    batch_controls_frame = Frame(batch_frame)
+    label_workers = Label(batch_controls_frame, text="Workers: ")
+    spinbox_workers = Spinbox(batch_controls_frame, from_=1, to=os.cpu_count() or 1, textvariable=workers, width=4)
+    cancel_button = Button(batch_controls_frame, text="Cancel", command=cancelBatch, width=12, height=1, cursor="hand2", state='disabled')
+    retry_button = Button(batch_controls_frame, text="Retry failed", command=retryFailed, width=12, height=1, cursor="hand2", state='disabled')
+    timings_scrollbar = Scrollbar(batch_frame)
+    timings_list = Listbox(batch_frame, height=10, width=140, font=("Courier", 9), yscrollcommand=timings_scrollbar.set)
+    timings_scrollbar.configure(command=timings_list.yview)
+
+    label_file_explorer.pack(side=TOP, pady=[70,40])
+
+    organization_frame.pack(side=TOP)
+
+    controls_frame.grid(column=1, row=1, rowspan=2, sticky=E, padx=[0,5])
+    button_explore.pack(side=TOP, pady=[20,0])
+    button_reset.pack(side=TOP, pady=[0,5])
+    label_outpath.pack(side=TOP)
+    textbox_outpath.pack(side=TOP, pady=5)
+    button_debug.pack(side=TOP, pady=[0,5])
+    button_exit.pack(side=TOP, pady=[0,69])
+
+    orientation_frame.grid(column=2, row=1, sticky=S, padx=[5,5], pady=[0,5])
+    button_orientation_L.grid(row=0, pady=[10,0], sticky=W, padx=[30,76])
+    button_orientation_J.grid(row=1, sticky=W, padx=[30,75])
+    button_orientation_K.grid(row=2, sticky=W, padx=[30,75])
+    button_singleFace.grid(row=3, sticky=W, pady=[0,17], padx=[30,0])
+
+    emissivity_frame.grid(column=2, row=2, sticky=N, padx=[5,5], pady=[5,0])
+    emissivity_val_frame.grid(row=0, pady=[10,0])
+    button_normalize.grid(row=1, sticky=W, padx=[15,19])
+    button_adc.grid(row=2, pady=[0,15], sticky=W, padx=[15,0])
+
+    label_emissivity.pack(side=LEFT)
+    textbox_emissivity.pack(side=LEFT)
+
+    borders_frame.grid(column=3, row=1, columnspan=4, rowspan=2, sticky=W, padx=[5,5])
+    button_manual_boundaries.grid(column=3, row=0, columnspan=3)
+    button_refind_edges.grid(column=3, row=1, columnspan=3)
+    LeftSide_label.grid(column=1, row=3, rowspan=4)
+    RightSide_label.grid(column=6, row=3, rowspan=4)
+
+    LeftSide_left.grid(column=0, row=4, padx=[10,0], sticky=SE)
+    LeftSide_right.grid(column=2, row=4, sticky=SW)
+    LeftSide_top.grid(column=1, row=2)
+    LeftSide_bottom.grid(column=1, row=8, pady=[0,10])
+    RightSide_left.grid(column=5, row=4, sticky=SE)
+    RightSide_right.grid(column=7, row=4, padx=[0,10], sticky=SW)
+    RightSide_top.grid(column=6, row=2)
+    RightSide_bottom.grid(column=6, row=8, pady=[0,10])
+    trim_frame.grid(column=3, row=8)
+
+    processes_frame.grid(column=7, row=1, rowspan=2, sticky=W, padx=[5,0])
+    confirm_button.pack(side=TOP, pady=[5,0])
+    analyze_button.pack(side=TOP, pady=[0,0])
+
+    batch_frame.pack(side=TOP, pady=[10,0])
+    batch_controls_frame.pack(side=TOP, anchor=W, pady=[5,5])
+    label_workers.pack(side=LEFT, padx=[10,0])
+    spinbox_workers.pack(side=LEFT, padx=[0,20])
+    cancel_button.pack(side=LEFT, padx=[0,5])
+    retry_button.pack(side=LEFT)
+    timings_scrollbar.pack(side=RIGHT, fill=Y)
+    timings_list.pack(side=LEFT, padx=[10,0], pady=[0,10])
+
+    root.mainloop()
\ No newline at end of file
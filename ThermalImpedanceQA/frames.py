@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+'''
+frames.py
+
+About: Lazy access to the frames of a capture and streaming reductions over them.
+
+  iter_frames() yields the (frame, metadata) pairs of any of our capture layouts one at a time:
+    - frame stores (see framestore.py), whose frames are memory-mapped,
+    - .npz files with an 'image' object array of (image, metadata) pairs (the acquisition format),
+    - .npz files with an 'images' stack and the calibration parameters as further keys (thermal controller),
+    - .npy stacks, either numeric (memory-mapped) or object arrays of (image, metadata) pairs,
+    - .csv files, which hold a single frame.
+  temperature_frames() converts them to temperature on the fly, and the reducers (RunningMean, TrimmedMean,
+  ApproximateMedian) combine them while holding only a fixed number of frames in memory.
+'''
+
+import os
+import re
+import glob
+import zipfile
+import numpy as np
+
+from process_tc_data import AdcConverter, calibration_key, lookup_table, CALIBRATION_KEYS
+from atomicfile import atomic_output
+from framestore import FrameStore, is_frame_store, npz_member_memmap
+
+def _csv_sidecar(path):
+    # the sidecar name carries the size and modification time of the CSV file, so an edited export is re-read
+    stat = os.stat(path)
+    return "{}.{}-{}.npy".format(path, stat.st_size, stat.st_mtime_ns)
+
+def is_csv_sidecar(path):
+    return re.search(r"\.csv\.\d+-\d+\.npy$", path) is not None
+
+def read_csv(path, cache=False):
+    '''
+    Reads a CSV image into a float array. numpy's C tokenizer parses the numbers straight into the float
+    array, instead of building a list of Python float lists first. With cache=True the image is also saved
+    to a .npy sidecar next to the CSV file, from which later reads of the unchanged file load directly.
+    '''
+    sidecar = _csv_sidecar(path) if cache else None
+    if sidecar is not None and os.path.isfile(sidecar):
+        try:
+            return np.load(sidecar)
+        except (OSError, ValueError):
+            pass # a broken sidecar is simply rewritten
+
+    image = np.loadtxt(path, delimiter=',', dtype=np.float64, ndmin=2)
+
+    if sidecar is not None:
+        for stale in glob.glob(glob.escape(path) + ".*-*.npy"):
+            if stale != sidecar:
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+        # written atomically, so that parallel readers never load a half-written sidecar
+        with atomic_output(sidecar, "wb") as f:
+            np.save(f, image)
+    return image
+
+def _iter_npz_stack(path, key, metadata):
+    # read the stack member of the npz file frame by frame instead of loading all of it. an uncompressed
+    # member is mapped from the file, a compressed one is decompressed one frame at a time
+    stack = npz_member_memmap(path, key)
+    if stack is not None:
+        if stack.ndim != 3:
+            raise ValueError("{}: '{}' is not a (n_frames, H, W) stack".format(path, key))
+        for frame in stack:
+            yield frame, metadata
+        return
+    with zipfile.ZipFile(path) as archive, archive.open(key + '.npy') as member:
+        version = np.lib.format.read_magic(member)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(member)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(member)
+        if fortran_order or dtype.hasobject or len(shape) != 3:
+            raise ValueError("{}: '{}' is not a C-ordered (n_frames, H, W) stack".format(path, key))
+        frame_bytes = shape[1] * shape[2] * dtype.itemsize
+        for i in range(shape[0]):
+            frame = np.frombuffer(member.read(frame_bytes), dtype=dtype).reshape(shape[1:])
+            yield frame, metadata
+
+def iter_frames(source):
+    '''
+    Yields the (frame, metadata) pairs of a capture. `source` is a file path or an already loaded object array
+    of (image, metadata) pairs. The metadata is an empty dict for frames that are temperatures already.
+    '''
+    if not isinstance(source, str):
+        for img, meta in source:
+            yield img, meta
+        return
+
+    if source.endswith('.csv'):
+        yield read_csv(source), {}
+
+    elif source.endswith('.npy'):
+        data = np.load(source, mmap_mode='r')
+        if data.dtype.hasobject:
+            yield from iter_frames(np.load(source, allow_pickle=True))
+        elif data.ndim == 2:
+            yield data, {}
+        else:
+            for frame in data:
+                yield frame, {}
+
+    elif is_frame_store(source):
+        yield from FrameStore(source)
+
+    elif source.endswith('.npz'):
+        with np.load(source, allow_pickle=True) as npzfile:
+            keys = list(npzfile.keys())
+            if 'images' not in keys:
+                # the object array has to be unpickled as a whole, but the frames stay in their raw type
+                images = npzfile['image']
+            else:
+                metadata = {k: npzfile[k][()] for k in keys if k != 'images'}
+        if 'images' not in keys:
+            yield from iter_frames(images)
+        else:
+            yield from _iter_npz_stack(source, 'images', metadata)
+
+    else:
+        raise ValueError("Unknown capture format: " + source)
+
+def temperature_frames(frames, emissivity=None, lut=False):
+    '''
+    Converts (frame, metadata) pairs to temperature, yielding (temperature, metadata). Frames with calibration
+    metadata are converted from ADC counts, the emissivity is overridden if provided; frames without are
+    passed through as float. With lut=True the counts are converted through the cached lookup tables.
+    The temperature buffer is reused for the next frame, copy it to keep it.
+    '''
+    converters = {}
+    out = None
+    for frame, meta in frames:
+        if not all(k in meta for k in CALIBRATION_KEYS if k != 'Transmissivity'):
+            yield np.asarray(frame, dtype=np.float64), meta
+            continue
+        key = calibration_key(meta, emissivity)
+        if key not in converters:
+            converters[key] = lookup_table(meta, emissivity) if lut else AdcConverter(dict(zip(CALIBRATION_KEYS, key)))
+        if out is None or out.shape != np.shape(frame):
+            out = np.empty(np.shape(frame), dtype=np.float64)
+        yield converters[key].convert(frame, out=out), meta
+
+class RunningMean:
+    # mean over all frames; holds one frame
+    def __init__(self):
+        self.count = 0
+        self.total = None
+
+    def add(self, frame):
+        if self.total is None:
+            self.total = np.array(frame, dtype=np.float64)
+        else:
+            self.total += frame
+        self.count += 1
+
+    def result(self):
+        return self.total / self.count
+
+class TrimmedMean:
+    # mean after dropping the `trim` lowest and `trim` highest values of every pixel; holds 2*trim frames plus the running sum.
+    # falls back to the plain mean while there are not more than 2*trim frames.
+    def __init__(self, trim=1):
+        self.trim = trim
+        self.mean = RunningMean()
+        self.lowest = []  # sorted ascending, the lowest values of every pixel
+        self.highest = [] # sorted descending
+
+    def _insert(self, kept, frame, better, worse):
+        # insertion step of a sorting network: `frame` passes through the kept frames, the worst value falls out
+        value = np.array(frame, dtype=np.float64)
+        for i in range(len(kept)):
+            kept[i], value = better(kept[i], value), worse(kept[i], value)
+        if len(kept) < self.trim:
+            kept.append(value)
+
+    def add(self, frame):
+        self.mean.add(frame)
+        if self.trim > 0:
+            self._insert(self.lowest, frame, np.minimum, np.maximum)
+            self._insert(self.highest, frame, np.maximum, np.minimum)
+
+    def result(self):
+        count = self.mean.count - 2*self.trim
+        if count <= 0:
+            return self.mean.result()
+        return (self.mean.total - sum(self.lowest) - sum(self.highest)) / count
+
+class ApproximateMedian:
+    # per-pixel median. the first `window` frames are kept and give the exact median; after that the
+    # estimate is refined by stochastic approximation, m += rate*spread*sign(frame - m)/n, where spread
+    # is the running mean absolute deviation of the pixel. holds `window` frames at most.
+    def __init__(self, window=9, rate=2.0):
+        self.window = window
+        self.rate = rate
+        self.count = 0
+        self.buffer = []
+        self.median = None
+        self.spread = None
+
+    def add(self, frame):
+        self.count += 1
+        if self.median is None:
+            self.buffer.append(np.array(frame, dtype=np.float64))
+            if len(self.buffer) >= self.window:
+                stack = np.stack(self.buffer)
+                self.median = np.median(stack, axis=0)
+                self.spread = np.mean(np.abs(stack - self.median), axis=0)
+                self.buffer = []
+            return
+        deviation = frame - self.median
+        self.spread += (np.abs(deviation) - self.spread) / self.count
+        self.median += self.rate * self.spread * np.sign(deviation) / self.count
+
+    def result(self):
+        if self.median is None:
+            return np.median(np.stack(self.buffer), axis=0)
+        return self.median.copy()
+
+REDUCERS = {'mean': RunningMean, 'trimmed': TrimmedMean, 'median': ApproximateMedian}
+
+def reduce_frames(frames, reducer='mean'):
+    # reduce temperature frames (or (temperature, metadata) pairs) with one of the REDUCERS (or a reducer object)
+    if isinstance(reducer, str):
+        reducer = REDUCERS[reducer]()
+    for frame in frames:
+        if isinstance(frame, tuple):
+            frame = frame[0]
+        reducer.add(frame)
+    return reducer.result()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+'''
+framestore.py
+
+About: A capture format that can be memory-mapped and read without unpickling, and a converter to it.
+
+  A frame store is an uncompressed .npz file (so np.load(path) opens it without allow_pickle) with the members
+    - 'format':   the string FORMAT_NAME, by which the loaders recognise the file,
+    - 'frames':   the raw frames as one C-ordered (n_frames, H, W) array in their original dtype (uint16 ADC
+                  counts from the camera, or float temperatures); it is the first member of the file,
+    - 'metadata': a JSON list with one dict per frame (calibration parameters, timestamp, ...),
+    - any further plain arrays of the capture, e.g. 'thermo_data' and 'flow_data'.
+  Since the members are stored, not compressed, FrameStore maps 'frames' straight from the file with np.memmap,
+  so the frames are only read from disk when they are used. frames.iter_frames() and with it all our loaders
+  read frame stores natively.
+
+  Usage: python framestore.py <files, directories or globs> -o <output directory>
+     or: python framestore.py <files, directories or globs> --replace
+  converts the acquisition (object array of (image, metadata) pairs) and thermal controller ('images' stack)
+  .npz files; files that are frame stores already are skipped.
+'''
+
+import os
+import sys
+import json
+import glob
+import struct
+import zipfile
+import argparse
+import numpy as np
+
+from atomicfile import atomic_output
+
+FORMAT_NAME = "thermal-frames/1"
+
+def is_frame_store(path):
+    if not path.endswith('.npz'):
+        return False
+    try:
+        with np.load(path) as npzfile:
+            return 'format' in npzfile.files and str(npzfile['format']) == FORMAT_NAME
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return False
+
+def npz_member_memmap(path, key):
+    '''
+    Maps the array `key` of an uncompressed .npz file read-only from the file. Returns None if the member
+    is compressed or holds Python objects, as these cannot be mapped.
+    '''
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(key + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, 'rb') as f:
+        # the data follows the local file header (30 bytes, then the file name and the extra field)
+        f.seek(info.header_offset)
+        header = f.read(30)
+        nameLength, extraLength = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + nameLength + extraLength)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if dtype.hasobject:
+        return None
+    if 0 in shape:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+class FrameStore:
+    '''
+    An opened frame store: `frames` is the memory-mapped frame stack, `metadata` the list of per-frame dicts and
+    the other arrays of the capture are available by key, e.g. store['thermo_data'].
+    '''
+    def __init__(self, path):
+        self.path = path
+        with np.load(path) as npzfile:
+            if 'format' not in npzfile.files or str(npzfile['format']) != FORMAT_NAME:
+                raise ValueError("{} is not a frame store".format(path))
+            self.metadata = json.loads(str(npzfile['metadata']))
+            self.keys = [k for k in npzfile.files if k not in ('format', 'frames', 'metadata')]
+        self.frames = npz_member_memmap(path, 'frames')
+        if self.frames is None:
+            raise ValueError("{}: the frames of a frame store must not be compressed".format(path))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, key):
+        with np.load(self.path) as npzfile:
+            return npzfile[key]
+
+    def __iter__(self):
+        # (frame, metadata) pairs, as frames.iter_frames yields them
+        return zip(self.frames, self.metadata)
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("Cannot store {!r} in the frame metadata".format(value))
+
+def write_frame_store(path, frames, metadata, **arrays):
+    '''
+    Writes a frame store. `frames` is a (n_frames, H, W) array (or a sequence of equally shaped frames),
+    `metadata` a list of n_frames dicts and `arrays` the further arrays of the capture.
+    '''
+    frames = np.asarray(frames)
+    if frames.ndim != 3 or frames.dtype.hasobject:
+        raise ValueError("The frames must be a numeric (n_frames, H, W) array")
+    if len(metadata) != len(frames):
+        raise ValueError("Need one metadata dict per frame")
+    members = {'frames': np.ascontiguousarray(frames), 'format': np.array(FORMAT_NAME),
+               'metadata': np.array(json.dumps(list(metadata), default=_to_json))}
+    for key, value in arrays.items():
+        value = np.asarray(value)
+        if value.dtype.hasobject:
+            raise ValueError("'{}' is not a plain array".format(key))
+        members[key] = value
+    # written atomically, so that nobody reads a half-written store
+    with atomic_output(path, "wb") as f:
+        # np.savez writes the members in this order, and does not compress them
+        np.savez(f, **members)
+
+def convert_capture(source, destination):
+    '''
+    Converts a capture in the acquisition layout (an 'image' object array of (image, metadata) pairs) or in the
+    thermal controller layout (an 'images' stack with the calibration parameters as further keys) to a frame store.
+    '''
+    with np.load(source, allow_pickle=True) as npzfile:
+        keys = list(npzfile.keys())
+        if 'image' in keys:
+            pairs = npzfile['image']
+            frames = np.stack([np.asarray(img) for img, meta in pairs])
+            metadata = [dict(meta) for img, meta in pairs]
+            arrays = {k: npzfile[k] for k in keys if k != 'image'}
+        elif 'images' in keys:
+            frames = npzfile['images']
+            meta = {k: npzfile[k][()] for k in keys if k != 'images'}
+            metadata = [meta] * len(frames)
+            arrays = {}
+        else:
+            raise ValueError("{}: neither an 'image' nor an 'images' capture".format(source))
+    write_frame_store(destination, frames, metadata, **arrays)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Converts .npz captures to memory-mappable frame stores.")
+    parser.add_argument("inputs", nargs='+', help="Input files, directories or glob patterns")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("-o", "--outpath", help="Directory to write the frame stores to, under the names of the inputs")
+    target.add_argument("--replace", action="store_true", help="Replace the inputs with their frame stores")
+    args = parser.parse_args(argv)
+
+    files = []
+    for pattern in args.inputs:
+        if os.path.isdir(pattern):
+            files += sorted(glob.glob(os.path.join(glob.escape(pattern), '*.npz')))
+        else:
+            files += sorted(glob.glob(pattern)) or [pattern]
+    if args.outpath:
+        os.makedirs(args.outpath, exist_ok=True)
+
+    failed = 0
+    for path in files:
+        if is_frame_store(path):
+            print("skipped {} (a frame store already)".format(path))
+            continue
+        with np.load(path) as npzfile:
+            if 'image' not in npzfile.files and 'images' not in npzfile.files:
+                # e.g. the graphs file of a thermal controller run
+                print("skipped {} (no frames)".format(path))
+                continue
+        destination = path if args.replace else os.path.join(args.outpath, os.path.basename(path))
+        try:
+            convert_capture(path, destination)
+        except Exception as e:
+            print("FAILED {}: {}".format(path, e))
+            failed += 1
+            continue
+        print("converted {} -> {}".format(path, destination))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
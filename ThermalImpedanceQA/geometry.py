@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+'''
+geometry.py
+
+About: The stave boundaries of a trial, saved next to its files. All files of a trial are taken with the stave at
+  the same place, hot and cold alike, so the edges only need to be found (or entered manually) once: the first
+  analysis saves the boundaries to the sidecar file stave_geometry.json in the directory of the trial, and the
+  later ones take them from there instead of searching again. impedanceFromCSV.py (with --trial-geometry),
+  process_tc_data.py and the GUI share the sidecar.
+
+  Analyses running in parallel (batch.py, the GUI) may find the edges of a trial at the same time: the first one
+  to save them wins, and the others take its boundaries instead of their own, so that all files of the trial use
+  the same ones. The sidecar is changed under the lock file stave_geometry.json.lock.
+
+  A sidecar holds one entry per setup, i.e. per orientation (or two faces) and image size, so the two sides of a
+  stave analysed in one directory do not mix. After the stave was moved, the entries have to be invalidated:
+  with --invalidate-geometry of the analysis scripts, or
+     python geometry.py <trial directory> --invalidate
+  Without --invalidate, this shows the saved boundaries.
+'''
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import datetime
+import contextlib
+
+from atomicfile import atomic_output
+
+SIDECAR_NAME = "stave_geometry.json"
+
+# how long to wait for the lock of a sidecar, and the age (in seconds) after which a lock is taken to be left
+# behind by a crashed process
+LOCK_TIMEOUT = 30.
+LOCK_STALE = 60.
+
+# the sidecars read by this process, by path: ((size, modification time), content)
+_sidecars = {}
+
+def setup_key(shape, orientation, scale):
+    # the orientation decides between one face (L, J, K) and two faces (None)
+    return "{} {}x{} scale {}".format(orientation or "two-face", shape[0], shape[1], scale)
+
+class TrialGeometry:
+    '''
+    The sidecar of the trial in `directory`. get() returns the saved boundaries of a setup, a list with one
+    (xLeft, xRight, yTop, yBottom) per stave in pixels of the scaled image, or None.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, SIDECAR_NAME)
+
+    @classmethod
+    def of_file(cls, path):
+        return cls(os.path.dirname(os.path.abspath(path)))
+
+    def _read(self):
+        # a long-running process (see server.py) reads a sidecar again only when it has changed
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return {}
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = _sidecars.get(self.path)
+        if cached is None or cached[0] != signature:
+            with open(self.path) as f:
+                cached = _sidecars[self.path] = (signature, json.load(f))
+        return copy.deepcopy(cached[1])
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # only one process at a time reads, changes and writes the sidecar
+        lockPath = self.path + ".lock"
+        deadline = time.time() + LOCK_TIMEOUT
+        while True:
+            try:
+                os.close(os.open(lockPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+                break
+            except FileExistsError:
+                with contextlib.suppress(OSError):
+                    if time.time() - os.stat(lockPath).st_mtime > LOCK_STALE:
+                        os.remove(lockPath)
+                        continue
+                if time.time() > deadline:
+                    raise Exception("Timed out waiting for the lock of " + self.path)
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(lockPath)
+
+    def _write(self, setups):
+        if not setups:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+            return
+        with atomic_output(self.path) as f:
+            json.dump(setups, f, indent=1, sort_keys=True)
+
+    def setups(self):
+        return self._read()
+
+    def get(self, key):
+        entry = self._read().get(key)
+        if entry is None:
+            return None
+        return [tuple(boundaries) for boundaries in entry["boundaries"]]
+
+    def put(self, key, boundaries, source, file=None, replace=False):
+        '''
+        Saves the boundaries of the staves of a setup; source says where they come from ('found' or 'manual').
+        Unless replace is set, boundaries another analysis saved for the setup in the meantime are kept. Returns
+        the boundaries saved for the setup, as get() does.
+        '''
+        with self._locked():
+            setups = self._read()
+            if key not in setups or replace:
+                setups[key] = {"boundaries": [[int(x) for x in stave] for stave in boundaries], "source": source,
+                               "file": os.path.basename(file) if file else None, "saved": datetime.datetime.now().isoformat(timespec="seconds")}
+                self._write(setups)
+        return [tuple(boundaries) for boundaries in setups[key]["boundaries"]]
+
+    def invalidate(self, key=None):
+        # forget the boundaries of one setup, or of all of them
+        with self._locked():
+            setups = self._read()
+            if key is None:
+                setups = {}
+            else:
+                setups.pop(key, None)
+            self._write(setups)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shows or invalidates the saved stave boundaries of a trial.")
+    parser.add_argument("directory", help="The directory of the trial")
+    parser.add_argument("--invalidate", action="store_true", help="Forget the saved boundaries, so that the next analysis finds the edges again")
+    args = parser.parse_args(argv)
+
+    geometry = TrialGeometry(args.directory)
+    if args.invalidate:
+        geometry.invalidate()
+        print("Invalidated the stave geometry of " + args.directory)
+        return 0
+    setups = geometry.setups()
+    if not setups:
+        print("No stave geometry saved in " + args.directory)
+    for key, entry in sorted(setups.items()):
+        print("{}: {} ({} from {}, {})".format(key, entry["boundaries"], entry["source"], entry["file"], entry["saved"]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
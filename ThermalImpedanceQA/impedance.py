@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+'''
+impedance.py
+
+About: The thermal impedances computed from region temperatures, for many images at once.
+
+  Every function takes the process variables (temp_in, temp_out, flow_rate, c_liquid, liquid_density) either as
+  numbers or as arrays with one value per image, and region temperatures as (n_images, n_regions) arrays, and
+  works on all images in one NumPy pass. Stave.getImpedances() and analyze_image() use the same functions for a
+  single image. batch_impedances() goes from the region temperatures of a stave (e.g. Stave.plan.evaluate() on
+  a stack of frames, with Stave.getRegionTypes()) to all impedances.
+
+  The flow rate is in liters per minute, temperatures in C, c_liquid in J/(kg K) and the density in kg/m3.
+'''
+
+import numpy as np
+
+# the corrections of the regions around the EoS ear (see Documents/2020-09-09-EOS-Impedances.pdf)
+CORRECTION_KEYS = ('dTdQ_large_0', 'dTdQ_large_1', 'dTdQ_small_0', 'dTdQ_small_1', 'dTdQ_nextEar')
+
+def _per_image(value):
+    # a column of per-image values, broadcasting against (n_images, n_regions)
+    return np.asarray(value, dtype=np.float64).reshape(-1, 1)
+
+def flow_kg_per_sec(flow_rate, liquid_density):
+    # in the config file the units are liters per minute
+    # to convert the FR to m3/s (cubic meters per second), FR is divided by 60(minute->seconds) and 1000(liter->cubic meters)
+    return (np.asarray(flow_rate, dtype=np.float64)/(60*1000))*np.asarray(liquid_density, dtype=np.float64)
+
+def liquid_temperatures(temperature_profile, temp_in, temp_out):
+    '''
+    The temperature of the cooling liquid at the points of the (relative) temperature profile: (n_images, n_points).
+    '''
+    profile = np.asarray(temperature_profile, dtype=np.float64)
+    temp_in, temp_out = _per_image(temp_in), _per_image(temp_out)
+    #scale it up
+    liquid = profile*(temp_out-temp_in)/profile[-1]
+    #shift it to match Tin
+    return liquid + (temp_in-liquid[:, :1])
+
+def segment_impedances(region_temperatures, temperature_corrections, liquid_temperature, c_liquid, flow_rate, liquid_density, heat_correction=False):
+    '''
+    The impedances of regions along the pipe, the i-th between the points i and i+1 of liquid_temperature:
+    (n_images, n_regions). temperature_corrections is subtracted from the region temperatures.
+    '''
+    region_temperatures = np.atleast_2d(np.asarray(region_temperatures, dtype=np.float64))
+    liquid_temperature = np.atleast_2d(liquid_temperature)
+    if not region_temperatures.shape[-1]+1 == liquid_temperature.shape[-1]:
+        raise Exception("The number of temperature profile data points does not match the number of regions.")
+
+    #divide by two to get the heat only for one part
+    heat = np.abs(liquid_temperature[:, :-1]-liquid_temperature[:, 1:])*_per_image(c_liquid)*0.5*_per_image(flow_kg_per_sec(flow_rate, liquid_density))
+    #heat correction: first two segments have the same heat as the third one
+    if heat_correction:
+        heat[:, 0] = heat[:, 2]
+        heat[:, 1] = heat[:, 2]
+
+    average_temp_diff = np.abs((liquid_temperature[:, :-1]+liquid_temperature[:, 1:])/2 - region_temperatures - temperature_corrections)
+    return average_temp_diff/heat
+
+def ear_correction(temperature_profile, temp_in, temp_out, c_liquid, flow_rate, liquid_density):
+    '''
+    The heat flowing through the EoS ear, the heat of the segment next to it and the liquid temperature after
+    the first segment (see Documents/2020-09-09-EOS-Impedances.pdf), one value per image each.
+    '''
+    profile = np.asarray(temperature_profile, dtype=np.float64)
+    temp_in, temp_out = np.asarray(temp_in, dtype=np.float64), np.asarray(temp_out, dtype=np.float64)
+    #total heat given up by the liquid per second
+    total_heat = (temp_in-temp_out)*np.asarray(c_liquid, dtype=np.float64)*flow_kg_per_sec(flow_rate, liquid_density)
+
+    fraction_heat_segment0 = (profile[1]-profile[0])/(profile[-1] - profile[0])
+    fraction_heat_segment1 = (profile[2]-profile[1])/(profile[-1] - profile[0])
+    fraction_heat_segment2 = (profile[3]-profile[2])/(profile[-1] - profile[0])
+
+    ear_heat = (fraction_heat_segment0+fraction_heat_segment1 - 2*fraction_heat_segment2)*total_heat/2
+    heat_next_ear = (1.0 + 54.0/98)*fraction_heat_segment2*total_heat/2
+    #liquid temperature between segments 0 and 1
+    liquid_after_segment0 = temp_in - profile[1]*(temp_in-temp_out)
+    return ear_heat, heat_next_ear, liquid_after_segment0
+
+def ear_impedance(ear_temperature, ear_heat, heat_next_ear, liquid_after_segment0, dTdQ_nextEar):
+    return (liquid_after_segment0 - np.asarray(ear_temperature, dtype=np.float64) - heat_next_ear*dTdQ_nextEar)/ear_heat
+
+def combined_impedance(small):
+    # the small regions on the way there and back in parallel, module by module
+    small = np.atleast_2d(small)
+    half = small.shape[-1]//2
+    return 1/(1/small[:, 0:half] + 1/np.flip(small[:, half:2*half], axis=-1))
+
+def batch_impedances(region_temperatures, region_types, temperature_profile, temp_in, temp_out, flow_rate, c_liquid, liquid_density, corrections):
+    '''
+    All impedances of a stave for many images. region_temperatures is (n_images, n_regions), with region_types
+    giving the type of every column ('large', 'small' and 'ear'; the columns of one type in the order of the
+    regions along the pipe). `corrections` maps CORRECTION_KEYS to their values (e.g. the config's Default section).
+    Returns a dict with 'large' and 'small' (n_images, n_regions of the type), 'combined' (n_images, n_modules)
+    and 'ear' (n_images,).
+    '''
+    region_temperatures = np.atleast_2d(np.asarray(region_temperatures, dtype=np.float64))
+    region_types = np.asarray(region_types)
+    dTdQ = {key: float(corrections[key]) for key in CORRECTION_KEYS}
+    n_images = len(region_temperatures)
+    liquid = liquid_temperatures(temperature_profile, temp_in, temp_out)
+
+    ear_heat, heat_next_ear, liquid_after_segment0 = ear_correction(temperature_profile, temp_in, temp_out, c_liquid, flow_rate, liquid_density)
+    ear_heat = np.broadcast_to(ear_heat, (n_images,))
+
+    result = {}
+    for region_type in ('large', 'small'):
+        temperatures = region_temperatures[:, region_types == region_type]
+        #correcting the surface temperatures of the segments around the EoS region
+        temperature_corrections = np.zeros_like(temperatures)
+        temperature_corrections[:, 0] = ear_heat*dTdQ['dTdQ_{}_0'.format(region_type)]
+        temperature_corrections[:, 1] = ear_heat*dTdQ['dTdQ_{}_1'.format(region_type)]
+        result[region_type] = segment_impedances(temperatures, temperature_corrections, liquid, c_liquid, flow_rate, liquid_density, heat_correction=(region_type == 'large'))
+
+    result['combined'] = combined_impedance(result['small'])
+    ear_temperature = region_temperatures[:, region_types == 'ear'][:, 0]
+    result['ear'] = ear_impedance(ear_temperature, ear_heat, heat_next_ear, liquid_after_segment0, dTdQ['dTdQ_nextEar'])
+    return result
@@ -7,432 +7,489 @@ Author: Lubos Vozdecky (Queen Mary, University of London)
 About: This program takes a thermal image of an ATLAS Itk Stave Support in CSV format,
   finds the stave and computes the thermal impedances using data of the cooling fluid saved in parameters.cfg.
   The program outputs the result impedances into the /data folder as a CSV file.
+
+  The analysis can also be used as a library: load_image() reads an input file, analyze_image() runs the
+  whole analysis on an in-memory image and config and returns an ImpedanceResult, and save_outputs()/plot_*()
+  write the same files as the command line does. The command line (main) is a thin wrapper around these.
 '''
 
 import numpy as np
 import os
-import csv
 import logging
 import argparse
 import configparser
-from matplotlib import pyplot as plt
-from stave import Stave
-
-parser = argparse.ArgumentParser()
-parser.add_argument("path", help="The path to the input CSV file")
-parser.add_argument("config", help="The path to the configuration file")
-parser.add_argument("-o", "--outpath", default="./output", help="Needs a folder for output path")
-parser.add_argument("-d","--debug", help="Runs the code in debug mode", action="store_true")
-parser.add_argument("-g","--graphs", help="Outputs the graph", action="store_true")
-parser.add_argument("-1f","--one_face", help="Using IR image with one face only", action="store_true")
-#parser.add_argument("-L","--L_flip", help="Flips the input image horizontally  before processing.", action="store_true")
-#parser.add_argument("-J","--J_flip", help="Flips the input image both vertically and horizontally before processing.", action="store_true")
-#parser.add_argument("-K", "--K_flip", action="store_true")
-parser.add_argument('--orientation', choices=['J', 'L', 'K'], help="Decides which side stave you have")
-parser.add_argument('-m','--manual_boundaries', type = int, nargs='+',
-                    help="Sets manual boundaries that overwrite the search algorithm. Use 4 (or 8) numbers divided by space. Format: [left,right,top,bottom]")
-parser.add_argument('--adc', action = "store_true", help = "Assume input is in adc units")
-parser.add_argument('--emissivity', default=0.92, type = float, help = "Overwriting emissivity value in adc_to_temp")
-parser.add_argument('--kill-shiny', action="store_true", help = "Getting rid of the bond pad shinyness")
-parser.add_argument('--nTrim', type=int, help="nTrim parameter from config file; trims pixels above/below the stave edges")
-args = parser.parse_args()
-
-
-inputFile = args.path
-configFile = args.config
-
-#check if the suffix is .csv
-#if inputFile[-3:] != "csv":
-  #print("The input file should be a .csv file")
-  #quit()
-
-#delete the debug folder if it exists and create a new one
-if args.debug:
-  if not os.path.isdir("debug_output"):
-    os.mkdir("debug_output")
-  if os.path.isfile("debug_output/debug.log"):
-    os.remove("debug_output/debug.log")
-
-#create the output folder if it doesn't exist
-#if not "output" in os.listdir("."):
-  #os.system("mkdir output")
-#os.makedirs(args.outpath, exist_ok=True)
-
-
-#set up the debugging log
-#if args.debug:
- # logging.basicConfig(filename='debug_output/debug.log',level=logging.DEBUG)
-
-#if args.L_flip and args.J_flip:
- # print("Cannot have both L and J flip options activated at the same time. Exiting...")
-  #exit()
-
-#get the git version of the code so it can be printed on the output graphs
-#gitHash = os.popen('git rev-parse --short HEAD').read()[:-2]
-#gitDate = os.popen('git log -1 --format=%cd').read()
-
-#logging.debug("Running the code version: " + gitHash + " " + gitDate)
-
-config = configparser.ConfigParser()
-
-if inputFile[-3:] == 'csv': 
-  #fetch the CSV file
-  logging.debug("Opening the CSV file")
-  imgList = []
-  with open(inputFile) as csvfile:
-    reader = csv.reader(csvfile, quoting=csv.QUOTE_NONNUMERIC)
-    for row in reader:
-      imgList.append(row)
-  image = np.array(imgList) 
-
-elif inputFile[-3:] == 'npy':
-  image = np.load(inputFile)
-elif inputFile[-3:] == 'npz':
-  assert not args.adc
-  npzfile = np.load(inputFile, allow_pickle=True)
-  from process_tc_data import npz_images_to_temp
-  image = npz_images_to_temp(npzfile['image'], emissivity=args.emissivity)
+from stave import Stave, ImageContext
+from layout import compile_layout
+from impedance import ear_correction, ear_impedance, combined_impedance
+from temperature_cache import TemperatureCache, DEFAULT_CACHE_DIR
+from atomicfile import atomic_output
+from geometry import TrialGeometry, setup_key
+
+#the staves are found and their regions defined on the image scaled up by this factor
+IMAGE_SCALE = 10
+
+#the bond pads of the modules (see Stave.killShiny): the box of the first one relative to the stave's left and
+#bottom edges, ((left, bottom), (right, top)), and the distance between two, in pixels of the scaled image
+BOND_PAD_BBOX = ((60,10),(165,50))
+BOND_PAD_PITCH = 412.5
+
+#the width of the debug image's thumbnail, in pixels (see plot_debug)
+DEBUG_IMAGE_WIDTH = 1280
+
+def make_parser():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("path", help="The path to the input CSV file")
+  parser.add_argument("config", help="The path to the configuration file")
+  parser.add_argument("-o", "--outpath", default="./output", help="Needs a folder for output path")
+  parser.add_argument("-d","--debug", help="Runs the code in debug mode", action="store_true")
+  parser.add_argument("-g","--graphs", help="Outputs the graph", action="store_true")
+  parser.add_argument("-1f","--one_face", help="Using IR image with one face only", action="store_true")
+  #parser.add_argument("-L","--L_flip", help="Flips the input image horizontally  before processing.", action="store_true")
+  #parser.add_argument("-J","--J_flip", help="Flips the input image both vertically and horizontally before processing.", action="store_true")
+  #parser.add_argument("-K", "--K_flip", action="store_true")
+  parser.add_argument('--orientation', choices=['J', 'L', 'K'], help="Decides which side stave you have")
+  parser.add_argument('-m','--manual_boundaries', type = int, nargs='+',
+                      help="Sets manual boundaries that overwrite the search algorithm. Use 4 (or 8) numbers divided by space. Format: [left,right,top,bottom]")
+  parser.add_argument('--adc', action = "store_true", help = "Assume input is in adc units")
+  parser.add_argument('--csv-cache', action = "store_true", help = "Saves a .npy copy next to a CSV input, so that the next analysis of the same file loads faster")
+  parser.add_argument('--lut', action="store_true", help = "Converts integer ADC counts through a lookup table (reports its deviation from the analytic formula)")
+  parser.add_argument('--emissivity', default=0.92, type = float, help = "Overwriting emissivity value in adc_to_temp")
+  parser.add_argument('--kill-shiny', action="store_true", help = "Getting rid of the bond pad shinyness")
+  parser.add_argument('--kill-shiny-mode', choices=['fill', 'exclude'], default='fill', help = "With --kill-shiny: fill the bond pads in from the stave next to them (fill, the default) or just exclude them from the averages (exclude)")
+  parser.add_argument('--nTrim', type=int, help="nTrim parameter from config file; trims pixels above/below the stave edges")
+  parser.add_argument('--cache', action="store_true", help="Keeps the converted temperature maps in an on-disk cache, so re-analysing a file skips loading and converting it")
+  parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="Directory of the temperature map cache")
+  parser.add_argument('--cache-size', type=int, default=2048, help="Size limit of the temperature map cache in MB; the least recently used maps are evicted")
+  parser.add_argument('--trial-geometry', action="store_true", help="Saves the stave boundaries to a sidecar in the directory of the input and takes them from there for the later files of the trial (see geometry.py)")
+  parser.add_argument('--invalidate-geometry', action="store_true", help="Forgets the saved stave boundaries of the trial first, so that the edges are found again")
+  parser.add_argument('--frame-average', choices=['mean', 'trimmed', 'median'], default='mean',
+                      help="How the frames of a npz capture are combined: mean, trimmed mean (drops the highest and lowest value of each pixel) or approximate median")
+  parser.add_argument('--results-db', help="Also adds the results to this results database (see results.py)")
+  parser.add_argument('--stave', help="The stave the input belongs to, in the results database (default: from the directory of the input)")
+  parser.add_argument('--run', help="The run the input belongs to, in the results database (default: the directory of the input)")
+  return parser
+
+def make_options(**kwargs):
+  '''
+  Returns the analysis options with the command-line defaults, e.g. make_options(orientation="L", one_face=True).
+  The keywords are the destinations of the command-line arguments.
+  '''
+  options = make_parser().parse_args(["", ""])
+  options.path = None
+  options.config = None
+  for key, value in kwargs.items():
+    if not hasattr(options, key):
+      raise TypeError("make_options(): unknown option '{}'".format(key))
+    setattr(options, key, value)
+  return options
+
+class ImpedanceResult:
+  '''
+  The impedances of one analysed image. The bottom-face values are None unless the image was analysed
+  in the two-face mode (no orientation given). config is the configuration the impedances were computed with.
+  '''
+  def __init__(self, staveTop, staveBottom, imgEdges=None, config=None):
+    self.staveTop = staveTop
+    self.staveBottom = staveBottom
+    self.config = config
+    self.__imgEdges = imgEdges
+    self.largeTop = None
+    self.smallTop = None
+    self.impedanceCombinedTop = None
+    self.earImpedanceTop = None
+    self.largeBottom = None
+    self.smallBottom = None
+    self.impedanceCombinedBottom = None
+    self.earImpedanceBottom = None
+
+  @property
+  def twoFace(self):
+    return self.staveBottom is not None
+
+  @property
+  def imgEdges(self):
+    #the scaled image with the bottom-face regions drawn in, for debugging; only made when it is asked for
+    if self.__imgEdges is None:
+      self.__imgEdges = self.staveTop.getImage()
+      if self.twoFace:
+        self.staveBottom.DrawRegions(self.__imgEdges,"small")
+        self.staveBottom.DrawRegions(self.__imgEdges,"large")
+        self.staveBottom.DrawRegions(self.__imgEdges,"ear")
+    return self.__imgEdges
+
+  @imgEdges.setter
+  def imgEdges(self, imgEdges):
+    self.__imgEdges = imgEdges
+
+  def toDict(self):
+    to_save = {'largeTop':self.largeTop, 'smallTop':self.smallTop, 'impedanceCombinedTop':self.impedanceCombinedTop, 'earImpedanceTop':self.earImpedanceTop}
+    if self.twoFace:
+      to_save.update({'largeBottom':self.largeBottom, 'smallBottom':self.smallBottom, 'impedanceCombinedBottom':self.impedanceCombinedBottom, 'earImpedanceBottom':self.earImpedanceBottom})
+    return to_save
+
+def load_image(inputFile, emissivity=0.92, frameAverage="mean", lut=False, csvCache=False):
+  '''
+  Loads the image from a .csv, .npy or .npz file. Returns the image and, for .npz files, the process variables
+  (temp_in, temp_out, flow_rate, regime) stored in the file; None otherwise. The frames of a .npz file are
+  combined with the frameAverage reducer (see frames.REDUCERS); lut converts their ADC counts through a lookup table.
+  csvCache keeps a .npy copy of a CSV image next to it, for faster re-analyses.
+  '''
+  processVariables = None
+  if inputFile[-3:] == 'csv':
+    #fetch the CSV file
+    logging.debug("Opening the CSV file")
+    from frames import read_csv
+    image = read_csv(inputFile, cache=csvCache)
+
+  elif inputFile[-3:] == 'npy':
+    image = np.load(inputFile)
+  elif inputFile[-3:] == 'npz':
+    #the frames are read by frames.iter_frames, which also knows the frame stores (see framestore.py);
+    #the process variables are plain arrays in every layout and need no unpickling
+    from process_tc_data import npz_images_to_temp
+    image = npz_images_to_temp(inputFile, emissivity=emissivity, reducer=frameAverage, lut=lut)
+    processVariables = load_process_variables(inputFile)
+
+  else:
+    raise Exception("Need to load a csv, npy or npz file")
+
+  return image, processVariables
+
+def load_process_variables(inputFile):
+  #the process variables of a .npz capture, from its thermocouple and flow readings
+  npzfile = np.load(inputFile)
   # note: only use the last 5 data points for averaging
   temp_in = np.median(npzfile['thermo_data'][-5:,2])
   logging.debug('Loading process variables from npz data')
-  config['Default'] = {
+  return {
     'temp_in': temp_in,
     'temp_out': np.median(npzfile['thermo_data'][-5:,3]),
     'flow_rate': np.median(npzfile['flow_data'][-5:]),
     'regime': 'cold' if temp_in < 0 else 'hot',
   }
 
-else:
-  print('Need to load a csv or npy file')
-  quit()
-
-logging.debug("Importing variables from config file " + configFile + " in the impedanceFromCSV.py script.")
-config.read(args.config)
-# override ntrim if provided
-if args.nTrim is not None:
-  print("Overriding nTrim value!")
-  config['Default']['nTrim'] = args.nTrim
-
-if "c_liquid" not in config["Default"]:
-  config["Default"]["c_liquid"] = config["Default"]["c_liquid_hot"] if config["Default"]["regime"] == "hot" else config["Default"]["c_liquid_cold"]
-
-if "liquid_density" not in config["Default"]:
-  config["Default"]["liquid_density"] = config["Default"]["liquid_density_hot"] if config["Default"]["regime"] == "hot" else config["Default"]["liquid_density_cold"]
-
-if args.adc:
-  from process_tc_data import adc_to_temp, DEFAULT_PARAMETERS 
-  params = DEFAULT_PARAMETERS.copy()
-
-  if args.emissivity is not None:
-    params['Emissivity'] = args.emissivity
-  image = adc_to_temp(image, params)
-  print('average temp') 
-  print(np.mean(image))
-
-#Jesse switched J and L on Jan 19
-  #J switched back to "correct" on march 8
-#if args.orientation == 'L':
-  #image = np.flip(image, axis=1)
-  #image = np.flip(image, axis=0)
-
-
-#if args.orientation == 'J':
-  #image = np.flip(image,axis=1)
-
-#if args.orientation == 'K':
-  #image = np.flip(image,axis=0)
-
-
-#####trying two below
-#if args.orientation == 'L':
-  image = np.flip(image, axis=1)
-  #image = np.flip(image, axis=0)
-
-######March 11 this is good for new cam. need to figure out L orientation 
-if args.orientation == 'J':
-  image = np.flip(image, axis=0)
-  image = np.flip(image,axis=1)
-
-
-
-
-###Way back original flips
-#if args.J_flip:
- # image = np.flip(image,axis=0)
-  #image = np.flip(image,axis=1)
-
-#if args.K_flip:
- # image = np.flip(image,axis=0)
-
-
-#creating the staves + loading the parameters from the config file
-staveTop = Stave(image, config)
-if args.orientation is None:
-  staveBottom = Stave(image, config)
-
-#scale up the images with linear extrapolation to get better results for small regions
-staveTop.ScaleImage(10)
-if args.orientation is None:
-  staveBottom.ScaleImage(10)
-
-
-if args.manual_boundaries:
-  # if the manual boundaries are set - use them
-  if args.one_face:
-    staveTop.DefineStave(args.manual_boundaries[:4])
-  #Above is the original original code before we modified it for Yale's default 1 face
-  #Jesse changed below on Feb 20 to fix the manual boundary problem. 
-  #if args.orientation is None:
-    #staveTop.DefineStave(args.manual_boundaries[:4])
-  else:
-    if len(args.manual_boundaries) < 8:
-      print("You have only provided 4 boundaries, while 8 are expected.")
-      print("Please provide 8 boundaries or run with the -1f option. Exiting...")
-      quit()
-    staveTop.DefineStave(args.manual_boundaries[:4])
-    staveBottom.DefineStave(args.manual_boundaries[4:])
-  print("Stave edges were manually set to:")
-else:
-  #finding the staves - triggers an algorithm that looks for the stave, using relative coordinates
-  if args.orientation is None:
-    staveTop.FindStaveWithin(0,1.0,0,0.46)
-    staveBottom.FindStaveWithin(0,1.0,0.54,1.0)
-  else:
-    staveTop.FindStaveWithin(0,1.0,0,1.0)
-  #print the positions of the staves
-  print("Staves' edges found at:")
-
-staveTop.Echo()
-if args.orientation is None:
-  staveBottom.Echo()
-
-
-#create a deep copy of the image, to which the edges/regions will be drawn
-#staveTop.DrawEdges(img_edges)
-#if args.orientation is None:
-  #staveBottom.DrawEdges(img_edges)
-
-if args.kill_shiny:
-  staveTop.killShiny(bbox=((60,10),(165,50)),dx=412.5)
-
-
-numModules = 14
-
-#get the scaled image; it's used later for showing the regions for debugging
-img_edges = staveTop.getImage()
-
-#large regions
-for i in range(numModules):
-  staveTop.AddRegion(i*1.0/numModules,(i+1)*1.0/numModules,0.0,0.5,"large")
-  if args.orientation is None:
-    staveBottom.AddRegion(i*1.0/numModules,(i+1)*1.0/numModules,0.5,1.0,"large")
-
-#large regions - return pipe
-for i in reversed(range(numModules)):
-  staveTop.AddRegion(i*1.0/numModules,(i+1)*1.0/numModules,0.5,1.0,"large")
-  if args.orientation is None:
-    staveBottom.AddRegion(i*1.0/numModules,(i+1)*1.0/numModules,0.0,0.5,"large")
-
-#small regions above the pipe
-for i in range(numModules):
-  #exception for near-edge regions
-  if i == 0:
-    staveTop.AddRegion(i*1.0/numModules + 0.1/numModules,(i+1)*1.0/numModules,0.247826,0.317391,"small")
-    if args.orientation is None:
-      staveBottom.AddRegion(i*1.0/numModules + 0.1/numModules,(i+1)*1.0/numModules,0.682609,0.752174,"small")
-  elif i==13:
-    staveTop.AddUBendRegion(i*1.0/numModules,(i+1)*1.0/numModules - 0.0174545,0.247826,0.317391,0.13,0.0869565,"small",bend="downwards")
-    if args.orientation is None:
-      staveBottom.AddUBendRegion(i*1.0/numModules,(i+1)*1.0/numModules - 0.0174545,0.682609,0.752174,0.13,0.0869565,"small",bend="upwards")
-  else:
-    staveTop.AddRegion(i*1.0/numModules,(i+1)*1.0/numModules,0.247826,0.317391,"small")
-    if args.orientation is None:
-      staveBottom.AddRegion(i*1.0/numModules,(i+1)*1.0/numModules,0.682609,0.752174,"small")
-#small regions above the pipe (return pipe)
-for i in reversed(range(numModules)):
-  #exception for near-edge regions
-  if i == 0:
-    staveTop.AddRegion(i*1.0/numModules + 0.1/numModules,(i+1)*1.0/numModules,0.682609,0.752174,"small")
-    if args.orientation is None:
-      staveBottom.AddRegion(i*1.0/numModules + 0.1/numModules,(i+1)*1.0/numModules,0.247826,0.317391,"small")
-  elif i==13:
-    staveTop.AddUBendRegion(i*1.0/numModules,(i+1)*1.0/numModules - 0.0174545,0.682609,0.752174,0.13,0.0869565,"small",bend="upwards")
-    if args.orientation is None:
-      staveBottom.AddUBendRegion(i*1.0/numModules,(i+1)*1.0/numModules - 0.0174545,0.247826,0.317391,0.13,0.0869565,"small",bend="downwards")
-  else:
-    staveTop.AddRegion(i*1.0/numModules,(i+1)*1.0/numModules,0.682609,0.752174,"small")
-    if args.orientation is None:
-      staveBottom.AddRegion(i*1.0/numModules,(i+1)*1.0/numModules,0.247826,0.317391,"small")
-
-#end-of-stave ear region
-#the region is defined to stay safely away from the edges: in x direction 0.1 of module length is subtracted from both sides; for y direction it's 5% of the stave width
-staveTop.AddRegion(0.1/numModules,154.0/1375-0.1/numModules,-49.0/115+0.05,0.0,"ear")
-if args.orientation is None:
-  staveBottom.AddRegion(0.1/numModules,154.0/1375-0.1/numModules,1.0,1.0+49.0/115-0.05,"ear")
-
-#drawing the regions
-#staveTop.DrawRegions(img_edges,"large")
-#staveTop.DrawRegions(img_edges,"small")
-#staveTop.DrawRegions(img_edges,"ear")
-
-staveTopTemp = staveTop.getTemperatures("small")
-
-
-if args.orientation is None:
-  staveBottom.DrawRegions(img_edges,"small")
-  staveBottom.DrawRegions(img_edges,"large")
-  staveBottom.DrawRegions(img_edges,"ear")
-
-  staveBottomTemp = staveBottom.getTemperatures("small")
-
-#correcting the temperature for the regions around the EoS ear (see Documents/2020-09-09-EOS-Impedances.pdf)
-temperatureProfile = [float(x) for x in config["Default"]["temperatureProfile"].split(",")]
-#total heat given up by the liquid per second
-flowRateKgPerSec = (float(config["Default"]["flow_rate"])/(60*1000))*float(config["Default"]["liquid_density"])
-totalHeat = (float(config["Default"]["temp_in"])-float(config["Default"]["temp_out"]))*float(config["Default"]["c_liquid"])*flowRateKgPerSec
-earTempTop = staveTop.getTemperatures("ear")[0]
-if args.orientation is None:
-  earTempBottom = staveBottom.getTemperatures("ear")[0]
-
-fractionHeat_segment0 = (temperatureProfile[1]-temperatureProfile[0])/(temperatureProfile[-1] - temperatureProfile[0])
-fractionHeat_segment1 = (temperatureProfile[2]-temperatureProfile[1])/(temperatureProfile[-1] - temperatureProfile[0])
-fractionHeat_segment2 = (temperatureProfile[3]-temperatureProfile[2])/(temperatureProfile[-1] - temperatureProfile[0])
-
-logging.debug("fractionHeat_segment0 = {}".format(fractionHeat_segment0))
-logging.debug("fractionHeat_segment1 = {}".format(fractionHeat_segment1))
-logging.debug("fractionHeat_segment2 = {}".format(fractionHeat_segment2))
-
-earHeat = (fractionHeat_segment0+fractionHeat_segment1 - 2*fractionHeat_segment2)*totalHeat/2
-heatNextEar = (1.0 + 54.0/98)*fractionHeat_segment2*totalHeat/2
-#liquid temperature between segments 0 and 1
-liqTempAfterSeg0 = float(config["Default"]["temp_in"]) - temperatureProfile[1]*(float(config["Default"]["temp_in"])-float(config["Default"]["temp_out"]))
-
-logging.debug("totalHeat = {}".format(totalHeat))
-logging.debug("earTempTop = {}".format(earTempTop))
-if args.orientation is None:
-  logging.debug("earTempBottom = {}".format(earTempBottom))
-logging.debug("earHeat = {}".format(earHeat))
-logging.debug("heatNextEar = {}".format(heatNextEar))
-logging.debug("liqTempAfterSeg0 = {}".format(liqTempAfterSeg0))
-
-#dT/dQ_region_segment as described in Documents/2020-09-09-EOS-Impedances.pdf
-#importing the values from the config file
-logging.debug("Loading the correction factors from the config file:")
-dTdQ_large_0 = float(config["Default"]["dTdQ_large_0"]) #1.193
-dTdQ_large_1 = float(config["Default"]["dTdQ_large_1"]) #0.716
-dTdQ_small_0 = float(config["Default"]["dTdQ_small_0"]) #0.591
-dTdQ_small_1 = float(config["Default"]["dTdQ_small_1"]) #0.251
-dTdQ_nextEar = float(config["Default"]["dTdQ_nextEar"]) #1.152
-
-logging.debug("dTdQ_large_0 = {}".format(dTdQ_large_0))
-logging.debug("dTdQ_large_1 = {}".format(dTdQ_large_1))
-logging.debug("dTdQ_small_0 = {}".format(dTdQ_small_0))
-logging.debug("dTdQ_small_1 = {}".format(dTdQ_small_1))
-logging.debug("dTdQ_nextEar = {}".format(dTdQ_nextEar))
-
-#correcting the surface temperatures of the segments around the EoS region
-staveTop.setTemperatureCorrection("large",0, earHeat*dTdQ_large_0)
-staveTop.setTemperatureCorrection("large",1, earHeat*dTdQ_large_1)
-staveTop.setTemperatureCorrection("small",0, earHeat*dTdQ_small_0)
-staveTop.setTemperatureCorrection("small",1, earHeat*dTdQ_small_1)
-if args.orientation is None:
-  staveBottom.setTemperatureCorrection("large",0, earHeat*dTdQ_large_0)
-  staveBottom.setTemperatureCorrection("large",1, earHeat*dTdQ_large_1)
-  staveBottom.setTemperatureCorrection("small",0, earHeat*dTdQ_small_0)
-  staveBottom.setTemperatureCorrection("small",1, earHeat*dTdQ_small_1)
-
-logging.debug("Temperature corrections for staveTop small regions: {}".format(str(staveTop.getTemperatureCorrections("small"))))
-logging.debug("Temperature corrections for staveTop large regions: {}".format(str(staveTop.getTemperatureCorrections("large"))))
-if args.orientation is None:
-  logging.debug("Temperature corrections for staveBottom small regions: {}".format(str(staveBottom.getTemperatureCorrections("small"))))
-  logging.debug("Temperature corrections for staveBottom large regions: {}".format(str(staveBottom.getTemperatureCorrections("large"))))
-
-#computing the impedance for the ear
-earImpedanceTop = (liqTempAfterSeg0 - earTempTop - heatNextEar*dTdQ_nextEar)/earHeat
-print("Z_earTop = {}".format(earImpedanceTop))
-
-if args.orientation is None:
-  earImpedanceBottom = (liqTempAfterSeg0 - earTempBottom - heatNextEar*dTdQ_nextEar)/earHeat
-  print("Z_earBottom = {}".format(earImpedanceBottom))
-
-#WIP: print the impedance on the plot as well
-
-#extracting the impedances
-largeTop = staveTop.getImpedances("large", heatCorrection=True)
-smallTop = staveTop.getImpedances("small")
-
-if args.orientation is None:
-  largeBottom = staveBottom.getImpedances("large", heatCorrection=True)
-  smallBottom = staveBottom.getImpedances("small")
-
-#compute the combined impedance
-smallTopThere = np.array(smallTop[0:14])
-smallTopReturn = np.array(smallTop[14:28])
-impedanceCombinedTop = 1/(1/smallTopThere + 1/np.flip(smallTopReturn))
-
-if args.orientation is None:
-  smallBottomThere = np.array(smallBottom[0:14])
-  smallBottomReturn = np.array(smallBottom[14:28])
-  impedanceCombinedBottom = 1/(1/smallBottomThere + 1/np.flip(smallBottomReturn))
-
-#savign data into the CSV file
-outputFilename = os.path.join(args.outpath, inputFile.split("/")[-1][:-4] + "_IMPEDANCES")
-print("Outputing data into a file: " + outputFilename + ".csv")
-with open(outputFilename+ ".csv", "w+") as f:
-  if args.orientation is not None:
-    f.write('#, topLargeRegion, topSmallRegion, smallRegionCombinedTop \n')
+def load_config(configFile, processVariables=None):
+  #the process variables of a npz file go first, so that the config file can overwrite them
+  config = configparser.ConfigParser()
+  if processVariables is not None:
+    config['Default'] = processVariables
+  logging.debug("Importing variables from config file " + configFile + " in the impedanceFromCSV.py script.")
+  config.read(configFile)
+  return config
+
+def prepare_image(image, options):
+  '''
+  Turns the loaded image into the temperature map the staves are searched in: optional ADC conversion and flips.
+  '''
+  if options.adc:
+    from process_tc_data import adc_to_temp, DEFAULT_PARAMETERS
+    params = DEFAULT_PARAMETERS.copy()
+
+    if options.emissivity is not None:
+      params['Emissivity'] = options.emissivity
+    image = adc_to_temp(image, params, lut=options.lut)
+    print('average temp')
+    print(np.mean(image))
+
+  #Jesse switched J and L on Jan 19
+    #J switched back to "correct" on march 8
+  #if args.orientation == 'L':
+    #image = np.flip(image, axis=1)
+    #image = np.flip(image, axis=0)
+
+
+  #if args.orientation == 'J':
+    #image = np.flip(image,axis=1)
+
+  #if args.orientation == 'K':
+    #image = np.flip(image,axis=0)
+
+
+  #####trying two below
+  #if args.orientation == 'L':
+    image = np.flip(image, axis=1)
+    #image = np.flip(image, axis=0)
+
+  ######March 11 this is good for new cam. need to figure out L orientation
+  if options.orientation == 'J':
+    image = np.flip(image, axis=0)
+    image = np.flip(image,axis=1)
+
+
+
+
+  ###Way back original flips
+  #if args.J_flip:
+   # image = np.flip(image,axis=0)
+    #image = np.flip(image,axis=1)
+
+  #if args.K_flip:
+   # image = np.flip(image,axis=0)
+
+  return image
+
+def analyze_image(image, config, options=None, prepared=False, geometry=None, source=None, timer=None):
+  '''
+  Runs the whole analysis on an image held in memory: optional ADC conversion, flips, finding the stave(s),
+  defining the regions and computing the impedances. The config is not modified. If the image went through
+  prepare_image() already, pass prepared=True. With a geometry (a geometry.TrialGeometry), the stave boundaries
+  saved for the trial are used instead of finding the edges, and the boundaries found (or set manually) are
+  saved there if there were none; source is the name of the file the image comes from. timer, if given, is called
+  with the name of every stage of the analysis as soon as it is done (see benchmark.py).
+  '''
+  if options is None:
+    options = make_options()
+  lap = timer or (lambda stage: None)
+
+  #work on a copy, so that one config can be shared by many images of different regimes
+  sharedConfig = config
+  config = configparser.ConfigParser()
+  config.read_dict(sharedConfig)
+
+  # override ntrim if provided
+  if options.nTrim is not None:
+    print("Overriding nTrim value!")
+    config['Default']['nTrim'] = str(options.nTrim)
+
+  if "c_liquid" not in config["Default"]:
+    config["Default"]["c_liquid"] = config["Default"]["c_liquid_hot"] if config["Default"]["regime"] == "hot" else config["Default"]["c_liquid_cold"]
+
+  if "liquid_density" not in config["Default"]:
+    config["Default"]["liquid_density"] = config["Default"]["liquid_density_hot"] if config["Default"]["regime"] == "hot" else config["Default"]["liquid_density_cold"]
+
+  lap("config")
+
+  if not prepared:
+    image = prepare_image(image, options)
+    lap("flips")
+
+  #creating the staves + loading the parameters from the config file; both faces share one image context,
+  #so the image (and its scaled version) exists only once
+  context = ImageContext(image)
+  staveTop = Stave(context, config)
+  staveBottom = None
+  if options.orientation is None:
+    staveBottom = Stave(context, config)
+
+  #scale up the images with linear extrapolation to get better results for small regions
+  staveTop.ScaleImage(IMAGE_SCALE)
+  if options.orientation is None:
+    staveBottom.ScaleImage(IMAGE_SCALE)
+  lap("ScaleImage")
+
+
+  #the boundaries saved for the trial, unless manual ones are given
+  geometryKey = setup_key(image.shape, options.orientation, IMAGE_SCALE)
+  saved = geometry.get(geometryKey) if geometry is not None and not options.manual_boundaries else None
+
+  if options.manual_boundaries:
+    # if the manual boundaries are set - use them
+    if options.one_face:
+      staveTop.DefineStave(options.manual_boundaries[:4])
+    #Above is the original original code before we modified it for Yale's default 1 face
+    #Jesse changed below on Feb 20 to fix the manual boundary problem.
+    #if args.orientation is None:
+      #staveTop.DefineStave(args.manual_boundaries[:4])
+    else:
+      if len(options.manual_boundaries) < 8:
+        print("You have only provided 4 boundaries, while 8 are expected.")
+        print("Please provide 8 boundaries or run with the -1f option. Exiting...")
+        raise Exception("8 manual boundaries are expected for the two-face analysis.")
+      staveTop.DefineStave(options.manual_boundaries[:4])
+      staveBottom.DefineStave(options.manual_boundaries[4:])
+    print("Stave edges were manually set to:")
+  elif saved is not None:
+    staveTop.DefineStave(saved[0])
+    if options.orientation is None:
+      staveBottom.DefineStave(saved[1])
+    print("Stave edges were taken from " + geometry.path + ":")
   else:
-    f.write("#, topLargeRegion, bottomLargeRegion, topSmallRegion, bottomSmallRegion, smallRegionCombinedTop, smallRegionCombinedBottom \n")
-  for i in range(0,28):
-    if i<14:
-      if args.orientation is not None:
-        f.write(str(i)+", "+str(largeTop[i])+", "+str(smallTop[i])+", "+str(impedanceCombinedTop[i]) + "\n")
-      else:
-        f.write(str(i)+", "+str(largeTop[i])+", "+str(largeBottom[i])+", "+str(smallTop[i])+", "+str(smallBottom[i]) + ", "+str(impedanceCombinedTop[i]) + ", "+str(impedanceCombinedBottom[i]) + "\n")
+    #finding the staves - triggers an algorithm that looks for the stave, using relative coordinates
+    if options.orientation is None:
+      staveTop.FindStaveWithin(0,1.0,0,0.46)
+      staveBottom.FindStaveWithin(0,1.0,0.54,1.0)
     else:
-      if args.orientation is not None:
-        f.write(str(i)+", "+str(largeTop[i])+", "+str(smallTop[i])+"\n")
+      staveTop.FindStaveWithin(0,1.0,0,1.0)
+    #print the positions of the staves
+    print("Staves' edges found at:")
+
+  if geometry is not None and saved is None:
+    staves = [staveTop] if staveBottom is None else [staveTop, staveBottom]
+    found = [tuple(int(x) for x in stave.boundaries) for stave in staves]
+    kept = geometry.put(geometryKey, found, "manual" if options.manual_boundaries else "found", source, replace=bool(options.manual_boundaries))
+    if kept != found:
+      #an analysis running in parallel saved the boundaries of the trial first: use them, like all its other files
+      for stave, boundaries in zip(staves, kept):
+        stave.DefineStave(boundaries)
+      print("Stave edges were taken from " + geometry.path + " instead:")
+
+  staveTop.Echo()
+  if options.orientation is None:
+    staveBottom.Echo()
+
+  #the scaled image was only needed to find the staves
+  context.release()
+  lap("FindStaveWithin")
+
+
+  #create a deep copy of the image, to which the edges/regions will be drawn
+  #staveTop.DrawEdges(img_edges)
+  #if args.orientation is None:
+    #staveBottom.DrawEdges(img_edges)
+
+  if options.kill_shiny:
+    staveTop.killShiny(bbox=BOND_PAD_BBOX,dx=BOND_PAD_PITCH,fill=options.kill_shiny_mode == 'fill')
+    lap("killShiny")
+
+
+  #the regions: large and small ones along the pipe, U-bends at the far end and the EoS ear (see layout.py).
+  #the layout is compiled once per stave geometry
+  nTrim = float(config["Default"]["nTrim"])
+  staveTop.AddLayout(compile_layout("long-strip", staveTop.boundaries, nTrim, face="top"))
+  if options.orientation is None:
+    staveBottom.AddLayout(compile_layout("long-strip", staveBottom.boundaries, nTrim, face="bottom"))
+  lap("regions")
+
+  #drawing the regions
+  #staveTop.DrawRegions(img_edges,"large")
+  #staveTop.DrawRegions(img_edges,"small")
+  #staveTop.DrawRegions(img_edges,"ear")
+
+  staveTopTemp = staveTop.getTemperatures("small")
+
+
+  if options.orientation is None:
+    staveBottomTemp = staveBottom.getTemperatures("small")
+
+  #correcting the temperature for the regions around the EoS ear (see Documents/2020-09-09-EOS-Impedances.pdf)
+  temperatureProfile = [float(x) for x in config["Default"]["temperatureProfile"].split(",")]
+  earTempTop = staveTop.getTemperatures("ear")[0]
+  if options.orientation is None:
+    earTempBottom = staveBottom.getTemperatures("ear")[0]
+
+  #heat through the ear, heat of the segment next to it, liquid temperature between segments 0 and 1 (see impedance.py)
+  earHeat, heatNextEar, liqTempAfterSeg0 = (float(x) for x in ear_correction(temperatureProfile, float(config["Default"]["temp_in"]), float(config["Default"]["temp_out"]),
+                                                                             float(config["Default"]["c_liquid"]), float(config["Default"]["flow_rate"]), float(config["Default"]["liquid_density"])))
+
+  logging.debug("earTempTop = {}".format(earTempTop))
+  if options.orientation is None:
+    logging.debug("earTempBottom = {}".format(earTempBottom))
+  logging.debug("earHeat = {}".format(earHeat))
+  logging.debug("heatNextEar = {}".format(heatNextEar))
+  logging.debug("liqTempAfterSeg0 = {}".format(liqTempAfterSeg0))
+
+  #dT/dQ_region_segment as described in Documents/2020-09-09-EOS-Impedances.pdf
+  #importing the values from the config file
+  logging.debug("Loading the correction factors from the config file:")
+  dTdQ_large_0 = float(config["Default"]["dTdQ_large_0"]) #1.193
+  dTdQ_large_1 = float(config["Default"]["dTdQ_large_1"]) #0.716
+  dTdQ_small_0 = float(config["Default"]["dTdQ_small_0"]) #0.591
+  dTdQ_small_1 = float(config["Default"]["dTdQ_small_1"]) #0.251
+  dTdQ_nextEar = float(config["Default"]["dTdQ_nextEar"]) #1.152
+
+  logging.debug("dTdQ_large_0 = {}".format(dTdQ_large_0))
+  logging.debug("dTdQ_large_1 = {}".format(dTdQ_large_1))
+  logging.debug("dTdQ_small_0 = {}".format(dTdQ_small_0))
+  logging.debug("dTdQ_small_1 = {}".format(dTdQ_small_1))
+  logging.debug("dTdQ_nextEar = {}".format(dTdQ_nextEar))
+
+  #correcting the surface temperatures of the segments around the EoS region
+  staveTop.setTemperatureCorrection("large",0, earHeat*dTdQ_large_0)
+  staveTop.setTemperatureCorrection("large",1, earHeat*dTdQ_large_1)
+  staveTop.setTemperatureCorrection("small",0, earHeat*dTdQ_small_0)
+  staveTop.setTemperatureCorrection("small",1, earHeat*dTdQ_small_1)
+  if options.orientation is None:
+    staveBottom.setTemperatureCorrection("large",0, earHeat*dTdQ_large_0)
+    staveBottom.setTemperatureCorrection("large",1, earHeat*dTdQ_large_1)
+    staveBottom.setTemperatureCorrection("small",0, earHeat*dTdQ_small_0)
+    staveBottom.setTemperatureCorrection("small",1, earHeat*dTdQ_small_1)
+
+  logging.debug("Temperature corrections for staveTop small regions: {}".format(str(staveTop.getTemperatureCorrections("small"))))
+  logging.debug("Temperature corrections for staveTop large regions: {}".format(str(staveTop.getTemperatureCorrections("large"))))
+  if options.orientation is None:
+    logging.debug("Temperature corrections for staveBottom small regions: {}".format(str(staveBottom.getTemperatureCorrections("small"))))
+    logging.debug("Temperature corrections for staveBottom large regions: {}".format(str(staveBottom.getTemperatureCorrections("large"))))
+
+  #the debug image (result.imgEdges) is made on demand
+  result = ImpedanceResult(staveTop, staveBottom, config=config)
+
+  #computing the impedance for the ear
+  result.earImpedanceTop = float(ear_impedance(earTempTop, earHeat, heatNextEar, liqTempAfterSeg0, dTdQ_nextEar))
+  print("Z_earTop = {}".format(result.earImpedanceTop))
+
+  if options.orientation is None:
+    result.earImpedanceBottom = float(ear_impedance(earTempBottom, earHeat, heatNextEar, liqTempAfterSeg0, dTdQ_nextEar))
+    print("Z_earBottom = {}".format(result.earImpedanceBottom))
+
+  #WIP: print the impedance on the plot as well
+
+  #extracting the impedances
+  result.largeTop = staveTop.getImpedances("large", heatCorrection=True)
+  result.smallTop = staveTop.getImpedances("small")
+
+  if options.orientation is None:
+    result.largeBottom = staveBottom.getImpedances("large", heatCorrection=True)
+    result.smallBottom = staveBottom.getImpedances("small")
+
+  #compute the combined impedance
+  result.impedanceCombinedTop = combined_impedance(result.smallTop)[0]
+
+  if options.orientation is None:
+    result.impedanceCombinedBottom = combined_impedance(result.smallBottom)[0]
+  lap("getImpedances")
+
+  return result
+
+def output_filename(inputFile, outpath):
+  return os.path.join(outpath, inputFile.split("/")[-1][:-4] + "_IMPEDANCES")
+
+def save_csv(result, outputFilename):
+  #savign data into the CSV file
+  print("Outputing data into a file: " + outputFilename + ".csv")
+  largeTop, smallTop, impedanceCombinedTop = result.largeTop, result.smallTop, result.impedanceCombinedTop
+  largeBottom, smallBottom, impedanceCombinedBottom = result.largeBottom, result.smallBottom, result.impedanceCombinedBottom
+  with atomic_output(outputFilename+ ".csv") as f:
+    if not result.twoFace:
+      f.write('#, topLargeRegion, topSmallRegion, smallRegionCombinedTop \n')
+    else:
+      f.write("#, topLargeRegion, bottomLargeRegion, topSmallRegion, bottomSmallRegion, smallRegionCombinedTop, smallRegionCombinedBottom \n")
+    for i in range(0,28):
+      if i<14:
+        if not result.twoFace:
+          f.write(str(i)+", "+str(largeTop[i])+", "+str(smallTop[i])+", "+str(impedanceCombinedTop[i]) + "\n")
+        else:
+          f.write(str(i)+", "+str(largeTop[i])+", "+str(largeBottom[i])+", "+str(smallTop[i])+", "+str(smallBottom[i]) + ", "+str(impedanceCombinedTop[i]) + ", "+str(impedanceCombinedBottom[i]) + "\n")
       else:
-        f.write(str(i)+", "+str(largeTop[i])+", "+str(largeBottom[i])+", "+str(smallTop[i])+", "+str(smallBottom[i]) + "\n")
-  f.write("\n")
-  f.write("Z_earTop, {} \n".format(earImpedanceTop))
-  if args.orientation is None:
-    f.write("Z_earBottom, {}".format(earImpedanceBottom))
-  f.close()
-
-to_save = {'largeTop':largeTop, 'smallTop':smallTop, 'impedanceCombinedTop':impedanceCombinedTop, 'earImpedanceTop':earImpedanceTop}
-if args.orientation is None:
-  to_save.update({'largeBottom':largeBottom, 'smallBottom':smallBottom, 'impedanceCombinedBottom':impedanceCombinedBottom, 'earImpedanceBottom':earImpedanceBottom})
-np.savez(outputFilename+".npz", **to_save)
-
-#plotting if -g option selected
-if args.graphs:
-  plt.figure(figsize=(12,6))
-  plt.plot(largeTop, label="Large Region: top")
-  plt.plot(smallTop, label="Small Region: top")
-  plt.plot(impedanceCombinedTop, label="Small Region: top combined")
-
-  if args.orientation is None:
-    plt.plot(largeBottom, label="Large Region: bottom")
-    plt.plot(smallBottom, label="Small Region: bottom")
-    plt.plot(impedanceCombinedBottom, label="Small Region: bottom combined")
-    
-  plt.plot([-1],[earImpedanceTop],marker='o', linestyle='', label="Z_earTop")
-  if args.orientation is None:
-    plt.plot([-1],[earImpedanceBottom],marker='o', linestyle='', label="Z_earBottom")
-  
-  plt.xlabel("Region number")
-  plt.ylabel("Thermal Impedance [K/W]")
-  plt.title(outputFilename.split("/")[-1])
-  if args.orientation is not None:
-    yrange = int(1+1.1*np.max([np.max(largeTop),np.max(smallTop),earImpedanceTop]))
+        if not result.twoFace:
+          f.write(str(i)+", "+str(largeTop[i])+", "+str(smallTop[i])+"\n")
+        else:
+          f.write(str(i)+", "+str(largeTop[i])+", "+str(largeBottom[i])+", "+str(smallTop[i])+", "+str(smallBottom[i]) + "\n")
+    f.write("\n")
+    f.write("Z_earTop, {} \n".format(result.earImpedanceTop))
+    if result.twoFace:
+      f.write("Z_earBottom, {}".format(result.earImpedanceBottom))
+
+def save_outputs(result, outputFilename):
+  save_csv(result, outputFilename)
+  with atomic_output(outputFilename+".npz", "wb") as f:
+    np.savez(f, **result.toDict())
+
+def _render(kind, data, path, plots):
+  #inline, unless the plots go to a queue (see plots.PlotQueue)
+  if plots is None:
+    from plots import render
+    render(kind, data, path)
   else:
-    yrange = int(1+1.1*np.max([np.max(largeTop),np.max(largeBottom),np.max(smallTop),np.max(smallBottom),earImpedanceTop,earImpedanceBottom]))
-  plt.xticks(np.arange(0, 28, 1.0))
-  plt.yticks(np.arange(0, yrange, 0.5))
-  plt.axis([-2.0,27.5,0,yrange])
-  plt.grid()
-  plt.legend(ncol=3)
+    plots.submit(kind, data, path)
+
+def plot_impedances(result, outputFilename, plots=None):
+  faces = ['top', 'bottom'] if result.twoFace else ['top']
+  staves = {'top': 'Top', 'bottom': 'Bottom'}
+  data = {'twoFace': result.twoFace, 'title': outputFilename.split("/")[-1],
+          'large': {face: np.array(getattr(result, 'large' + staves[face])) for face in faces},
+          'small': {face: np.array(getattr(result, 'small' + staves[face])) for face in faces},
+          'combined': {face: np.array(getattr(result, 'impedanceCombined' + staves[face])) for face in faces},
+          'ear': {face: float(getattr(result, 'earImpedance' + staves[face])) for face in faces}}
   #ear impedances printed on the plot
   """
   ZearStr = "Z_earTop = {}".format(earImpedanceTop)
@@ -443,40 +500,149 @@ if args.graphs:
   #code version printed on the plot
   #change back here
 #  plt.text(0, -0.13*yrange, "Code version: {} {}".format(gitHash, gitDate[:-6]), fontsize=10)
-  plt.savefig(outputFilename)
-  print("Outputing graphical output into a file: " + outputFilename)
-
-
-if args.debug:
-  r1 = np.array([[staveTop.xLeft+60, staveTop.xLeft+165], [staveTop.yBottom-10, staveTop.yBottom-50]])
-  dx = 412.5
-  plt.figure(dpi=250)
-  #plt.plot([r1[0][0], r1[0][0], r1[0][1], r1[0][1], r1[0][0]], [r1[1][0], r1[1][1], r1[1][1], r1[1][0], r1[1][0]], color = 'red', lw=.25)
-  for i in range(14):
-    plt.plot(dx*i + np.array(([r1[0][0], r1[0][0], r1[0][1], r1[0][1], r1[0][0]])), [r1[1][0], r1[1][1], r1[1][1], r1[1][0], r1[1][0]], color = 'red', lw=.25)
-  plt.axvline(staveTop.xLeft, color='red', lw=.25)
-  plt.axvline(staveTop.xRight, color='red', lw=.25)
-  plt.axhline(staveTop.yTop, color='red', lw=.25)
-  plt.axhline(staveTop.yBottom, color='red', lw=.25)
-
+  _render('impedances', data, outputFilename + ".png", plots)
+
+def debug_filename(inputFile, outpath):
+  #every input has a debug directory of its own, so that analyses running at the same time don't overwrite each other
+  return os.path.join(outpath, "debug_output", os.path.basename(inputFile)[:-4], "edges.png")
+
+def plot_debug(result, debugFile, plots=None, maxWidth=DEBUG_IMAGE_WIDTH):
+  #the debug image is drawn from a thumbnail at most maxWidth pixels wide; the stave edges and regions (defined on
+  #the scaled image) are mapped onto it
+  staveTop = result.staveTop
+  image, factor = staveTop.getThumbnail(maxWidth)
+  toThumbnail = lambda *coordinates: [(x + 0.5)*factor - 0.5 for x in coordinates]
+  staves = [staveTop] if not result.twoFace else [staveTop, result.staveBottom]
+  (left, bottom), (right, top) = BOND_PAD_BBOX
+  pads = [[toThumbnail(BOND_PAD_PITCH*i + staveTop.xLeft + x, staveTop.yBottom - y) for x, y in ((left, bottom), (left, top), (right, top), (right, bottom), (left, bottom))]
+          for i in range(14)]
+
+  regions, ears, labels = [], [], []
   for iregion, region in enumerate(staveTop.GetRegions('large')):
     xl, xr, yt, yb = region.getPosition()
-    plt.plot([xl,xl],[yb,yt], color='magenta', lw=.25, alpha=0.7)
-    plt.plot([xr,xr],[yb,yt], color='magenta', lw=.25, alpha=0.7)
-    plt.plot([xl,xr],[yb,yb], color='magenta', lw=.25, alpha=0.7)
-    plt.plot([xl,xr],[yt,yt], color='magenta', lw=.25, alpha=0.7)
-    plt.text(xl+5, yt+50, f"{iregion}", color="white", fontsize=3)
-    plt.text(xl+5, yt+100, f"t = {region.getAverageTemperature():.1f}", color='white', fontsize=3)
+    regions.append(toThumbnail(xl, xr, yt, yb))
+    labels.append(toThumbnail(xl+5, yt+50) + [str(iregion)])
+    labels.append(toThumbnail(xl+5, yt+100) + ["t = {:.1f}".format(region.getAverageTemperature())])
   for region in staveTop.GetRegions('ear'):
     xl, xr, yt, yb = region.getPosition()
-    plt.plot([xl,xl],[yb,yt], color='goldenrod', lw=.25, alpha=0.7)
-    plt.plot([xr,xr],[yb,yt], color='goldenrod', lw=.25, alpha=0.7)
-    plt.plot([xl,xr],[yb,yb], color='goldenrod', lw=.25, alpha=0.7)
-    plt.plot([xl,xr],[yt,yt], color='goldenrod', lw=.25, alpha=0.7)
-    plt.text(xl+5, yt+100, f"t = {region.getAverageTemperature():.1f}", color='white', fontsize=3)
+    ears.append(toThumbnail(xl, xr, yt, yb))
+    labels.append(toThumbnail(xl+5, yt+100) + ["t = {:.1f}".format(region.getAverageTemperature())])
+  if result.twoFace:
+    #the regions of the bottom face, without labels
+    for regionType in ("small", "large", "ear"):
+      regions += [toThumbnail(*region.getPosition()) for region in result.staveBottom.GetRegions(regionType)]
 
   temps = [region.getAverageTemperature() for region in staveTop.GetRegions('large')]
   mean = np.mean(temps)
   std = np.std(temps)
-  plt.imshow(img_edges, vmin=(mean-2*std), vmax=(mean+10*std))
-  plt.savefig("debug_output/edges.png")
+  data = {'image': image, 'clim': (mean-2*std, mean+10*std), 'staves': [toThumbnail(*stave.boundaries) for stave in staves],
+          'pads': pads, 'regions': regions, 'ears': ears, 'labels': labels}
+  os.makedirs(os.path.dirname(debugFile) or ".", exist_ok=True)
+  _render('debug', data, debugFile, plots)
+
+def analyze_file(options, debugFile=None, plots=None, images=None):
+  '''
+  Analyses the file options.path with the config file options.config and writes the outputs into options.outpath,
+  like the command line does. The plots are rendered after the numbers are written, at once or, with a
+  plots.PlotQueue, whenever the queue renders them. The debug image goes to debugFile, by default edges.png in
+  the input's own directory below outpath/debug_output (see debug_filename). images is the
+  temperature_cache.MemoryCache of a long-running process, looked at before loading the file.
+  '''
+  inputFile = options.path
+  if inputFile[-3:] == 'npz':
+    assert not options.adc
+
+  mapParameters = dict(emissivity=options.emissivity, adc=options.adc, orientation=options.orientation, frameAverage=options.frame_average)
+  cache = None
+  if options.cache:
+    cache = TemperatureCache(options.cache_dir, options.cache_size*1024**2)
+
+  entry = None
+  if images is not None:
+    imagesKey = images.key(inputFile, **mapParameters)
+    entry = images.get(imagesKey)
+  if entry is None and cache is not None:
+    key = cache.key(inputFile, **mapParameters)
+    entry = cache.get(key)
+    if entry is not None and images is not None:
+      images.put(imagesKey, *entry)
+  if entry is not None:
+    image, processVariables = entry
+    print("Loaded the temperature map from the cache")
+  else:
+    image, processVariables = load_image(inputFile, emissivity=options.emissivity, frameAverage=options.frame_average, lut=options.lut, csvCache=options.csv_cache)
+    image = prepare_image(image, options)
+    if cache is not None:
+      cache.put(key, image, processVariables)
+    if images is not None:
+      images.put(imagesKey, image, processVariables)
+  config = load_config(options.config, processVariables)
+
+  geometry = None
+  if options.trial_geometry or options.invalidate_geometry:
+    geometry = TrialGeometry.of_file(inputFile)
+    if options.invalidate_geometry:
+      geometry.invalidate(setup_key(image.shape, options.orientation, IMAGE_SCALE))
+
+  result = analyze_image(image, config, options, prepared=True, geometry=geometry, source=inputFile)
+
+  outputFilename = output_filename(inputFile, options.outpath)
+  save_outputs(result, outputFilename)
+
+  if options.results_db:
+    from results import ResultsDB, result_record
+    with ResultsDB(options.results_db) as db:
+      db.add(result_record(result, options, inputFile))
+
+  #plotting if -g option selected
+  if options.graphs:
+    plot_impedances(result, outputFilename, plots)
+
+  if options.debug:
+    plot_debug(result, debugFile or debug_filename(inputFile, options.outpath), plots)
+
+  return result
+
+def main(argv=None):
+  args = make_parser().parse_args(argv)
+
+  inputFile = args.path
+  configFile = args.config
+
+  #check if the suffix is .csv
+  #if inputFile[-3:] != "csv":
+    #print("The input file should be a .csv file")
+    #quit()
+
+  #the debug image goes to a directory of its own per input, below the output folder (see debug_filename)
+
+  #create the output folder if it doesn't exist
+  #if not "output" in os.listdir("."):
+    #os.system("mkdir output")
+  #os.makedirs(args.outpath, exist_ok=True)
+
+
+  #set up the debugging log
+  #if args.debug:
+   # logging.basicConfig(filename='debug_output/debug.log',level=logging.DEBUG)
+
+  #if args.L_flip and args.J_flip:
+   # print("Cannot have both L and J flip options activated at the same time. Exiting...")
+    #exit()
+
+  #get the git version of the code so it can be printed on the output graphs
+  #gitHash = os.popen('git rev-parse --short HEAD').read()[:-2]
+  #gitDate = os.popen('git log -1 --format=%cd').read()
+
+  #logging.debug("Running the code version: " + gitHash + " " + gitDate)
+
+  if inputFile[-3:] not in ['csv', 'npy', 'npz']:
+    print('Need to load a csv or npy file')
+    return 1
+
+  analyze_file(args)
+
+  return 0
+
+if __name__ == "__main__":
+  raise SystemExit(main())
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+'''
+layout.py
+
+About: The region layouts of the staves, as data, and their compilation for given stave boundaries.
+
+  A layout lists the region sets of the top face of a stave; the bottom face is its mirror image (y -> 1-y, with
+  the U-bends turning the other way). A region set is either one region per module, in the order the pipe passes
+  the modules ('there': from the end-of-stave (EoS) end, 'return': back to it), or a single region. Coordinates are
+  relative to the stave: x in units of its length, y in units of its width. A region set has
+    - 'type':     the region type the impedances are computed for ('large', 'small', 'ear', ...),
+    - 'y':        (top, bottom) of the regions,
+    - 'modules':  'there' or 'return' for one region per module, whose x range is the module,
+      or 'x':     (left, right) of a single region,
+    - 'trim_modules': (left, right) in units of the module length, taken off the x range (optional),
+    - 'trim_y':   (top, bottom) in units of the stave width, taken off the y range (optional),
+    - 'exceptions': {module index: changes} for single modules, with the changes being a 'trim_modules' or a
+                  'ubend' (see Stave.AddUBendRegion): 'trim_x' (left, right) in units of the stave length,
+                  'radius', 'length' and the 'bend' on the top face.
+
+  compile_layout() turns a layout into pixel coordinates for the boundaries of a stave, and caches the result,
+  so that files of one geometry (e.g. all images of a trial) lay out their regions once.
+'''
+
+import functools
+import numpy as np
+
+from stave import globalCoordinates, uBendGeometry, uBendMask
+
+NUM_MODULES = 14
+
+# the small regions lie on the bands above the pipe, on the way from the EoS end and on the way back to it
+PIPE_THERE = (0.247826, 0.317391)
+PIPE_RETURN = (0.682609, 0.752174)
+
+# the U-bend at the far end: the first rectangle stops short of the module end, the arc and the second
+# rectangle follow the pipe
+U_BEND = {'trim_x': (0.0, 0.0174545), 'radius': 0.13, 'length': 0.0869565}
+
+# the EoS ear: 154 mm of the 1375 mm long stave, 49 mm beyond its 115 mm width. the region stays safely
+# away from the edges: 0.1 of a module length from both sides in x, 5% of the stave width in y
+EAR_LENGTH = 154.0/1375
+EAR_HEIGHT = 49.0/115
+
+LONG_STRIP = [
+    {'type': 'large', 'modules': 'there', 'y': (0.0, 0.5)},
+    {'type': 'large', 'modules': 'return', 'y': (0.5, 1.0)},
+    {'type': 'small', 'modules': 'there', 'y': PIPE_THERE,
+     'exceptions': {0: {'trim_modules': (0.1, 0.0)}, NUM_MODULES-1: {'ubend': dict(U_BEND, bend='downwards')}}},
+    {'type': 'small', 'modules': 'return', 'y': PIPE_RETURN,
+     'exceptions': {0: {'trim_modules': (0.1, 0.0)}, NUM_MODULES-1: {'ubend': dict(U_BEND, bend='upwards')}}},
+    {'type': 'ear', 'x': (0.0, EAR_LENGTH), 'y': (-EAR_HEIGHT, 0.0), 'trim_modules': (0.1, 0.1), 'trim_y': (0.05, 0.0)},
+]
+
+LAYOUTS = {'long-strip': LONG_STRIP}
+
+def _mirrored(regionSet):
+    # the region set on the bottom face
+    mirrored = dict(regionSet)
+    top, bottom = regionSet['y']
+    mirrored['y'] = (1.0-bottom, 1.0-top)
+    if 'trim_y' in regionSet:
+        mirrored['trim_y'] = regionSet['trim_y'][::-1]
+    exceptions = {}
+    for module, changes in regionSet.get('exceptions', {}).items():
+        changes = dict(changes)
+        if 'ubend' in changes:
+            changes['ubend'] = dict(changes['ubend'], bend='upwards' if changes['ubend']['bend'] == 'downwards' else 'downwards')
+        exceptions[module] = changes
+    mirrored['exceptions'] = exceptions
+    return mirrored
+
+def _relative_regions(layout, face):
+    # the regions of the layout in relative coordinates: (type, [xLeft, xRight, yTop, yBottom], U-bend or None)
+    regions = []
+    for regionSet in layout:
+        if face == 'bottom':
+            regionSet = _mirrored(regionSet)
+        top, bottom = regionSet['y']
+        trimTop, trimBottom = regionSet.get('trim_y', (0.0, 0.0))
+        yTop, yBottom = top + trimTop, bottom - trimBottom
+        if 'modules' in regionSet:
+            modules = range(NUM_MODULES) if regionSet['modules'] == 'there' else reversed(range(NUM_MODULES))
+            spans = [(i, i*1.0/NUM_MODULES, (i+1)*1.0/NUM_MODULES) for i in modules]
+        else:
+            spans = [(None,) + tuple(regionSet['x'])]
+        for module, left, right in spans:
+            changes = regionSet.get('exceptions', {}).get(module, {})
+            trimLeft, trimRight = changes.get('trim_modules', regionSet.get('trim_modules', (0.0, 0.0)))
+            xLeft, xRight = left + trimLeft/NUM_MODULES, right - trimRight/NUM_MODULES
+            ubend = changes.get('ubend')
+            if ubend is not None:
+                xLeft, xRight = left + ubend['trim_x'][0], right - ubend['trim_x'][1]
+            if not(xLeft < xRight and yTop < yBottom):
+                raise Exception("The coordiates of a '{}' region of the layout are invalid.".format(regionSet['type']))
+            regions.append((regionSet['type'], [xLeft, xRight, yTop, yBottom], ubend))
+    return regions
+
+class CompiledLayout:
+    '''
+    The regions of a layout for one stave: `regions` is a list of (type, kind, geometry) in the order they are
+    added to the stave, with kind 'rectangle' and the pixel coordinates (xLeft, xRight, yTop, yBottom) or kind
+    'ubend' and the arguments of stave.uBendMask.
+    '''
+    def __init__(self, name, regions):
+        self.name = name
+        self.regions = regions
+        self.__weights = {}
+
+    def __len__(self):
+        return len(self.regions)
+
+    def weights(self, plan, pads=None):
+        # the weights of the regions in a projection plan (see projection.py), made once per image shape and
+        # bond pads (stave.BondPads) excluded from the regions
+        key = (plan.shape, plan.scaledShape, pads)
+        if key not in self.__weights:
+            height, width = plan.scaledShape
+            weights = []
+            for type, kind, geometry in self.regions:
+                if kind == 'rectangle':
+                    xLeft, xRight, yTop, yBottom = geometry
+                    rows, cols, mask = range(height)[int(yTop):int(yBottom)], range(width)[int(xLeft):int(xRight)], None
+                else:
+                    rows, cols, mask = uBendMask(plan.scaledShape, *geometry)
+                if pads is not None:
+                    weights.append(pads.weights(plan, rows, cols, mask))
+                elif mask is None:
+                    weights.append(plan.rectangle(rows, cols))
+                else:
+                    weights.append(plan.mask(rows, cols, mask))
+            self.__weights[key] = weights
+        return self.__weights[key]
+
+@functools.lru_cache(maxsize=32)
+def compile_layout(name, boundaries, nTrim, face='top'):
+    '''
+    The layout `name` (see LAYOUTS) on the `face` ('top' or 'bottom') of a stave with the boundaries
+    (xLeft, xRight, yTop, yBottom) in pixels; nTrim pixels are kept away from the stave edges.
+    '''
+    if face not in ('top', 'bottom'):
+        raise Exception("Invalid face: " + str(face))
+    boundaries = tuple(int(x) for x in boundaries)
+    relative = _relative_regions(LAYOUTS[name], face)
+
+    # all rectangles at once
+    isRectangle = [ubend is None for type, coordinates, ubend in relative]
+    xLeft, xRight, yTop, yBottom = np.array([coordinates for type, coordinates, ubend in relative]).T
+    rectangles = np.stack(globalCoordinates(boundaries, float(nTrim), xLeft, xRight, yTop, yBottom), axis=1)
+
+    regions = []
+    for (type, coordinates, ubend), rectangle, rectangular in zip(relative, rectangles, isRectangle):
+        if rectangular:
+            regions.append((type, 'rectangle', tuple(rectangle)))
+        else:
+            geometry = uBendGeometry(boundaries, *coordinates, ubend['radius'], ubend['length'], ubend['bend'])
+            regions.append((type, 'ubend', geometry))
+    return CompiledLayout(name, regions)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+'''
+plots.py
+
+About: Renders the graphs of the analysis (-g) and the debug image (-d) to PNG files, away from the numerical work.
+
+  The figures are drawn with matplotlib's Agg canvas, without pyplot and its global state, from templates that
+  are built once per process and thread (the server runs all its jobs on one thread) and only get new data for
+  every file: the lines, the image and the region outlines (one line collection per colour) are updated in place
+  instead of being drawn again. A plot is described by a small dict of plain values (see
+  impedanceFromCSV.plot_impedances/plot_debug), so it can be rendered later or in another process. A PlotQueue
+  decides when: at once ('inline'), when it is flushed ('deferred', e.g. after the numbers of a file are written),
+  or in a pool of processes in the background ('pool').
+'''
+
+import os
+import threading
+import concurrent.futures
+import numpy as np
+import cv2
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+
+from atomicfile import atomic_output
+
+PLOT_KINDS = ('impedances', 'debug')
+
+def _rectangles(positions):
+    # the outlines of rectangles (xLeft, xRight, yTop, yBottom) as closed polylines, for a LineCollection
+    return [[(xl, yt), (xl, yb), (xr, yb), (xr, yt), (xl, yt)] for xl, xr, yt, yb in positions]
+
+class ImpedancePlot:
+    '''
+    The impedances of the regions along the stave, of one face or two.
+    '''
+    FACES = ('top', 'bottom')
+
+    def __init__(self, twoFace):
+        self.figure = Figure(figsize=(12, 6))
+        FigureCanvasAgg(self.figure)
+        ax = self.axes = self.figure.add_subplot()
+        faces = self.FACES if twoFace else self.FACES[:1]
+        self.lines = {}
+        for face in faces:
+            self.lines['large', face], = ax.plot([], [], label="Large Region: " + face)
+            self.lines['small', face], = ax.plot([], [], label="Small Region: " + face)
+            self.lines['combined', face], = ax.plot([], [], label="Small Region: {} combined".format(face))
+        for face in faces:
+            self.lines['ear', face], = ax.plot([], [], marker='o', linestyle='', label="Z_ear" + face.capitalize())
+        ax.set_xlabel("Region number")
+        ax.set_ylabel("Thermal Impedance [K/W]")
+        ax.set_xticks(np.arange(0, 28, 1.0))
+        ax.grid()
+        ax.legend(ncol=3)
+        self.title = ax.set_title("")
+
+    def update(self, data):
+        top = 0.
+        for (kind, face), line in self.lines.items():
+            if kind == 'ear':
+                values = np.array([data['ear'][face]])
+                line.set_data([-1], values)
+            else:
+                values = np.asarray(data[kind][face])
+                line.set_data(np.arange(len(values)), values)
+            if kind != 'combined':
+                top = max(top, np.max(values))
+        yrange = int(1 + 1.1*top)
+        self.axes.set_yticks(np.arange(0, yrange, 0.5))
+        self.axes.axis([-2.0, 27.5, 0, yrange])
+        self.title.set_text(data['title'])
+
+class DebugPlot:
+    '''
+    A thumbnail of the image with the stave edges, the bond pads, the regions and their temperatures drawn over it,
+    all in the coordinates of the thumbnail.
+    '''
+    def __init__(self):
+        self.figure = Figure(dpi=250)
+        FigureCanvasAgg(self.figure)
+        ax = self.axes = self.figure.add_subplot()
+        self.pads = ax.add_collection(LineCollection([], colors='red', linewidths=.25))
+        self.edges = ax.add_collection(LineCollection([], colors='red', linewidths=.25))
+        self.regions = ax.add_collection(LineCollection([], colors='magenta', linewidths=.25, alpha=0.7))
+        self.ears = ax.add_collection(LineCollection([], colors='goldenrod', linewidths=.25, alpha=0.7))
+        self.texts = []
+        self.image = ax.imshow(np.zeros((2, 2)))
+
+    def _text(self, i):
+        # the labels are kept and reused, one per position
+        while len(self.texts) <= i:
+            self.texts.append(self.axes.text(0, 0, "", color='white', fontsize=3))
+        return self.texts[i]
+
+    def update(self, data):
+        image = data['image']
+        height, width = image.shape[:2]
+        # the stave edges span the whole image, like axvline/axhline
+        edges = []
+        for xLeft, xRight, yTop, yBottom in data['staves']:
+            edges += [[(x, -0.5), (x, height-0.5)] for x in (xLeft, xRight)]
+            edges += [[(-0.5, y), (width-0.5, y)] for y in (yTop, yBottom)]
+        self.edges.set_segments(edges)
+        self.pads.set_segments(data['pads'])
+        self.regions.set_segments(_rectangles(data['regions']))
+        self.ears.set_segments(_rectangles(data['ears']))
+
+        for i, (x, y, text) in enumerate(data['labels']):
+            label = self._text(i)
+            label.set_position((x, y))
+            label.set_text(text)
+            label.set_visible(True)
+        for label in self.texts[len(data['labels']):]:
+            label.set_visible(False)
+
+        self.image.set_data(image)
+        self.image.set_extent((-0.5, width-0.5, height-0.5, -0.5))
+        self.image.set_clim(*data['clim'])
+        self.axes.set_xlim(-0.5, width-0.5)
+        self.axes.set_ylim(height-0.5, -0.5)
+
+# the templates of this thread, by kind and layout
+_templates = threading.local()
+
+def template(kind, data):
+    templates = _templates.__dict__.setdefault('figures', {})
+    key = (kind, data.get('twoFace'))
+    if key not in templates:
+        templates[key] = ImpedancePlot(data['twoFace']) if kind == 'impedances' else DebugPlot()
+    return templates[key]
+
+def render(kind, data, path):
+    '''
+    Renders a plot of `kind` ('impedances' or 'debug') described by `data` into the PNG file `path`.
+    '''
+    if kind not in PLOT_KINDS:
+        raise Exception("Invalid plot kind: " + str(kind))
+    plot = template(kind, data)
+    plot.update(data)
+    with atomic_output(path, "wb") as f:
+        plot.figure.savefig(f, format="png")
+    if kind == 'impedances':
+        print("Outputing graphical output into a file: " + path[:-4])
+    return path
+
+def contact_sheet(images, path, columns=4, tileWidth=480):
+    '''
+    Tiles the PNG files `images` (e.g. the debug images of a batch), each shrunk to tileWidth pixels and labelled
+    with the name of its directory, into one PNG file `path`.
+    '''
+    tiles = []
+    for image in images:
+        tile = cv2.imread(image, cv2.IMREAD_COLOR)
+        if tile is None:
+            continue
+        height = max(1, int(round(tile.shape[0]*tileWidth/tile.shape[1])))
+        tile = cv2.resize(tile, (tileWidth, height), interpolation=cv2.INTER_AREA)
+        cv2.putText(tile, os.path.basename(os.path.dirname(image)), (8, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1, cv2.LINE_AA)
+        tiles.append(tile)
+    if not tiles:
+        return None
+    tileHeight = max(tile.shape[0] for tile in tiles)
+    rows = -(-len(tiles) // columns)
+    sheet = np.full((rows*tileHeight, min(columns, len(tiles))*tileWidth, 3), 255, dtype=np.uint8)
+    for i, tile in enumerate(tiles):
+        row, column = divmod(i, columns)
+        sheet[row*tileHeight:row*tileHeight+tile.shape[0], column*tileWidth:(column+1)*tileWidth] = tile
+    ok, encoded = cv2.imencode(".png", sheet)
+    with atomic_output(path, "wb") as f:
+        f.write(encoded.tobytes())
+    return path
+
+class PlotQueue:
+    '''
+    Renders the plots submitted to it: 'inline' at once, 'deferred' when flush() is called, 'pool' in the background
+    on `workers` processes. flush() renders (or waits for) the outstanding plots and returns their paths; an error
+    in one of them is raised there.
+    '''
+    MODES = ('inline', 'deferred', 'pool')
+
+    def __init__(self, mode='inline', workers=None):
+        if mode not in self.MODES:
+            raise Exception("Invalid plot mode: " + str(mode))
+        self.mode = mode
+        self.workers = workers
+        self.pool = None
+        self.pending = []
+
+    def submit(self, kind, data, path):
+        if self.mode == 'inline':
+            render(kind, data, path)
+        elif self.mode == 'deferred':
+            self.pending.append((kind, data, path))
+        else:
+            if self.pool is None:
+                self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            self.pending.append(self.pool.submit(render, kind, data, path))
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        if self.mode != 'pool':
+            return [render(*job) for job in pending]
+        # wait for all of them before raising the first error
+        concurrent.futures.wait(pending)
+        return [future.result() for future in pending]
+
+    def discard(self):
+        # forgets the outstanding plots, e.g. those of a file whose analysis failed
+        for job in self.pending:
+            if self.mode == 'pool':
+                job.cancel()
+        self.pending = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -7,60 +7,237 @@ import os
 import sys
 import configparser
 import itertools as it
-import tempfile
-import shutil
-import subprocess
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 DEFAULT_TRANSMISSIVITY = 0.987
-DEFAULT_TEMPERATURE_PROFILE='0.0000,0.0686,0.1233,0.1603,0.1969,0.2329,0.2685,0.3037,0.3385,0.3729,0.4068,0.4404,0.4736,0.5064,0.5395,0.5744,0.6088,0.6430,0.6770,0.7107,0.7441,0.7772,0.8099,0.8422,0.8742,0.905 -d8,0.9368,0.9681,1.0000'
+DEFAULT_TEMPERATURE_PROFILE='0.0000,0.0686,0.1233,0.1603,0.1969,0.2329,0.2685,0.3037,0.3385,0.3729,0.4068,0.4404,0.4736,0.5064,0.5395,0.5744,0.6088,0.6430,0.6770,0.7107,0.7441,0.7772,0.8099,0.8422,0.8742,0.9058,0.9368,0.9681,1.0000'
 
 DEFAULT_PARAMETERS = { "B":1452, "F":1.0, "O":-5208, "R2":0.016026809, "R1":17980.574, "AtomTemp":20.0, "ReflTemp":20.0, "Emissivity":.95, "Transmissivity": .987
 
 }
 
+CALIBRATION_KEYS = ("B", "F", "O", "R1", "R2", "AtomTemp", "ReflTemp", "Emissivity", "Transmissivity")
+
+def calibration_key(params, emissivity=None):
+    # the calibration parameters of a frame as a tuple in the order of CALIBRATION_KEYS
+    params = dict(params)
+    if emissivity is not None:
+        params['Emissivity'] = emissivity
+    params.setdefault('Transmissivity', DEFAULT_TRANSMISSIVITY)
+    return tuple(float(params[k]) for k in CALIBRATION_KEYS)
+
 #cold emissivity .905 -d
 #hot emissivity .918
 
-def adc_to_temp(adc_image, params):
+# number of pixels converted at once; 32k float64 values (256 kB) stay in the L2 cache
+CONVERSION_BLOCK_SIZE = 32768
+
+class AdcConverter:
+    # converts raw ADC counts to temperature for one set of calibration parameters.
+    # the constants (RawAtom, RawRefl and the emissivity/transmissivity terms) are
+    # computed once, and the conversion runs block by block in place in the output
+    # buffer, so no full-frame temporaries are created. every block goes through the
+    # same operations in the same order as the formula below, so the result is
+    # bit-identical to it (the stave edge search is sensitive to the last bit).
+
+    def __init__(self, params):
+        # CODE FROM ISU
+        # converting DC counts received by each pixel of the IR camera,
+        # which represents energy (heat), to temperature in degree C.
+        p = {k: float(v) for k, v in params.items() if k in DEFAULT_PARAMETERS}
+        p.setdefault('Transmissivity', DEFAULT_TRANSMISSIVITY)
+        RawAtom = p["R1"] / (p["R2"] * ( np.exp( p["B"] / (p["AtomTemp"] + 273.15) ) - p["F"] ) ) - p["O"]
+        RawRefl = p["R1"] / (p["R2"] * ( np.exp( p["B"] / (p["ReflTemp"] + 273.15) ) - p["F"] ) ) - p["O"]
+        # old one before swapping RawAtom and Raw Refl RawObj_numerator   = ( adc_image - params["Transmissivity"] * (1 - params["Emissivity"]) * RawAtom - (1 - params["Transmissivity"]) * RawRefl )
+        # RawObj_numerator   = ( adc_image - params["Transmissivity"] * (1 - params["Emissivity"]) * RawRefl - (1 - params["Transmissivity"]) * RawAtom )
+        # RawObj_denominator = ( params["Emissivity"] * params["Transmissivity"])
+        # RawObj = RawObj_numerator / RawObj_denominator
+        # temp_img = params["B"] / np.log ( params["R1"] / ( params["R2"] * ( RawObj + params["O"] ) ) + params["F"] ) - 273.15
+        self.reflTerm = p["Transmissivity"] * (1 - p["Emissivity"]) * RawRefl
+        self.atomTerm = (1 - p["Transmissivity"]) * RawAtom
+        self.denominator = p["Emissivity"] * p["Transmissivity"]
+        self.p = p
+
+    def _convert_block(self, adc, out):
+        p = self.p
+        np.subtract(adc, self.reflTerm, out=out)
+        out -= self.atomTerm
+        out /= self.denominator
+        out += p["O"]
+        out *= p["R2"]
+        np.divide(p["R1"], out, out=out)
+        out += p["F"]
+        np.log(out, out=out)
+        np.divide(p["B"], out, out=out)
+        out -= 273.15
+
+    def convert(self, adc, out=None, threads=None, block_size=CONVERSION_BLOCK_SIZE):
+        # converts an image or a whole (n_frames, H, W) stack. the result is written into `out`
+        # (a C-contiguous float64 array of the same shape) if given. the blocks are spread over
+        # `threads` threads (default: number of CPUs); numpy releases the GIL inside the ufuncs.
+        return convert_blockwise(self._convert_block, adc, out, threads, block_size)
+
+def convert_blockwise(convert_block, adc, out=None, threads=None, block_size=CONVERSION_BLOCK_SIZE):
+    # runs convert_block(adc_block, out_block) over the flattened arrays, with the blocks spread over threads
+    adc = np.asarray(adc)
+    if out is None:
+        out = np.empty(adc.shape, dtype=np.float64)
+    elif out.shape != adc.shape or out.dtype != np.float64 or not out.flags.c_contiguous:
+        raise ValueError("out must be a C-contiguous float64 array of shape {}".format(adc.shape))
+    flat_adc = adc.reshape(-1)
+    flat_out = out.reshape(-1)
+
+    starts = range(0, flat_out.size, block_size)
+    threads = min(threads or os.cpu_count() or 1, len(starts))
+
+    def convert_stripe(stripe):
+        for start in starts[stripe::threads]:
+            convert_block(flat_adc[start:start+block_size], flat_out[start:start+block_size])
+
+    if threads <= 1:
+        convert_stripe(0)
+    else:
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(convert_stripe, range(threads)))
+    return out
+
+def adc_to_temp(adc_image, params, lut=False):
     # CODE FROM ISU
     # converting DC counts received by each pixel of the IR camera,
     # which represents energy (heat), to temperature in degree C.
+    # with lut=True integer images are converted through a cached lookup table.
     params.setdefault('Transmissivity', DEFAULT_TRANSMISSIVITY)
-    RawAtom = params["R1"] / (params["R2"] * ( np.exp( params["B"] / (params["AtomTemp"] + 273.15) ) - params["F"] ) ) - params["O"]
-    RawRefl = params["R1"] / (params["R2"] * ( np.exp( params["B"] / (params["ReflTemp"] + 273.15) ) - params["F"] ) ) - params["O"]
-    # old one before swapping RawAtom and Raw Refl RawObj_numerator   = ( adc_image - params["Transmissivity"] * (1 - params["Emissivity"]) * RawAtom - (1 - params["Transmissivity"]) * RawRefl )
-    RawObj_numerator   = ( adc_image - params["Transmissivity"] * (1 - params["Emissivity"]) * RawRefl - (1 - params["Transmissivity"]) * RawAtom )
-    RawObj_denominator = ( params["Emissivity"] * params["Transmissivity"])
+    if lut:
+        return lookup_table(params).convert(adc_image)
+    return AdcConverter(params).convert(adc_image)
+
+def analytic_temp(adc_image, params):
+    # the textbook form of the conversion with full-size temporaries, used as the
+    # reference that the lookup tables are checked against
+    p = dict(params)
+    p.setdefault('Transmissivity', DEFAULT_TRANSMISSIVITY)
+    RawAtom = p["R1"] / (p["R2"] * ( np.exp( p["B"] / (p["AtomTemp"] + 273.15) ) - p["F"] ) ) - p["O"]
+    RawRefl = p["R1"] / (p["R2"] * ( np.exp( p["B"] / (p["ReflTemp"] + 273.15) ) - p["F"] ) ) - p["O"]
+    RawObj_numerator   = ( adc_image - p["Transmissivity"] * (1 - p["Emissivity"]) * RawRefl - (1 - p["Transmissivity"]) * RawAtom )
+    RawObj_denominator = ( p["Emissivity"] * p["Transmissivity"])
     RawObj = RawObj_numerator / RawObj_denominator
-    temp_img = params["B"] / np.log ( params["R1"] / ( params["R2"] * ( RawObj + params["O"] ) ) + params["F"] ) - 273.15
-
-    return temp_img
-
-def npz_images_to_temp(npz_images, emissivity=None):
-    # convert images as stored in npz file into a single (averaged)
-    # temperature map using the in-file metadata. override emissivity if provided.
-    result = []
-    for img, meta in npz_images:
-        if emissivity is not None:
-            meta['Emissivity'] = emissivity
-        meta.setdefault('Transmissivity', DEFAULT_TRANSMISSIVITY)
-        result.append(adc_to_temp(img, meta))
-    return np.mean(result, axis=0)
+    return p["B"] / np.log ( p["R1"] / ( p["R2"] * ( RawObj + p["O"] ) ) + p["F"] ) - 273.15
+
+# raw counts covered by the lookup tables (the camera delivers 16 bit counts)
+LOOKUP_TABLE_SIZE = 2**16
+# the gather converts its indices to intp per block, so it uses smaller blocks
+LOOKUP_BLOCK_SIZE = 4096
+
+class AdcLookupTable:
+    # count -> temperature table for one set of calibration parameters. integer
+    # frames within the table are converted with a single gather; anything else
+    # (e.g. float ADC images from CSV files) falls back to the analytic converter.
+    # max_deviation is the largest difference between the table and analytic_temp
+    # over all counts that give a finite temperature.
+
+    def __init__(self, params):
+        self.converter = AdcConverter(params)
+        counts = np.arange(LOOKUP_TABLE_SIZE, dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.table = self.converter.convert(counts, threads=1)
+            reference = analytic_temp(counts, self.converter.p)
+        valid = np.isfinite(reference)
+        self.max_deviation = float(np.max(np.abs(self.table[valid] - reference[valid]), initial=0.))
+        if np.any(np.isfinite(self.table) != valid):
+            self.max_deviation = np.inf
+        print("ADC lookup table built; max deviation from the analytic formula: {} K".format(self.max_deviation))
+
+    def _convert_block(self, adc, out):
+        np.take(self.table, adc, out=out)
+
+    def convert(self, adc, out=None, threads=None):
+        adc = np.asarray(adc)
+        if not np.issubdtype(adc.dtype, np.integer):
+            return self.converter.convert(adc, out=out, threads=threads)
+        if adc.dtype.itemsize > 2 or np.issubdtype(adc.dtype, np.signedinteger):
+            if adc.size and (adc.min() < 0 or adc.max() >= LOOKUP_TABLE_SIZE):
+                return self.converter.convert(adc, out=out, threads=threads)
+        return convert_blockwise(self._convert_block, adc, out, threads, LOOKUP_BLOCK_SIZE)
+
+@functools.lru_cache(maxsize=8)
+def _cached_lookup_table(key):
+    return AdcLookupTable(dict(zip(CALIBRATION_KEYS, key)))
+
+def lookup_table(params, emissivity=None):
+    # the lookup table for these calibration parameters; the most recently used tables are kept
+    return _cached_lookup_table(calibration_key(params, emissivity))
+
+def frames_to_temp(frames, emissivity=None, out=None):
+    # convert (image, metadata) pairs as stored in the npz/npy files into a
+    # (n_frames, H, W) temperature stack. consecutive frames with the same
+    # calibration are converted together. override emissivity if provided.
+    frames = list(frames)
+    if out is None:
+        out = np.empty((len(frames),) + np.shape(frames[0][0]), dtype=np.float64)
+    start = 0
+    for key, group in it.groupby(frames, key=lambda frame: calibration_key(frame[1], emissivity)):
+        images = [img for img, meta in group]
+        AdcConverter(dict(zip(CALIBRATION_KEYS, key))).convert(np.stack(images), out=out[start:start+len(images)])
+        start += len(images)
+    return out
+
+def npz_images_to_temp(npz_images, emissivity=None, reducer='mean', lut=False):
+    # convert images as stored in npz file (the path of the file, or its loaded 'image' array) into a single
+    # (averaged) temperature map using the in-file metadata. override emissivity if provided.
+    # the frames are converted and averaged one at a time (see frames.REDUCERS).
+    from frames import iter_frames, temperature_frames, reduce_frames
+    return reduce_frames(temperature_frames(iter_frames(npz_images), emissivity=emissivity, lut=lut), reducer)
         
 
-if __name__ == "__main__":
+def main(argv=None, images=None):
+    # images: the temperature_cache.MemoryCache of a long-running process (see server.py)
     parser = argparse.ArgumentParser()
     parser.add_argument('path', help='path the thermal controller results')
-    args = parser.parse_args()
+    parser.add_argument('--lut', action='store_true', help='convert the ADC counts through a lookup table')
+    parser.add_argument('--cache', action='store_true', help='keep the temperature maps in the on-disk cache shared with impedanceFromCSV.py')
+    parser.add_argument('--cache-dir', default=None, help='directory of the temperature map cache')
+    parser.add_argument('--time-series', action='store_true', help='find the stave once and write one impedance-vs-time table for the whole run')
+    parser.add_argument('--reference', default=None, help='image file to find the stave on with --time-series (default: the first one)')
+    parser.add_argument('--invalidate-geometry', action='store_true', help='find the stave edges again instead of taking them from the trial geometry saved in path (see geometry.py)')
+    parser.add_argument('--track', action='store_true', help='with --time-series: follow the stave from image to image (see tracking.py) instead of keeping the geometry of the reference image')
+    parser.add_argument('--results-db', default=None, help='also add the impedances to this results database (see results.py)')
+    parser.add_argument('--stave', default=None, help='the stave of the run in the results database (default: from path)')
+    parser.add_argument('--run', default=None, help='the name of the run in the results database (default: the last directory of path)')
+    parser.add_argument('--server', action='store_true', help='run in the analysis server (see server.py), if one is running')
+    args = parser.parse_args(argv)
+
+    if args.server:
+        from server import connect
+        try:
+            client = connect(fallback=False)
+        except Exception:
+            print("No analysis server is running, analysing here")
+        else:
+            with client:
+                response = client.processTc([arg for arg in (sys.argv[1:] if argv is None else argv) if arg != '--server'])
+            sys.stdout.write(response['output'])
+            if not response['ok']:
+                print(response['error'])
+                return 1
+            return 0
+
+    import impedanceFromCSV
+    from frames import iter_frames, temperature_frames, RunningMean
+    from temperature_cache import TemperatureCache, DEFAULT_CACHE_DIR
+    from impedance import batch_impedances
+    from atomicfile import atomic_output
+    from geometry import TrialGeometry
+    cache = TemperatureCache(args.cache_dir or DEFAULT_CACHE_DIR) if args.cache else None
 
     # first find the graphs file
     gfile = glob(os.path.join(args.path, 'graphs_*.npz'))
     if not len(gfile):
         print("Could not find graphs file in specified directory!")
-        sys.exit(1)
+        return 1
     if len(gfile) > 1:
         print("Found more than one graphs file... i am confused!")
-        sys.exit(1)
+        return 1
     gfile = gfile[0]
 
     # check whether we have a L or J side based on the graphs file name
@@ -102,46 +279,168 @@ if __name__ == "__main__":
         config.set('Default', 'nTrim', str(20))
         return config
 
+    options = impedanceFromCSV.make_options(one_face=True, orientation=side_type, stave=args.stave, run=args.run)
+
+    # the stave edges are found once per trial, hot and cold alike, and saved next to the images
+    geometry = TrialGeometry(args.path)
+    if args.invalidate_geometry:
+        geometry.invalidate()
+
+    def load_temperature_map(fname):
+        # the averaged, prepared temperature map of an image file and its timestamp
+        # emissivity=None: the map uses the emissivity stored in the file
+        map_parameters = dict(emissivity=None, adc=False, orientation=side_type, frameAverage='mean')
+        images_key = images.key(fname, **map_parameters) if images is not None else None
+        entry = images.get(images_key) if images is not None else None
+        key = cache.key(fname, **map_parameters) if cache and entry is None else None
+        if entry is None and cache:
+            entry = cache.get(key)
+            if entry is not None and images is not None:
+                images.put(images_key, *entry)
+        if entry is not None:
+            temp_img, meta = entry
+            print('loaded temp_img from the cache')
+            return temp_img, meta['timestamp']
+        # convert and average the frames one at a time
+        mean = RunningMean()
+        timestamp = None
+        for temp, meta in temperature_frames(iter_frames(fname), lut=args.lut):
+            if timestamp is None:
+                timestamp = meta['timestamp']
+            mean.add(temp)
+        temp_img = impedanceFromCSV.prepare_image(mean.result(), options)
+        if cache:
+            cache.put(key, temp_img, {'timestamp': timestamp})
+        if images is not None:
+            images.put(images_key, temp_img, {'timestamp': timestamp})
+        return temp_img, timestamp
+
     # load up the image files
-    for fname in it.chain(
+    fnames = list(it.chain(
             glob(os.path.join(args.path, '*.npy')),
             glob(os.path.join(args.path, 'images_*.npz')),
-        ):
+        ))
+
+    if args.time_series:
+        # the stave does not move within a run: find it (and lay out its regions) on one reference image only,
+        # then every image only needs its region temperatures. with --track, the stave is followed from image to
+        # image, and laid out anew wherever it moved to
+        if not fnames:
+            print("Could not find image files in specified directory!")
+            return 1
+        reference = args.reference or sorted(fnames)[0]
+        print("Finding the stave on", reference)
+        temp_img, timestamp = load_temperature_map(reference)
+        stave = impedanceFromCSV.analyze_image(temp_img, make_config(timestamp), options, prepared=True, geometry=geometry, source=reference).staveTop
+
+        tracker = None
+        if args.track:
+            from tracking import StaveTracker
+            # one stave (and so one layout of the regions) per geometry the stave is seen at
+            staves = {stave.boundaries: stave}
+
+            def stave_at(temp_img, timestamp, boundaries=None):
+                # the stave laid out at the boundaries, or where the full search finds it
+                if boundaries in staves:
+                    return staves[boundaries]
+                stave_options = options
+                if boundaries is not None:
+                    stave_options = impedanceFromCSV.make_options(one_face=True, orientation=side_type, manual_boundaries=list(boundaries))
+                found = impedanceFromCSV.analyze_image(temp_img, make_config(timestamp), stave_options, prepared=True).staveTop
+                return staves.setdefault(tuple(found.boundaries), found)
+
+            # the full search runs on the image being tracked, in the regime of its timestamp
+            tracker = StaveTracker(lambda temp_img: stave_at(temp_img, timestamp).boundaries)
+            tracker.reset(temp_img, stave.boundaries)
+            fnames = sorted(fnames)
+
+        timestamps = []
+        temperatures = []
+        frames = []
+        for fname in fnames:
+            print(fname)
+            temp_img, timestamp = load_temperature_map(fname)
+            timestamps.append(timestamp)
+            if tracker is not None:
+                frame = tracker.track(temp_img)
+                if frame.moved:
+                    print("The stave moved to", frame.boundaries)
+                stave = stave_at(temp_img, timestamp, frame.boundaries)
+                frames.append(frame)
+            temperatures.append(stave.plan.evaluate(temp_img))
+        order = np.argsort(timestamps, kind='stable')
+        timestamps = np.array(timestamps, dtype=np.float64)[order]
+        fnames = [fnames[i] for i in order]
+
+        # all impedances of the run in one go
+        cfg = make_config(timestamps[0])['Default']
+        tmean = 0.5*(temp_in(timestamps) + temp_out(timestamps))
+        impedances = batch_impedances(np.array(temperatures)[order], stave.getRegionTypes(),
+            [float(x) for x in DEFAULT_TEMPERATURE_PROFILE.split(',')], temp_in(timestamps), temp_out(timestamps),
+            flow_rate(timestamps), fluid_c(tmean), fluid_density(tmean), cfg)
+
+        header = ['file', 'timestamp', 'temp_in', 'temp_out', 'flow_rate', 'ear']
+        columns = [np.array([os.path.basename(f) for f in fnames]), timestamps, temp_in(timestamps), temp_out(timestamps), flow_rate(timestamps), impedances['ear']]
+        for region_type in ('large', 'small', 'combined'):
+            header += ['{}_{}'.format(region_type, i) for i in range(impedances[region_type].shape[1])]
+            columns += list(impedances[region_type].T)
+        if tracker is not None:
+            # where the stave was in every image, and how sure the tracker was of it
+            frames = [frames[i] for i in order]
+            header += ['x_left', 'x_right', 'y_top', 'y_bottom', 'confidence', 'detected']
+            columns += list(zip(*[frame.boundaries for frame in frames]))
+            columns += [[frame.confidence for frame in frames], [int(frame.detected) for frame in frames]]
+        table_name = os.path.join(args.path, 'impedance_vs_time_{}.csv'.format(side_type))
+        print("Outputing the impedances of {} images into a file: {}".format(len(fnames), table_name))
+        with atomic_output(table_name) as f:
+            f.write(','.join(header) + '\n')
+            for row in zip(*columns):
+                f.write(','.join(str(value) for value in row) + '\n')
+        if args.results_db:
+            from results import ResultsDB, make_record
+            region_types = stave.getRegionTypes()
+            ordered_temperatures = np.array(temperatures)[order]
+            records = []
+            for i, (fname, timestamp) in enumerate(zip(fnames, timestamps)):
+                record_impedances = [('top', 'ear', 0, impedances['ear'][i])]
+                for region_type in ('large', 'small', 'combined'):
+                    record_impedances += [('top', region_type, j, value) for j, value in enumerate(impedances[region_type][i])]
+                # the region temperatures, numbered along the pipe per type (the EoS corrections are not kept here)
+                region_temperatures = ordered_temperatures[i]
+                record_temperatures = []
+                for region_type in sorted(set(region_types) - {None}):
+                    columns_of_type = [j for j, t in enumerate(region_types) if t == region_type]
+                    record_temperatures += [('top', region_type, j, region_temperatures[column], None) for j, column in enumerate(columns_of_type)]
+                records.append(make_record(fname, side_type, record_impedances, record_temperatures, make_config(timestamp)['Default'],
+                                           vars(args), [frames[i].boundaries if tracker is not None else stave.boundaries],
+                                           args.stave, args.run, timestamp))
+            with ResultsDB(args.results_db) as db:
+                db.add_many(records)
+            print("Added {} analyses to {}".format(len(records), args.results_db))
+        return 0
+
+    records = []
+    for fname in fnames:
         print(fname)
         out_path,out_name = os.path.split(fname)
-        d = np.load(fname, allow_pickle=True)
-        if fname.endswith('.npy'):
-            temp_imgs = np.stack(list(it.starmap(adc_to_temp, d)), axis=0)
-            timestamp = d[0,1]['timestamp']
-        else:
-            params = {k: v for k,v in d.items() if not k == 'images'}
-            print('got params', params)
-            temp_imgs = np.stack([adc_to_temp(img, params) for img in d['images']], axis=0)
-            print('loaded temp_imgs', temp_imgs.shape)
-            timestamp = params['timestamp']
+        temp_img, timestamp = load_temperature_map(fname)
 
         print('timestamp', timestamp)
-        temp_img = temp_imgs.mean(axis=0)
         print(temp_img.shape)
         cfg = make_config(timestamp)
-        with tempfile.TemporaryDirectory() as tempdir:
-            print("temp dir:", tempdir)
-            with open(os.path.join(tempdir, 'config.cfg'), 'w') as fcfg:
-                cfg.write(fcfg)
-            np.save(os.path.join(tempdir, 'image.npy'), temp_img)
-
-            cmd=['python',
-                './impedanceFromCSV.py',
-                '-1f',
-                f'-{side_type}',
-                '--outpath',
-                f'{tempdir}',
-                f'{tempdir}/image.npy',
-                f'{tempdir}/config.cfg',
-            ]
-
-            print(cmd)
-            subprocess.run(cmd)
-
-            shutil.copy(os.path.join(tempdir, 'image_IMPEDANCES.csv'),
-                    os.path.join(out_path, out_name[:-4]+'_IMPEDANCES.csv'))
\ No newline at end of file
+        # analyse in-process instead of starting a new interpreter for every image
+        result = impedanceFromCSV.analyze_image(temp_img, cfg, options, prepared=True, geometry=geometry, source=fname)
+        impedanceFromCSV.save_csv(result, os.path.join(out_path, out_name[:-4]+'_IMPEDANCES'))
+        if args.results_db:
+            from results import result_record
+            records.append(result_record(result, options, fname, timestamp))
+
+    if args.results_db and records:
+        from results import ResultsDB
+        with ResultsDB(args.results_db) as db:
+            db.add_many(records)
+        print("Added {} analyses to {}".format(len(records), args.results_db))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
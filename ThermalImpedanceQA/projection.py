@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+'''
+projection.py
+
+About: Region averages over a linearly upscaled image, computed from the original image.
+
+  The regions of a stave are defined on the image scaled up with cv2.resize(..., interpolation=cv2.INTER_LINEAR),
+  to get sub-pixel region boundaries. Every pixel of the scaled image is a weighted sum of (at most) four pixels
+  of the original image, so the sum over a region of the scaled image is a weighted sum over the original pixels
+  under it. A ProjectionPlan holds these weights for all regions, as a sparse regions x pixels matrix: the region
+  averages of an image (or of a whole stack of frames) are then a single sparse product, and the scaled image
+  is never made.
+
+  The weights are those of OpenCV's INTER_LINEAR resize, so the averages agree with the ones taken on the
+  scaled image up to the rounding of the sums.
+'''
+
+import numpy as np
+
+def interpolation_coordinates(scaledSize, size):
+    '''
+    For every pixel of an axis scaled from `size` to `scaledSize` pixels: the first of the two source pixels it
+    is interpolated from and the weight of the second one, as cv2.resize computes them for INTER_LINEAR.
+    '''
+    position = (np.arange(scaledSize) + 0.5) * (size / scaledSize) - 0.5
+    source = np.floor(position).astype(np.int64)
+    fraction = position - source
+    # pixels beyond the centres of the outermost source pixels take their value
+    outside = (source < 0) | (source >= size - 1)
+    fraction[outside] = 0.
+    source = np.clip(source, 0, size - 1)
+    return source, fraction
+
+class RegionWeights:
+    '''
+    The weights of one region: the average is sum(weights * image.flat[indices]) / count.
+    '''
+    def __init__(self, indices, weights, count):
+        self.indices = indices
+        self.weights = weights
+        self.count = count
+
+    def plus(self, other, factor=1.0):
+        # the weights of this region with `factor` times the weighted sum of `other` added to its sum
+        return RegionWeights(np.concatenate([self.indices, other.indices]),
+                             np.concatenate([self.weights, factor * other.weights]), self.count)
+
+class ProjectionPlan:
+    '''
+    The weights of regions defined on the image of shape `shape` scaled to `scaledShape`. Regions are given in
+    scaled pixel coordinates, by the ranges of their rows and columns (rectangle()) or by a mask over such
+    a bounding box (mask()), and add() puts them into the plan. evaluate() returns the region averages.
+    '''
+    def __init__(self, shape, scaledShape):
+        self.shape = tuple(shape[:2])
+        self.scaledShape = tuple(scaledShape[:2])
+        self.__coordinates = [interpolation_coordinates(scaledShape[axis], shape[axis]) for axis in (0, 1)]
+        self.__regions = []
+        self.__compiled = None
+
+    def __len__(self):
+        return len(self.__regions)
+
+    def _axisWeights(self, axis, pixels):
+        # weights of the source pixels of `axis` summed over the scaled pixels `pixels` (a range);
+        # returns the first source pixel and the weights from there on
+        source, fraction = self.__coordinates[axis]
+        source, fraction = source[pixels.start:pixels.stop], fraction[pixels.start:pixels.stop]
+        if len(source) == 0:
+            return 0, np.zeros(0)
+        first = source[0]
+        upper = np.minimum(source + 1, self.shape[axis] - 1)
+        size = upper[-1] - first + 1
+        weights = np.bincount(source - first, weights=1. - fraction, minlength=size)
+        weights += np.bincount(upper - first, weights=fraction, minlength=size)
+        return first, weights
+
+    def _axisMatrix(self, axis, pixels):
+        # the interpolation matrix of the scaled pixels `pixels` (a range): one row per scaled pixel
+        source, fraction = self.__coordinates[axis]
+        source, fraction = source[pixels.start:pixels.stop], fraction[pixels.start:pixels.stop]
+        if len(source) == 0:
+            return 0, np.zeros((0, 0))
+        first = source[0]
+        upper = np.minimum(source + 1, self.shape[axis] - 1)
+        matrix = np.zeros((len(source), upper[-1] - first + 1))
+        rows = np.arange(len(source))
+        np.add.at(matrix, (rows, source - first), 1. - fraction)
+        np.add.at(matrix, (rows, upper - first), fraction)
+        return first, matrix
+
+    def _regionWeights(self, y0, x0, weights, count):
+        rows = np.arange(y0, y0 + weights.shape[0])
+        cols = np.arange(x0, x0 + weights.shape[1])
+        indices = (rows[:, None] * self.shape[1] + cols[None, :]).ravel()
+        return RegionWeights(indices, weights.ravel(), count)
+
+    def rectangle(self, rows, cols):
+        '''
+        The weights of the rectangle of scaled pixels rows x cols (ranges, as from range(n)[start:stop]).
+        '''
+        y0, wy = self._axisWeights(0, rows)
+        x0, wx = self._axisWeights(1, cols)
+        return self._regionWeights(y0, x0, np.outer(wy, wx), len(rows) * len(cols))
+
+    def mask(self, rows, cols, mask):
+        '''
+        The weights of the scaled pixels where `mask` (of shape (len(rows), len(cols))) is non-zero.
+        '''
+        mask = np.asarray(mask) != 0
+        y0, my = self._axisMatrix(0, rows)
+        x0, mx = self._axisMatrix(1, cols)
+        return self._regionWeights(y0, x0, my.T @ mask @ mx, int(np.count_nonzero(mask)))
+
+    def add(self, regionWeights):
+        # returns the index of the region in the results of evaluate()
+        self.__regions.append(regionWeights)
+        self.__compiled = None
+        return len(self.__regions) - 1
+
+    def _compile(self):
+        if self.__compiled is None:
+            lengths = [len(region.indices) for region in self.__regions]
+            starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+            indices = np.concatenate([region.indices for region in self.__regions] + [np.zeros(0, dtype=np.int64)])
+            weights = np.concatenate([region.weights for region in self.__regions] + [np.zeros(0)])
+            counts = np.array([region.count for region in self.__regions], dtype=np.float64)
+            self.__compiled = (indices, weights, starts, np.array(lengths) == 0, counts)
+        return self.__compiled
+
+    def evaluate(self, images):
+        '''
+        The region averages of an image of the original shape, or of a stack of them (..., H, W); the result has
+        one entry per region along its last axis. Regions without pixels average to nan.
+        '''
+        images = np.asarray(images)
+        if images.shape[-2:] != self.shape:
+            raise ValueError("The plan is for images of shape {}, not {}".format(self.shape, images.shape[-2:]))
+        indices, weights, starts, empty, counts = self._compile()
+        flat = images.reshape(images.shape[:-2] + (-1,))
+        if len(indices) == 0:
+            return np.full(flat.shape[:-1] + (len(counts),), np.nan)
+        # the sparse product: gather the pixels, weight them and sum the entries of every region
+        sums = np.add.reduceat(flat[..., indices] * weights, np.minimum(starts, len(indices) - 1), axis=-1)
+        sums[..., empty] = 0.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sums / counts
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+'''
+results.py
+
+About: A local database (SQLite) of analysis results, next to the _IMPEDANCES.csv/.npz files of every input. One
+  database holds the impedances, region temperatures, process variables, parameters and provenance of any number
+  of analyses, indexed by stave, side, regime, run and timestamp, so that comparisons across staves and runs are
+  one query instead of globbing thousands of small files.
+
+  impedanceFromCSV.py, watch.py and process_tc_data.py write to it with --results-db; batch.py collects the
+  results of its workers and inserts them in bulk, in one transaction per chunk of files. The stave and run of an
+  analysis are --stave and --run, by default taken from the directory of the input (see default_labels).
+
+  Usage: python results.py <database> list   [filters]
+         python results.py <database> export [filters] -o table.csv
+  with the filters --stave, --side, --regime, --run, --since and --until (dates as YYYY-MM-DD[THH:MM:SS]).
+'''
+
+import os
+import re
+import csv
+import sys
+import json
+import socket
+import sqlite3
+import argparse
+import datetime
+import numpy as np
+
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS analyses (
+    id INTEGER PRIMARY KEY,
+    file TEXT NOT NULL,
+    path TEXT,
+    stave TEXT,
+    side TEXT NOT NULL,
+    regime TEXT,
+    run TEXT,
+    timestamp REAL,
+    analysed TEXT NOT NULL,
+    host TEXT,
+    temp_in REAL,
+    temp_out REAL,
+    flow_rate REAL,
+    c_liquid REAL,
+    liquid_density REAL,
+    boundaries TEXT,
+    parameters TEXT,
+    options TEXT
+);
+CREATE TABLE IF NOT EXISTS impedances (
+    analysis INTEGER NOT NULL REFERENCES analyses(id) ON DELETE CASCADE,
+    face TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    region INTEGER NOT NULL,
+    value REAL
+);
+CREATE TABLE IF NOT EXISTS temperatures (
+    analysis INTEGER NOT NULL REFERENCES analyses(id) ON DELETE CASCADE,
+    face TEXT NOT NULL,
+    type TEXT NOT NULL,
+    region INTEGER NOT NULL,
+    temperature REAL,
+    correction REAL
+);
+CREATE INDEX IF NOT EXISTS analyses_stave ON analyses(stave, side, regime, run, timestamp);
+CREATE INDEX IF NOT EXISTS analyses_run ON analyses(run, timestamp);
+CREATE INDEX IF NOT EXISTS analyses_timestamp ON analyses(timestamp);
+CREATE INDEX IF NOT EXISTS impedances_analysis ON impedances(analysis, face, kind);
+CREATE INDEX IF NOT EXISTS temperatures_analysis ON temperatures(analysis, face, type);
+'''
+
+# the process variables, which are columns of their own (the whole config section is kept in `parameters`)
+PROCESS_VARIABLES = ('temp_in', 'temp_out', 'flow_rate', 'c_liquid', 'liquid_density')
+
+FILTERS = ('stave', 'side', 'regime', 'run')
+
+# a run directory of the thermal controller, inside the directory of the stave (e.g. trial13/run_004)
+RUN_DIRECTORY = re.compile(r"run_?\d+$")
+
+def default_labels(path):
+    '''
+    The (stave, run) of an input file: the run is the name of its directory; the stave is the name of the directory
+    above a run directory (run_004, ...), otherwise the name of the directory itself.
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    run = os.path.basename(directory)
+    stave = os.path.basename(os.path.dirname(directory)) if RUN_DIRECTORY.match(run) else run
+    return stave, run
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def make_record(path, side, impedances, temperatures=(), parameters=None, options=None, boundaries=None,
+                stave=None, run=None, timestamp=None):
+    '''
+    One analysis as it goes into the database. impedances are (face, kind, region, value) with kind 'large',
+    'small', 'combined' or 'ear'; temperatures are (face, type, region, temperature, correction). parameters is
+    the config section the analysis used, options a dict of its options. stave and run default to
+    default_labels(path), the timestamp to the modification time of the file.
+    '''
+    defaultStave, defaultRun = default_labels(path)
+    parameters = dict(parameters or {})
+    if timestamp is None and os.path.isfile(path):
+        timestamp = os.stat(path).st_mtime
+    record = {
+        'file': os.path.basename(path),
+        'path': os.path.abspath(path),
+        'stave': stave or defaultStave,
+        'side': side,
+        'regime': parameters.get('regime'),
+        'run': run or defaultRun,
+        'timestamp': _float(timestamp),
+        'analysed': datetime.datetime.now().isoformat(timespec="seconds"),
+        'host': socket.gethostname(),
+        'boundaries': json.dumps([[int(x) for x in staveBoundaries] for staveBoundaries in boundaries]) if boundaries is not None else None,
+        'parameters': json.dumps(parameters, sort_keys=True),
+        'options': json.dumps(options or {}, sort_keys=True, default=str),
+        'impedances': [(face, kind, int(region), _float(value)) for face, kind, region, value in impedances],
+        'temperatures': [(face, type, int(region), _float(temperature), _float(correction)) for face, type, region, temperature, correction in temperatures],
+    }
+    for name in PROCESS_VARIABLES:
+        record[name] = _float(parameters.get(name))
+    return record
+
+def result_record(result, options, path, timestamp=None):
+    '''
+    The record of an impedanceFromCSV.ImpedanceResult of the file `path`, analysed with `options`.
+    '''
+    faces = [('top', result.staveTop, 'Top')]
+    if result.twoFace:
+        faces.append(('bottom', result.staveBottom, 'Bottom'))
+    values = result.toDict()
+    impedances = []
+    temperatures = []
+    for face, stave, suffix in faces:
+        for kind, key in (('large', 'large'), ('small', 'small'), ('combined', 'impedanceCombined')):
+            impedances += [(face, kind, i, value) for i, value in enumerate(values[key + suffix])]
+        impedances.append((face, 'ear', 0, values['earImpedance' + suffix]))
+        for type in sorted(set(stave.getRegionTypes()) - {None}):
+            temperatures += [(face, type, i, temperature, correction) for i, (temperature, correction)
+                             in enumerate(zip(stave.getTemperatures(type), stave.getTemperatureCorrections(type)))]
+    parameters = dict(result.config['Default']) if result.config is not None else None
+    return make_record(path, options.orientation or 'two-face', impedances, temperatures, parameters, vars(options),
+                       [stave.boundaries for face, stave, suffix in faces], options.stave, options.run, timestamp)
+
+def _timestamp(value):
+    # a date (YYYY-MM-DD[THH:MM:SS]) or seconds since the epoch
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+class ResultsDB:
+    '''
+    The results database at `path`, created if it does not exist. Queries take the filters stave, side, regime and
+    run (a value or a list of values) and since/until (timestamps or dates).
+    '''
+    def __init__(self, path):
+        self.path = path
+        # several processes (watchers, batches) may write to one database: wait for each other's transactions
+        self.connection = sqlite3.connect(path, timeout=60.)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise Exception("The results database {} was written by a newer version of the analysis".format(path))
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+            self.connection.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, record):
+        return self.add_many([record])[0]
+
+    def add_many(self, records):
+        '''
+        Inserts the records (see make_record) in one transaction; returns their ids.
+        '''
+        columns = [name for name in records[0] if name not in ('impedances', 'temperatures')] if records else []
+        insert = "INSERT INTO analyses ({}) VALUES ({})".format(", ".join(columns), ", ".join("?"*len(columns)))
+        ids = []
+        with self.connection:
+            for record in records:
+                ids.append(self.connection.execute(insert, [record[name] for name in columns]).lastrowid)
+            self.connection.executemany("INSERT INTO impedances VALUES (?, ?, ?, ?, ?)",
+                                        [(id,) + row for id, record in zip(ids, records) for row in record['impedances']])
+            self.connection.executemany("INSERT INTO temperatures VALUES (?, ?, ?, ?, ?, ?)",
+                                        [(id,) + row for id, record in zip(ids, records) for row in record['temperatures']])
+        return ids
+
+    def _where(self, filters):
+        clauses, values = [], []
+        for name in FILTERS:
+            value = filters.pop(name, None)
+            if value is None:
+                continue
+            value = [value] if isinstance(value, str) else list(value)
+            clauses.append("a.{} IN ({})".format(name, ", ".join("?"*len(value))))
+            values += value
+        for name, operator in (('since', '>='), ('until', '<=')):
+            value = _timestamp(filters.pop(name, None))
+            if value is not None:
+                clauses.append("a.timestamp {} ?".format(operator))
+                values.append(value)
+        if filters:
+            raise TypeError("Unknown filters: " + ", ".join(filters))
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", values
+
+    def analyses(self, **filters):
+        '''
+        The analyses matching the filters as dicts (without their impedances and temperatures), in the order of
+        their timestamps.
+        '''
+        where, values = self._where(filters)
+        rows = self.connection.execute("SELECT a.* FROM analyses a" + where + " ORDER BY a.timestamp, a.id", values)
+        return [dict(row) for row in rows]
+
+    def _values(self, table, column, selector, face, filters):
+        analyses = self.analyses(**filters)
+        if not analyses:
+            return analyses, np.zeros((0, 0))
+        where, values = self._where(dict(filters))
+        rows = self.connection.execute(
+            "SELECT a.id, v.region, v.{column} FROM analyses a JOIN {table} v ON v.analysis = a.id{where}{conjunction}"
+            " v.face = ? AND v.{selectorColumn} = ?".format(column=column, table=table, where=where,
+            conjunction=" AND" if where else " WHERE", selectorColumn='kind' if table == 'impedances' else 'type'),
+            values + [face, selector]).fetchall()
+        index = {analysis['id']: i for i, analysis in enumerate(analyses)}
+        array = np.full((len(analyses), max((row[1] for row in rows), default=-1) + 1), np.nan)
+        for id, region, value in rows:
+            array[index[id], region] = np.nan if value is None else value
+        return analyses, array
+
+    def impedances(self, kind, face='top', **filters):
+        '''
+        The impedances of one kind ('large', 'small', 'combined' or 'ear') of the analyses matching the filters:
+        returns the analyses (see analyses()) and an array with one row per analysis and one column per region.
+        '''
+        return self._values('impedances', 'value', kind, face, filters)
+
+    def temperatures(self, type, face='top', **filters):
+        '''
+        The region temperatures of one region type, like impedances().
+        '''
+        return self._values('temperatures', 'temperature', type, face, filters)
+
+    def summary(self, **filters):
+        # the number of analyses and their time span per stave, side, regime and run
+        where, values = self._where(filters)
+        rows = self.connection.execute("SELECT a.stave, a.side, a.regime, a.run, COUNT(*) AS analyses, MIN(a.timestamp) AS first,"
+                                       " MAX(a.timestamp) AS last FROM analyses a" + where +
+                                       " GROUP BY a.stave, a.side, a.regime, a.run ORDER BY a.stave, a.side, a.regime, a.run", values)
+        return [dict(row) for row in rows]
+
+    def table(self, **filters):
+        '''
+        The analyses matching the filters as one wide table: a header and one row per analysis, with the
+        impedances of every face in the columns of watch.py's tables (earImpedanceTop, largeTop_0, ...).
+        '''
+        analyses = self.analyses(**dict(filters))
+        header = ['id', 'file', 'stave', 'side', 'regime', 'run', 'timestamp', 'time'] + list(PROCESS_VARIABLES)
+        rows = [[analysis[name] for name in header[:7]] +
+                [datetime.datetime.fromtimestamp(analysis['timestamp']).isoformat() if analysis['timestamp'] is not None else None] +
+                [analysis[name] for name in PROCESS_VARIABLES] for analysis in analyses]
+        for face in ('top', 'bottom'):
+            suffix = face.capitalize()
+            for kind, name in (('ear', 'earImpedance'), ('large', 'large'), ('small', 'small'), ('combined', 'impedanceCombined')):
+                selected, values = self.impedances(kind, face, **dict(filters))
+                if not np.isfinite(values).any():
+                    continue
+                if kind == 'ear':
+                    header.append(name + suffix)
+                else:
+                    header += ['{}{}_{}'.format(name, suffix, i) for i in range(values.shape[1])]
+                # the same analyses in the same order
+                for row, regionValues in zip(rows, values):
+                    row += [None if np.isnan(value) else float(value) for value in regionValues]
+        return header, rows
+
+def add_filter_arguments(parser):
+    for name in FILTERS:
+        parser.add_argument("--" + name, action="append", help="Only the analyses of this {} (can be given more than once)".format(name))
+    parser.add_argument("--since", help="Only the analyses of files taken at or after this date (YYYY-MM-DD[THH:MM:SS])")
+    parser.add_argument("--until", help="Only the analyses of files taken at or before this date")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lists or exports the analyses in a results database.")
+    parser.add_argument("database", help="The results database")
+    commands = parser.add_subparsers(dest="command", required=True)
+    listing = commands.add_parser("list", help="The number of analyses per stave, side, regime and run")
+    add_filter_arguments(listing)
+    export = commands.add_parser("export", help="Exports the impedances of the analyses as one CSV table")
+    add_filter_arguments(export)
+    export.add_argument("-o", "--output", help="The CSV file to write (default: standard output)")
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(args.database):
+        print("No results database at " + args.database)
+        return 1
+    filters = {name: getattr(args, name) for name in FILTERS + ('since', 'until')}
+    with ResultsDB(args.database) as db:
+        if args.command == "list":
+            for entry in db.summary(**filters):
+                first, last = (datetime.datetime.fromtimestamp(entry[name]).isoformat(timespec="seconds") if entry[name] is not None else "?"
+                               for name in ('first', 'last'))
+                print("{stave} {side} {regime} {run}: {analyses} analyses".format(**entry) + ", {} to {}".format(first, last))
+            return 0
+        header, rows = db.table(**filters)
+        output = open(args.output, "w", newline="") if args.output else sys.stdout
+        try:
+            writer = csv.writer(output)
+            writer.writerow(header)
+            writer.writerows(rows)
+        finally:
+            if args.output:
+                output.close()
+        if args.output:
+            print("Exported {} analyses to {}".format(len(rows), args.output))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
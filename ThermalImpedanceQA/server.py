@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+'''
+server.py
+
+About: A long-running analysis service for the GUI, process_tc_data.py and the command line. Every script started
+  on its own pays for starting Python and importing numpy, cv2 and matplotlib, and loses what the analysis keeps in
+  memory when it exits. The server imports the analysis once and keeps, from one job to the next, the compiled
+  region layouts and their weights (layout.py), the stave geometry sidecars of the trials (geometry.py), the
+  temperature maps of the files it analysed (temperature_cache.MemoryCache) and the plot templates (plots.py), so a
+  file analysed through it costs only the numerical work.
+
+  The server listens on localhost only. It writes its port and a random key to ~/.thermal_qa_server, and the
+  clients authenticate with that key. The jobs run one after the other on one thread, in the order they arrive;
+  what a job prints is sent back to the client that submitted it. Without a running server, connect() returns a
+  LocalClient, which runs the same jobs in the calling process (and is the stand-in for the server in tests).
+
+  Usage: python server.py start [--port PORT] [--memory MB]
+         python server.py status
+         python server.py stop
+         python server.py analyze <impedanceFromCSV.py arguments>
+         python server.py process-tc <process_tc_data.py arguments>
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import traceback
+import contextlib
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+SERVER_FILE = os.path.join(os.path.expanduser("~"), ".thermal_qa_server")
+
+class AnalysisService:
+    '''
+    Runs the jobs in this process, with the caches that outlive them. run() takes a request {'command': ...,
+    'argv': [...], 'cwd': ...} and returns {'ok', 'result', 'error', 'output', 'seconds'}. The job runs in the
+    directory cwd, so that the relative paths of the client mean the same.
+    '''
+    def __init__(self, memoryBytes=1024**3):
+        # the imports are paid for once, when the service starts
+        import impedanceFromCSV
+        import process_tc_data
+        import plots
+        from temperature_cache import MemoryCache
+        self.impedanceFromCSV = impedanceFromCSV
+        self.process_tc_data = process_tc_data
+        self.images = MemoryCache(memoryBytes)
+        self.started = time.time()
+        self.jobs = 0
+
+    def analyze(self, argv):
+        # like impedanceFromCSV.py; returns the impedances of the file
+        options = self.impedanceFromCSV.make_parser().parse_args(argv)
+        if options.path[-3:] not in ['csv', 'npy', 'npz']:
+            raise Exception("Need to load a csv, npy or npz file")
+        result = self.impedanceFromCSV.analyze_file(options, images=self.images)
+        return {name: (None if value is None else getattr(value, 'tolist', lambda: value)()) for name, value in result.toDict().items()}
+
+    def processTc(self, argv):
+        # like process_tc_data.py; fails like a script that exits with its code
+        code = self.process_tc_data.main(argv, images=self.images)
+        if code:
+            raise SystemExit(code)
+        return code
+
+    def status(self, argv=()):
+        return {'pid': os.getpid(), 'uptime': time.time() - self.started, 'jobs': self.jobs, 'cachedMaps': len(self.images.entries),
+                'cachedBytes': self.images.size, 'cacheHits': self.images.hits, 'cacheMisses': self.images.misses}
+
+    def run(self, request):
+        command = request.get('command')
+        handler = {'analyze': self.analyze, 'process-tc': self.processTc, 'status': self.status}.get(command)
+        startTime = time.time()
+        output = io.StringIO()
+        result, error = None, None
+        directory = os.getcwd()
+        try:
+            if handler is None:
+                raise Exception("Unknown command: " + str(command))
+            os.chdir(request.get('cwd') or directory)
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                result = handler(list(request.get('argv', ())))
+        except SystemExit as exit:
+            # the scripts (and argparse) exit with a code
+            if exit.code not in (None, 0):
+                error = "exited with code {}".format(exit.code)
+        except Exception:
+            error = traceback.format_exc()
+        finally:
+            os.chdir(directory)
+        if command != 'status':
+            self.jobs += 1
+        return {'ok': error is None, 'result': result, 'error': error, 'output': output.getvalue(), 'seconds': time.time() - startTime}
+
+class AnalysisServer:
+    '''
+    The service behind a localhost socket; serve() runs until a client sends 'stop'.
+    '''
+    def __init__(self, port=0, memoryBytes=1024**3, serverFile=SERVER_FILE):
+        self.key = os.urandom(32)
+        self.listener = Listener(('localhost', port), authkey=self.key)
+        self.address = self.listener.address
+        self.serverFile = serverFile
+        self.service = AnalysisService(memoryBytes)
+        # the jobs run one at a time, all on the same thread: the caches are not shared between threads (the plot
+        # templates are kept per thread), and the output of a job is captured. The items are (request, reply
+        # queue); None stops the thread.
+        self.jobs = queue.Queue()
+        self.jobThread = threading.Thread(target=self._run_jobs, daemon=True)
+        self.jobThread.start()
+        self.running = True
+
+    def _run_jobs(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            request, reply = job
+            response = self.service.run(request)
+            print("[{}] {} {} ({:.2f} s)".format("done" if response['ok'] else "FAILED", request.get('command'),
+                                                 " ".join(request.get('argv', ())), response['seconds']))
+            reply.put(response)
+
+    def _client(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    break
+                if request.get('command') == 'stop':
+                    conn.send({'ok': True, 'result': None, 'error': None, 'output': "", 'seconds': 0.})
+                    self.stop()
+                    break
+                reply = queue.Queue(1)
+                self.jobs.put((request, reply))
+                conn.send(reply.get())
+
+    def stop(self):
+        self.running = False
+        # wake up the accept() of serve()
+        try:
+            Client(self.address, authkey=self.key).close()
+        except OSError:
+            pass
+
+    def serve(self):
+        # only the user who started the server may read the key
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.serverFile)
+        with os.fdopen(os.open(self.serverFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as f:
+            json.dump({'port': self.address[1], 'key': self.key.hex(), 'pid': os.getpid()}, f)
+        print("Analysis server listening on {}:{}".format(*self.address))
+        try:
+            while self.running:
+                try:
+                    conn = self.listener.accept()
+                except AuthenticationError:
+                    continue
+                if not self.running:
+                    conn.close()
+                    break
+                threading.Thread(target=self._client, args=(conn,), daemon=True).start()
+        finally:
+            self.jobs.put(None)
+            self.listener.close()
+            with contextlib.suppress(OSError):
+                os.remove(self.serverFile)
+        print("Analysis server stopped.")
+
+class AnalysisClient:
+    '''
+    A connection to the running server. Raises OSError if there is none.
+    '''
+    remote = True
+
+    def __init__(self, serverFile=SERVER_FILE):
+        with open(serverFile) as f:
+            server = json.load(f)
+        self.conn = Client(('localhost', server['port']), authkey=bytes.fromhex(server['key']))
+
+    def request(self, command, argv=()):
+        self.conn.send({'command': command, 'argv': list(argv), 'cwd': os.getcwd()})
+        return self.conn.recv()
+
+    def analyze(self, argv):
+        return self.request('analyze', argv)
+
+    def processTc(self, argv):
+        return self.request('process-tc', argv)
+
+    def status(self):
+        return self.request('status')
+
+    def stop(self):
+        return self.request('stop')
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class LocalClient(AnalysisClient):
+    '''
+    Runs the jobs in this process, with the caches of its own AnalysisService; for when no server is running,
+    and for tests.
+    '''
+    remote = False
+
+    def __init__(self, memoryBytes=1024**3):
+        self.service = AnalysisService(memoryBytes)
+
+    def request(self, command, argv=()):
+        if command == 'stop':
+            return {'ok': True, 'result': None, 'error': None, 'output': "", 'seconds': 0.}
+        return self.service.run({'command': command, 'argv': list(argv)})
+
+    def close(self):
+        pass
+
+def connect(fallback=True, serverFile=SERVER_FILE):
+    '''
+    A client of the running server or, if there is none and fallback is set, a LocalClient.
+    '''
+    try:
+        return AnalysisClient(serverFile)
+    except (OSError, ValueError, KeyError, AuthenticationError):
+        if not fallback:
+            raise
+        return LocalClient()
+
+def _report(response):
+    sys.stdout.write(response['output'])
+    if not response['ok']:
+        print(response['error'])
+    return 0 if response['ok'] else 1
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs analyses in a long-running server.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    start = commands.add_parser("start", help="Start the server (it runs until it is stopped)")
+    start.add_argument("--port", type=int, default=0, help="The port on localhost (default: any free one)")
+    start.add_argument("--memory", type=int, default=1024, help="Memory for the temperature maps kept between jobs, in MB (default: 1024)")
+    commands.add_parser("status", help="Show whether the server runs, and what it keeps")
+    commands.add_parser("stop", help="Stop the server")
+    for command, script in (("analyze", "impedanceFromCSV.py"), ("process-tc", "process_tc_data.py")):
+        job = commands.add_parser(command, help="Run {} in the server".format(script), add_help=False)
+        job.add_argument("arguments", nargs=argparse.REMAINDER, help="The arguments of " + script)
+    args = parser.parse_args(argv)
+
+    if args.command == "start":
+        AnalysisServer(args.port, args.memory*1024**2).serve()
+        return 0
+    try:
+        client = connect(fallback=False)
+    except (OSError, ValueError, KeyError, AuthenticationError):
+        if args.command in ("status", "stop"):
+            print("No analysis server is running.")
+            return 1 if args.command == "status" else 0
+        # without a server, the job runs here
+        client = LocalClient()
+    with client:
+        if args.command == "status":
+            status = client.status()['result']
+            print("Analysis server (pid {pid}) up for {uptime:.0f} s: {jobs} jobs, {cachedMaps} temperature maps in memory "
+                  "({cachedBytes} bytes, {cacheHits} hits, {cacheMisses} misses)".format(**status))
+        elif args.command == "stop":
+            client.stop()
+            print("Stopped the analysis server.")
+        elif args.command == "analyze":
+            return _report(client.analyze(args.arguments))
+        else:
+            return _report(client.processTc(args.arguments))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
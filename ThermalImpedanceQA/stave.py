@@ -10,15 +10,305 @@ for finding the edges of the staves.
 
 import logging
 import os
+import functools
 import cv2
 import configparser
 import numpy as np
-from matplotlib import pyplot as plt
+from projection import ProjectionPlan, RegionWeights
+from impedance import liquid_temperatures, segment_impedances, flow_kg_per_sec
+
+def globalCoordinates(boundaries, nTrim, xLeft, xRight, yTop, yBottom, tolerance=1.e-6):
+  '''
+  Transforms region coordinates relative to the stave [xLeft, xRight, yTop, yBottom] (numbers or arrays) into
+  pixel coordinates of the (scaled) image. Edges on the edges of the stave are moved nTrim pixels inwards.
+  '''
+  staveXLeft, staveXRight, staveYTop, staveYBottom = boundaries
+  length = staveXRight - staveXLeft
+  width = staveYBottom - staveYTop
+  regionXLeft = staveXLeft + xLeft*length
+  regionYTop = staveYTop + yTop*width
+  regionXRight = staveXLeft + xRight*length
+  regionYBottom = staveYTop + yBottom*width
+  #(adding nTrim times a boolean leaves the other edges exactly as they are)
+  regionYTop = regionYTop + nTrim*(abs(yTop-0.) < tolerance)
+  regionYBottom = regionYBottom - nTrim*(abs(yBottom-1.) < tolerance)
+  regionXLeft = regionXLeft + nTrim*(abs(xLeft-0.) < tolerance)
+  regionXRight = regionXRight - nTrim*(abs(xRight-1.) < tolerance)
+  return regionXLeft, regionXRight, regionYTop, regionYBottom
+
+def edgeProjection(image, gradient, axis, rows, cols):
+  '''
+  np.sum(np.gradient(image[rows, cols], axis=axis), axis=1-axis), taken from the gradient of the whole image:
+  only the first and the last line of the window need their one-sided differences.
+  '''
+  projection = np.sum(gradient[rows, cols], axis=1-axis)
+  lines = np.moveaxis(image[rows, cols], axis, 0)
+  projection[0] = np.sum(lines[1] - lines[0])
+  projection[-1] = np.sum(lines[-1] - lines[-2])
+  return projection
+
+def edgePeaks(projection, findMax):
+  #the positions of the largest and the smallest value of the projection; the other way round if not findMax
+  first, second = (np.argmax(projection), np.argmin(projection)) if findMax else (np.argmin(projection), np.argmax(projection))
+  return int(first), int(second)
+
+def refineEdge(image, axis, estimate, margin, findMax):
+  '''
+  The line of image where the sum of its gradient along axis is largest (findMax) or smallest, looked for within
+  margin lines of the estimate. The projection is computed on these lines only, and comes out exactly as on the
+  whole image. Returns None if the peak may lie outside of the lines searched.
+  '''
+  length = image.shape[axis]
+  lo, hi = max(int(estimate - margin), 0), min(int(estimate + margin) + 1, length)
+  if hi - lo < 2:
+    return None
+  #one line more on both sides, so that the differences are central as on the whole image
+  start, stop = max(lo - 1, 0), min(hi + 1, length)
+  lines = image[start:stop] if axis == 0 else image[:, start:stop]
+  projection = np.sum(np.gradient(lines, axis=axis), axis=1-axis)[lo-start:hi-start]
+  peak = int(np.argmax(projection) if findMax else np.argmin(projection))
+  if (peak == 0 and lo > 0) or (peak == len(projection)-1 and hi < length):
+    return None
+  return lo + peak
+
+def uBendGeometry(boundaries, rxLeft, rxRight, ryTop, ryBottom, rradius, rlength, bend):
+  '''
+  The pixel geometry of a U-bend region (see Stave.AddUBendRegion), as the arguments of uBendMask after the shape.
+  '''
+  staveXLeft, staveXRight, staveYTop, staveYBottom = boundaries
+  length = staveXRight - staveXLeft
+  width = staveYBottom - staveYTop
+
+  #coordinates of the first "starting" rectangle
+  xLeft1 = int(staveXLeft + rxLeft*length)
+  yTop1 = int(staveYTop + ryTop*width)
+  xRight1 = int(staveXLeft + rxRight*length)
+  yBottom1 = int(staveYTop + ryBottom*width)
+
+
+  radius = int(rradius*width)
+
+  thickness = int(yBottom1-yTop1)
+  centreX = int(xRight1)
+
+  if bend=="upwards":
+    centreY = int(0.5*(yTop1+yBottom1)-rradius*width)
+  else:
+    centreY = int(0.5*(yTop1+yBottom1)+rradius*width)
+
+  xLeft2 = int(xRight1 + radius - thickness/2)
+  xRight2 = int(xLeft2 + thickness)
+
+  if bend=="upwards":
+    yTop2 = int(yBottom1 - radius - thickness/2)
+    yBottom2 = int(yTop2 - rlength*width)
+  else:
+    yTop2 = int(yBottom1 + radius - thickness/2)
+    yBottom2 = int(yTop2 + rlength*width)
+
+
+  if bend=="upwards":
+    start_angle, stop_angle = 0, 90
+  else:
+    start_angle, stop_angle = 270, 360
+
+  return (xLeft1,yTop1,xRight1,yBottom1), (centreX,centreY), radius, thickness, start_angle, stop_angle, (xLeft2,yTop2,xRight2,yBottom2)
+
+@functools.lru_cache(maxsize=64)
+def uBendMask(shape, rectangle1, centre, radius, thickness, startAngle, stopAngle, rectangle2):
+  '''
+  Draws the U-bend region (rectangle -> quarter circle -> rectangle, in pixels of an image of the given shape)
+  into a mask of its bounding box only. Returns the rows and columns (ranges) of the bounding box and the mask,
+  which is read-only as it is shared by all regions of the same geometry.
+  '''
+  xLeft1, yTop1, xRight1, yBottom1 = rectangle1
+  xLeft2, yTop2, xRight2, yBottom2 = rectangle2
+  #a box surely containing the shapes (the arc is drawn up to half its thickness around the circle), clipped to the image
+  margin = radius + thickness//2 + 2
+  xMin = max(0, min(xLeft1, xRight1, xLeft2, xRight2, centre[0]-margin))
+  xMax = min(shape[1]-1, max(xLeft1, xRight1, xLeft2, xRight2, centre[0]+margin))
+  yMin = max(0, min(yTop1, yBottom1, yTop2, yBottom2, centre[1]-margin))
+  yMax = min(shape[0]-1, max(yTop1, yBottom1, yTop2, yBottom2, centre[1]+margin))
+  if xMin > xMax or yMin > yMax:
+    raise Exception("The U-bend region is outside of the image.")
+
+  #draw in the coordinates of the box
+  regions_image = np.zeros([yMax-yMin+1, xMax-xMin+1])
+  regions_image = cv2.rectangle(regions_image, (xLeft1-xMin,yTop1-yMin), (xRight1-xMin,yBottom1-yMin), 1, -1)
+  regions_image = cv2.ellipse(regions_image, (centre[0]-xMin,centre[1]-yMin), (radius,radius), 0, startAngle, stopAngle, 1, thickness)
+  regions_image = cv2.rectangle(regions_image, (xLeft2-xMin,yTop2-yMin), (xRight2-xMin,yBottom2-yMin), 1, -1)
+
+  #shrink the box to the drawn pixels
+  rows = np.flatnonzero(regions_image.any(axis=1))
+  cols = np.flatnonzero(regions_image.any(axis=0))
+  if len(rows) == 0:
+    raise Exception("The U-bend region is outside of the image.")
+  mask = regions_image[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+  mask.flags.writeable = False
+  return range(yMin+rows[0], yMin+rows[-1]+1), range(xMin+cols[0], xMin+cols[-1]+1), mask
+
+class BondPads:
+  '''
+  The bond pads of a stave, which are shiny and so do not show the temperature of the stave: `pads` are the
+  (rows, cols) ranges of the scaled image they cover, `windows` the (leftCols, rightCols) ranges of the windows
+  next to them. The region averages leave the pad pixels out (fill=False) or count them with the average of the
+  two windows, as if the pads were painted over with it (fill=True). Made by bondPads(), once per geometry.
+  '''
+  def __init__(self, scaledShape, pads, windows, fill):
+    self.scaledShape = scaledShape
+    self.pads = pads
+    self.windows = windows
+    self.fill = fill
+    #the pads as one label image over their bounding box: 0 outside of the pads, i+1 on pad i
+    self.rows = range(min(rows.start for rows, cols in pads), max(rows.stop for rows, cols in pads))
+    self.cols = range(min(cols.start for rows, cols in pads), max(cols.stop for rows, cols in pads))
+    self.labels = np.zeros((len(self.rows), len(self.cols)), dtype=np.int32)
+    for i, (rows, cols) in enumerate(pads):
+      self.labels[rows.start-self.rows.start:rows.stop-self.rows.start, cols.start-self.cols.start:cols.stop-self.cols.start] = i+1
+    self.labels.flags.writeable = False
+    self.__fillWeights = {}
+
+  def fillWeights(self, plan):
+    #for every pad, the weights of the average of its two windows (as one pixel), made once per image shape
+    key = (plan.shape, plan.scaledShape)
+    if key not in self.__fillWeights:
+      fills = []
+      for (rows, cols), (leftCols, rightCols) in zip(self.pads, self.windows):
+        left, right = plan.rectangle(rows, leftCols), plan.rectangle(rows, rightCols)
+        leftFactor = 0.5/left.count if left.count else np.nan
+        rightFactor = 0.5/right.count if right.count else np.nan
+        fills.append(RegionWeights(np.concatenate([left.indices, right.indices]),
+                                   np.concatenate([leftFactor*left.weights, rightFactor*right.weights]), 1))
+      self.__fillWeights[key] = fills
+    return self.__fillWeights[key]
+
+  def weights(self, plan, rows, cols, mask=None):
+    '''
+    The weights of the scaled pixels rows x cols (where mask is non-zero), with the pads left out or filled.
+    '''
+    overlapRows = range(max(rows.start, self.rows.start), min(rows.stop, self.rows.stop))
+    overlapCols = range(max(cols.start, self.cols.start), min(cols.stop, self.cols.stop))
+    if len(overlapRows) == 0 or len(overlapCols) == 0:
+      return plan.rectangle(rows, cols) if mask is None else plan.mask(rows, cols, mask)
+    regionMask = np.ones((len(rows), len(cols)), dtype=bool) if mask is None else np.asarray(mask) != 0
+    labels = np.zeros(regionMask.shape, dtype=np.int32)
+    labels[overlapRows.start-rows.start:overlapRows.stop-rows.start, overlapCols.start-cols.start:overlapCols.stop-cols.start] = \
+      self.labels[overlapRows.start-self.rows.start:overlapRows.stop-self.rows.start, overlapCols.start-self.cols.start:overlapCols.stop-self.cols.start]
+    #the pixels of the region on every pad, all pads at once
+    padCounts = np.bincount(labels[regionMask], minlength=len(self.pads)+1)[1:]
+    if not padCounts.any():
+      return plan.rectangle(rows, cols) if mask is None else plan.mask(rows, cols, mask)
+    weights = plan.mask(rows, cols, regionMask & (labels == 0))
+    if not self.fill:
+      return weights
+    #the pad pixels count with the average of the windows next to their pad
+    weights = RegionWeights(weights.indices, weights.weights, int(np.count_nonzero(regionMask)))
+    fills = self.fillWeights(plan)
+    for i in np.flatnonzero(padCounts):
+      weights = weights.plus(fills[i], float(padCounts[i]))
+    return weights
+
+  def paint(self, img):
+    #paints the pads over with the average of their windows (fill=True) in the scaled image img
+    if not self.fill:
+      return img
+    for (rows, cols), (leftCols, rightCols) in zip(self.pads, self.windows):
+      avgLeft = img[rows.start:rows.stop, leftCols.start:leftCols.stop].mean()
+      avgRight = img[rows.start:rows.stop, rightCols.start:rightCols.stop].mean()
+      img[rows.start:rows.stop, cols.start:cols.stop] = .5*(avgLeft+avgRight)
+    return img
+
+@functools.lru_cache(maxsize=16)
+def bondPads(scaledShape, boundaries, bbox, dx, fill=True, modules=14):
+  '''
+  The bond pads of the stave with the boundaries (in pixels of the scaled image of scaledShape): one per module,
+  dx pixels apart, the first at bbox ((xLeft, yBottom), (xRight, yTop)) relative to the bottom left corner of the
+  stave. The windows next to a pad reach 55 pixels beyond its sides.
+  '''
+  (xLeft,yBottom),(xRight,yTop) = bbox
+  scaledHeight, scaledWidth = scaledShape
+  x0, y0 = boundaries[0], boundaries[3]
+  rows = range(scaledHeight)[int(y0-yTop):int(y0-yBottom)]
+  pads, windows = [], []
+  for i in range(modules):
+    pads.append((rows, range(scaledWidth)[int(dx*i+x0+xLeft):int(dx*i+x0+xRight)]))
+    windows.append((range(scaledWidth)[int(dx*i+x0+xLeft-55):int(dx*i+x0-5+xRight)],
+                    range(scaledWidth)[int(dx*i+x0+xLeft+5):int(dx*i+x0+xRight+55)]))
+  return BondPads(scaledShape, tuple(pads), tuple(windows), fill)
+
+class ImageContext:
+  '''
+  The image the staves are analysed on, shared by all staves and regions of it. It hands out read-only views
+  of the image (without copying it) and makes the scaled image once for all of them; anything that wants
+  to modify the pixels has to copy them.
+  '''
+  def __init__(self, image):
+    self.__image = np.asarray(image).view()
+    self.__image.flags.writeable = False
+    self.__scaled = {}
+    self.__pyramid = {}
+    self.__gradients = {}
+
+  @property
+  def image(self):
+    return self.__image
+
+  def scaledShape(self, scale):
+    return (int(self.__image.shape[0] * scale), int(self.__image.shape[1] * scale))
+
+  def scaled(self, scale):
+    #uses the openCV library to scale the image using a linear extrapolation
+    if scale == 1:
+      return self.__image
+    if scale not in self.__scaled:
+      height, width = self.scaledShape(scale)
+      resized = cv2.resize(self.__image, (width, height), interpolation = cv2.INTER_LINEAR)
+      resized.flags.writeable = False
+      self.__scaled[scale] = resized
+    return self.__scaled[scale]
+
+  def pyramidLevel(self, minSize):
+    #the coarsest level of the image pyramid whose smaller side still has minSize pixels
+    level, size = 0, min(self.__image.shape[:2])
+    while size//2 >= minSize:
+      level, size = level + 1, size//2
+    return level
+
+  def pyramid(self, level):
+    #the image halved in size level times (Gaussian pyramid); pixel i of a level is centred on pixel 2**level*i
+    if level not in self.__pyramid:
+      if level == 0:
+        image = np.asarray(self.__image, dtype=np.float64)
+      else:
+        image = cv2.pyrDown(self.pyramid(level - 1))
+      image.flags.writeable = False
+      self.__pyramid[level] = image
+    return self.__pyramid[level]
+
+  def gradients(self, level):
+    #the gradients of a pyramid level along y and x, computed once for all staves of the image
+    if level not in self.__gradients:
+      image = self.pyramid(level)
+      self.__gradients[level] = (np.gradient(image, axis=0), np.gradient(image, axis=1))
+    return self.__gradients[level]
+
+  def release(self):
+    #free the scaled images and the edge search data; they are made again if needed
+    self.__scaled.clear()
+    self.__pyramid.clear()
+    self.__gradients.clear()
 
 class Stave:
 
   def __init__(self,globalImg, config):
-    self.__globalImg = globalImg
+    #globalImg is the image or an ImageContext shared with other staves of the same image
+    self.__context = globalImg if isinstance(globalImg, ImageContext) else ImageContext(globalImg)
+    self.__globalImg = self.__context.image
+    self.__scale = 1 #the stave and its regions are defined on the image scaled up by this factor
+    self.__plan = None #the weights of the regions on the original image (see projection.py)
+    self.__planTemperatures = None
+    self.__bondPads = None #the bond pads excluded from the regions by killShiny (see BondPads)
+    self.__plainPlanIndices = {} #plan index of a region -> plan index of its average without excluding the bond pads
     self.__staveFound = False
     self.__xLeft = 0
     self.__xRight = 0
@@ -30,6 +320,7 @@ class Stave:
     self.__staveRatioTolerance = 1 #TEMPORARY TOLERANCE TO TEST NEW WL DRYBOX. DO NOT USE FOR ACTUAL TESTS.
     self.__lineThickness = 1 #thickness of the line that is used for drawing the regions
     self.__staveEndTolerance = 1.e-6 # tolerance for horizontal ends of stave
+    self.__edgeSearchMinSize = 160 # the edges are first looked for on the coarsest pyramid level at least this large
 
     self.__nTrim = config["Default"]["nTrim"]
     self.__regime = config["Default"]["regime"]
@@ -73,6 +364,10 @@ class Stave:
   def yBottom(self):
     return self.__yBottom
 
+  @property
+  def boundaries(self):
+    return (self.__xLeft, self.__xRight, self.__yTop, self.__yBottom)
+
   def FindStaveWithin(self, relXMin, relXMax, relYMin, relYMax):
     if relXMin > relXMax or relYMin > relYMax:
       logging.error("Minimal values are larger than the maximum.")
@@ -84,15 +379,16 @@ class Stave:
 
     logging.debug("Finding stave algorithm:")
 
-    imageHeight = self.__globalImg.shape[0]
-    imageWidth = self.__globalImg.shape[1]
+    scaledImg = self.__scaledImage()
+    imageHeight = scaledImg.shape[0]
+    imageWidth = scaledImg.shape[1]
 
     xMin = int(relXMin * imageWidth)
     xMax = int(relXMax * imageWidth)
     yMin = int(relYMin * imageHeight)
     yMax = int(relYMax * imageHeight)
 
-    imgOfInterest = self.__globalImg[yMin:yMax,xMin:xMax]
+    imgOfInterest = scaledImg[yMin:yMax,xMin:xMax]
     logging.debug("Looking for the stave within: " + str([yMin,yMax,xMin,xMax]))
 
     #algorithm for finding the stave within the region of interest:
@@ -101,25 +397,21 @@ class Stave:
     # 3. look for the positive/negative peaks corresponding to top/bottom edge of stave
     # the positive/negative peaks are found by taking max and min
     # 4. find the left and right edges similarly by only considering the strip between the top/bottom edges
+    # the peaks are first found on a coarse level of the image pyramid (whose gradients are shared by both
+    # faces), then on the scaled image only within a few pixels of them
 
-    gradient = np.gradient(imgOfInterest,axis=0)
+    level, yEstimates, xEstimates = self.__coarseEdges(xMin, xMax, yMin, yMax)
+    #a pixel of the coarse level spans 2**level pixels of the image
+    margin = self.__scale*(2**(level+1) + 2)
 
-    projection = np.sum(gradient, axis=1)
-
-    upperEdge = np.argmax(projection) if self.__regime == "hot" else np.argmin(projection)
+    upperEdge, lowerEdge = self.__findEdgePair(imgOfInterest, 0, yEstimates, margin)
     logging.debug("upperEdge = " + str(upperEdge))
-    lowerEdge = np.argmin(projection) if self.__regime == "hot" else np.argmax(projection)
     logging.debug("lowerEdge = " + str(lowerEdge))
 
     strip = imgOfInterest[upperEdge:lowerEdge,:]
 
-    stripGradient = np.gradient(strip,axis=1)
-
-    stripProjection = np.sum(stripGradient, axis=0)
-
-    leftEdge = np.argmax(stripProjection) if self.__regime == "hot" else np.argmin(stripProjection)
+    leftEdge, rightEdge = self.__findEdgePair(strip, 1, xEstimates, margin)
     logging.debug("leftEdge = " + str(leftEdge))
-    rightEdge = np.argmin(stripProjection) if self.__regime == "hot" else np.argmax(stripProjection)
     logging.debug("rightEdge = " + str(rightEdge))
 
     ratioMeasured = abs(1.0*(rightEdge-leftEdge)/(lowerEdge-upperEdge))
@@ -143,17 +435,99 @@ class Stave:
 
     self.__staveFound = True
 
+  def __coarseEdges(self, xMin, xMax, yMin, yMax):
+    #the edges within the window [yMin:yMax, xMin:xMax] of the scaled image, found on a coarse level of the image
+    #pyramid: (level, (upper, lower), (left, right)) in scaled pixels relative to the window; None for the edges
+    #the coarse level is too small for
+    level = self.__context.pyramidLevel(self.__edgeSearchMinSize)
+    image = self.__context.pyramid(level)
+    gradientY, gradientX = self.__context.gradients(level)
+    step = 2**level
+    toCoarse = lambda s: ((s + 0.5)/self.__scale - 0.5)/step
+    toScaled = lambda c: (c*step + 0.5)*self.__scale - 0.5
+    rows = slice(max(int(np.ceil(toCoarse(yMin))), 0), min(int(np.floor(toCoarse(yMax - 1))) + 1, image.shape[0]))
+    cols = slice(max(int(np.ceil(toCoarse(xMin))), 0), min(int(np.floor(toCoarse(xMax - 1))) + 1, image.shape[1]))
+    if rows.stop - rows.start < 3 or cols.stop - cols.start < 3:
+      return level, None, None
+
+    findMax = self.__regime == "hot"
+    upper, lower = edgePeaks(edgeProjection(image, gradientY, 0, rows, cols), findMax)
+    yEstimates = (toScaled(rows.start + upper) - yMin, toScaled(rows.start + lower) - yMin)
+    strip = slice(rows.start + upper, rows.start + lower)
+    if strip.stop - strip.start < 2:
+      return level, yEstimates, None
+    left, right = edgePeaks(edgeProjection(image, gradientX, 1, strip, cols), findMax)
+    xEstimates = (toScaled(cols.start + left) - xMin, toScaled(cols.start + right) - xMin)
+    return level, yEstimates, xEstimates
+
+  def __findEdgePair(self, img, axis, estimates, margin):
+    #the rising and falling edge of img along axis, looked for near the estimates, or on the whole image if there
+    #are none or the peaks are not close to them
+    findMax = self.__regime == "hot"
+    if estimates is not None:
+      first = refineEdge(img, axis, estimates[0], margin, findMax)
+      second = refineEdge(img, axis, estimates[1], margin, not findMax)
+      if first is not None and second is not None:
+        return first, second
+      logging.debug("The edges are not near their coarse estimates, searching the whole window")
+    return edgePeaks(np.sum(np.gradient(img, axis=axis), axis=1-axis), findMax)
+
   def ScaleImage(self, scale):
-    #uses the openCV library to scale the image using a linear extrapolation
+    #the stave is found and the regions are defined on the image scaled up using a linear extrapolation;
+    #the scaled image is only made when it is needed (finding the stave, getImage), the regions are averaged
+    #on the original image with the equivalent weights
     logging.debug("Scaling image: scale = " + str(scale))
-    width = int(self.__globalImg.shape[1] * scale)
-    height = int(self.__globalImg.shape[0] * scale)
-    dim = (width, height)
-    resized = cv2.resize(self.__globalImg, dim, interpolation = cv2.INTER_LINEAR)
-    self.__globalImg = resized
+    if self.__plan is not None:
+      raise Exception("Cannot scale the image after regions were defined.")
+    self.__scale = self.__scale * scale
 
     self.__lineThickness = self.__lineThickness * scale
 
+  def __scaledShape(self):
+    return self.__context.scaledShape(self.__scale)
+
+  def __scaledImage(self):
+    #read-only, shared with the other staves of the image
+    return self.__context.scaled(self.__scale)
+
+  def __getPlan(self):
+    if self.__plan is None:
+      self.__plan = ProjectionPlan(self.__globalImg.shape, self.__scaledShape())
+    return self.__plan
+
+  @property
+  def plan(self):
+    #the weights of all regions; plan.evaluate(images) averages them on other images of the same shape
+    return self.__getPlan()
+
+  def __paintedWeights(self, rows, cols, mask=None):
+    #the weights of the scaled pixels rows x cols (where mask is non-zero), taking account of the bond pads
+    #excluded by killShiny
+    plan = self.__getPlan()
+    if self.__bondPads is not None:
+      return self.__bondPads.weights(plan, rows, cols, mask)
+    return plan.rectangle(rows, cols) if mask is None else plan.mask(rows, cols, mask)
+
+  def __addToPlan(self, region, rows, cols, mask=None, weights=None, plainWeights=None):
+    plan = self.__getPlan()
+    if weights is None:
+      weights = self.__paintedWeights(rows, cols, mask)
+    region.setPlanIndex(plan.add(weights))
+    if self.__bondPads is not None:
+      #the average without the bond pads excluded comes out of the same pass over the image
+      if plainWeights is None:
+        plainWeights = plan.rectangle(rows, cols) if mask is None else plan.mask(rows, cols, mask)
+      self.__plainPlanIndices[region.getPlanIndex()] = plan.add(plainWeights)
+    self.__planTemperatures = None
+
+  def __updateTemperatures(self):
+    #average all regions at once
+    if self.__planTemperatures is None and self.__plan is not None:
+      self.__planTemperatures = self.__plan.evaluate(self.__globalImg)
+      for regions in self.__regions.values():
+        for region in regions:
+          region.setAverageTemperature(self.__planTemperatures[region.getPlanIndex()])
+
   def setTemperatureProfile(self,newTemperatureProfile):
     logging.debug("Re-setting the temperature profile:")
     self.__temperatureProfile = newTemperatureProfile
@@ -180,21 +554,22 @@ class Stave:
     logging.debug("Adding a new region of type '" + str(type) + "': [xLeft,xRight,yTop,yBottom] = " + str([xLeft,xRight,yTop,yBottom]))
 
     #transforming the relative coordinates to global coordinates
-    regionXLeft = self.__xLeft + xLeft*self.__length
-    regionYTop = self.__yTop + yTop*self.__width
-    regionXRight = self.__xLeft + xRight*self.__length
-    regionYBottom = self.__yTop + yBottom*self.__width
-    if abs(yTop-0.) < self.__staveEndTolerance:
-        regionYTop    += float(self.__nTrim)
-    if abs(yBottom-1.) < self.__staveEndTolerance:
-        regionYBottom -= float(self.__nTrim)
-    if abs(xLeft-0.) < self.__staveEndTolerance:
-        regionXLeft += float(self.__nTrim)
-    if abs(xRight-1.) < self.__staveEndTolerance:
-        regionXRight -= float(self.__nTrim)
-
-    newRegion = Region(self.__globalImg,regionXLeft,regionXRight,regionYTop,regionYBottom)
+    coordinates = globalCoordinates(self.boundaries, float(self.__nTrim), xLeft, xRight, yTop, yBottom, self.__staveEndTolerance)
+    self.__addRectangle(type, *coordinates)
+
+  def __addRectangle(self, type, regionXLeft, regionXRight, regionYTop, regionYBottom, weights=None, plainWeights=None):
+    newRegion = Region(regionXLeft,regionXRight,regionYTop,regionYBottom)
+    #the pixels of the region, as the slice [int(yTop):int(yBottom),int(xLeft):int(xRight)] of the scaled image
+    rows, cols = self.__rectanglePixels(regionXLeft, regionXRight, regionYTop, regionYBottom)
+    self.__addToPlan(newRegion, rows, cols, weights=weights, plainWeights=plainWeights)
+    self.__appendRegion(type, newRegion)
+    newRegion.setIndex(len(self.__regions[type])-1)
 
+  def __rectanglePixels(self, regionXLeft, regionXRight, regionYTop, regionYBottom):
+    scaledHeight, scaledWidth = self.__scaledShape()
+    return range(scaledHeight)[int(regionYTop):int(regionYBottom)], range(scaledWidth)[int(regionXLeft):int(regionXRight)]
+
+  def __appendRegion(self, type, newRegion):
     # self.__regions is a dictionary with the format { region_type(string) : regions(list) }
     if type in self.__regions:
       self.__regions[type].append(newRegion)
@@ -202,8 +577,6 @@ class Stave:
       self.__regions[type] = []
       self.__regions[type].append(newRegion)
 
-    newRegion.setIndex(len(self.__regions[type])-1)
-
   def AddUBendRegion(self, rxLeft, rxRight, ryTop, ryBottom, rradius, rlength, type, bend="downwards"):
     """
     Adding the U-bend regions used at the end of the stave where the pipe is U-shaped
@@ -232,57 +605,31 @@ class Stave:
 
     logging.debug("Adding a new region of type '" + str(type) + "': [xLeft,xRight,yTop,yBottom] = " + str([rxLeft, rxRight, ryTop, ryBottom]))
 
-    #coordinates of the first "starting" rectangle
-    xLeft1 = int(self.__xLeft + rxLeft*self.__length)
-    yTop1 = int(self.__yTop + ryTop*self.__width)
-    xRight1 = int(self.__xLeft + rxRight*self.__length)
-    yBottom1 = int(self.__yTop + ryBottom*self.__width)
-
-
-    radius = int(rradius*self.__width)
-
-    thickness = int(yBottom1-yTop1)
-    centreX = int(xRight1)
-
-    if bend=="upwards":
-      centreY = int(0.5*(yTop1+yBottom1)-rradius*self.__width)
-    else:
-      centreY = int(0.5*(yTop1+yBottom1)+rradius*self.__width)
-
-    xLeft2 = int(xRight1 + radius - thickness/2)
-    xRight2 = int(xLeft2 + thickness)
-
-    if bend=="upwards":
-      yTop2 = int(yBottom1 - radius - thickness/2)
-      yBottom2 = int(yTop2 - rlength*self.__width)
-    else:
-      yTop2 = int(yBottom1 + radius - thickness/2)
-      yBottom2 = int(yTop2 + rlength*self.__width)
-
-
-    if bend=="upwards":
-      start_angle, stop_angle = 0, 90
-    else:
-      start_angle, stop_angle = 270, 360
-
-    shape = np.shape(self.__globalImg)
-
-    regions_image = np.zeros([shape[0],shape[1]])
-
-    regions_image = cv2.rectangle(regions_image, (xLeft1,yTop1), (xRight1,yBottom1), 1, -1)
-
-    regions_image=cv2.ellipse(regions_image, (centreX,centreY), (radius,radius), 0, start_angle, stop_angle, 1, thickness)
-
-    regions_image = cv2.rectangle(regions_image, (xLeft2,yTop2), (xRight2,yBottom2), 1, -1)
+    self.__addUBend(type, uBendGeometry(self.boundaries, rxLeft, rxRight, ryTop, ryBottom, rradius, rlength, bend))
 
-    newRegion = GeneralRegion(self.__globalImg, regions_image)
+  def __addUBend(self, type, geometry, weights=None, plainWeights=None):
+    #the mask is only drawn within the bounding box of the region, and reused for the same geometry
+    rows, cols, regions_image = uBendMask(self.__scaledShape(), *geometry)
+    newRegion = GeneralRegion(rows, cols, regions_image)
+    self.__addToPlan(newRegion, rows, cols, regions_image, weights=weights, plainWeights=plainWeights)
+    self.__appendRegion(type, newRegion)
 
-
-    if type in self.__regions:
-      self.__regions[type].append(newRegion)
-    else:
-      self.__regions[type] = []
-      self.__regions[type].append(newRegion)
+  def AddLayout(self, layout):
+    '''
+    Adds all regions of a compiled region layout (see layout.py), in the order of the layout.
+    '''
+    if not self.__staveFound:
+      logging.error("Defining region for a stave that has not been found.")
+      raise Exception("Cannot define a region for stave that has not been found.")
+    logging.debug("Adding the {} regions of the layout '{}'".format(len(layout), layout.name))
+    #the weights only depend on the geometry (and that of the bond pads)
+    plainWeights = layout.weights(self.__getPlan())
+    weights = layout.weights(self.__getPlan(), self.__bondPads) if self.__bondPads is not None else plainWeights
+    for (type, kind, geometry), regionWeights, regionPlainWeights in zip(layout.regions, weights, plainWeights):
+      if kind == "rectangle":
+        self.__addRectangle(type, *geometry, weights=regionWeights, plainWeights=regionPlainWeights)
+      else:
+        self.__addUBend(type, geometry, weights=regionWeights, plainWeights=regionPlainWeights)
 
   def Echo(self):
     if self.__staveFound:
@@ -295,12 +642,14 @@ class Stave:
 	    region.Echo()
 
   def Show(self):
-    plt.imshow(self.__globalImg)
+    from matplotlib import pyplot as plt
+    plt.imshow(self.getImage())
     plt.show()
     return
 
   def SaveImage(self,path):
-    plt.imshow(self.__globalImg)
+    from matplotlib import pyplot as plt
+    plt.imshow(self.getImage())
     plt.savefig(path)
     return
 
@@ -314,6 +663,7 @@ class Stave:
     #for region in self.__regions[regionType]:
     #  regions.append(region.getPosition())
     #return regions
+    self.__updateTemperatures()
     return self.__regions[regionType]
 
   def DrawEdges(self,img):
@@ -327,37 +677,52 @@ class Stave:
     return
 
   #bbox: (xLeft,yBottom),(xRight,yTop)
-  def killShiny(self,bbox,dx):
-    (xLeft,yBottom),(xRight,yTop) = bbox
-    img = self.__globalImg
-    y0 = self.yBottom
-    x0 = self.xLeft
-    for i in range(14):
-      avgLeft = self.__globalImg[
-        int(y0-yTop):int(y0-yBottom), 
-        int(dx*i+x0+xLeft-55):int(dx*i+x0-5+xRight)
-        ].mean()
-      avgRight = self.__globalImg[
-        int(y0-yTop):int(y0-yBottom),
-          int(dx*i+x0+xLeft+5):int(dx*i+x0+xRight+55)
-          ].mean()
-      self.__globalImg[
-        int(y0-yTop):int(y0-yBottom), 
-        int(dx*i+x0+xLeft):int(dx*i+x0+xRight)
-        ] = .5*(avgLeft+avgRight)
-      
-    pass
+  def killShiny(self, bbox, dx, fill=True):
+    #the bond pads are excluded from the regions defined afterwards: their pixels are left out of the averages, or
+    #with fill=True replaced by the average of the windows left and right of them. the image itself is not
+    #modified, and getTemperatures(..., excludePads=False) still gives the plain averages
+    bbox = tuple(tuple(corner) for corner in bbox)
+    self.__bondPads = bondPads(self.__scaledShape(), tuple(int(x) for x in self.boundaries), bbox, dx, fill)
 
   def getImage(self):
-    deepCopy = np.copy(self.__globalImg)
-    return deepCopy
-
-  def getTemperatures(self,regionType):
+    #a copy of the scaled image with the bond pads painted over
+    img = np.copy(self.__scaledImage())
+    if self.__bondPads is not None:
+      self.__bondPads.paint(img)
+    return img
+
+  def getThumbnail(self, maxWidth):
+    #the image the stave is in, not scaled up but shrunk to at most maxWidth pixels wide, for displaying it; and the
+    #factor f from the coordinates of the scaled image to those of the thumbnail: x -> (x+0.5)*f - 0.5
+    image = self.__globalImg
+    height, width = image.shape[:2]
+    shrink = 1.
+    if width > maxWidth:
+      size = (int(maxWidth), max(1, int(round(height*maxWidth/width))))
+      image = cv2.resize(np.asarray(image, dtype=np.float32), size, interpolation=cv2.INTER_AREA)
+      shrink = size[0]/width
+    return np.array(image), shrink/self.__scale
+
+  def getTemperatures(self,regionType, excludePads=True):
+    #excludePads=False: the averages without the bond pads excluded by killShiny
+    self.__updateTemperatures()
     temperatures = []
     for region in self.__regions[regionType]:
-      temperatures.append(region.getAverageTemperature())
+      if excludePads or region.getPlanIndex() not in self.__plainPlanIndices:
+        temperatures.append(region.getAverageTemperature())
+      else:
+        temperatures.append(self.__planTemperatures[self.__plainPlanIndices[region.getPlanIndex()]])
     return temperatures
 
+  def getRegionTypes(self):
+    #the type of every region, in the order of the plan's results (columns of plan.evaluate()); None for the
+    #averages without the bond pads excluded (see killShiny)
+    types = [None]*len(self.__getPlan())
+    for type, regions in self.__regions.items():
+      for region in regions:
+        types[region.getPlanIndex()] = type
+    return types
+
   def getTemperatureCorrections(self,regionType):
     temperatureCorrections = []
     for region in self.__regions[regionType]:
@@ -368,70 +733,47 @@ class Stave:
     logging.debug("Calculating impedances of region type '" + str(regionType) + "'")
     regionTemp = self.getTemperatures(regionType)
     tempCorrections = self.getTemperatureCorrections(regionType)
-    #temp. of the cooling liquid
-    liquidTemperature = self.__temperatureProfile
-
     logging.debug("Scaling the temperature profile accoreding to [Tout,Tin] = " + str([self.__Tout,self.__Tin]))
+    liquidTemperature = liquid_temperatures(self.__temperatureProfile, self.__Tin, self.__Tout)
 
-    #scale it up
-    liquidTemperature = [x*(self.__Tout-self.__Tin)/self.__temperatureProfile[-1] for x in self.__temperatureProfile]
-
-    #shift it to match Tin
-    liquidTemperature = [x+(self.__Tin-liquidTemperature[0]) for x in liquidTemperature]
-
-    # in the config file the units are liters per minute
-    # to convert the FR to m3/s (cubic meters per second), FR is divided by 60(minute->seconds) and 1000(liter->cubic meters)
-    flowRateKgPerSec = (self.__FR/(60*1000))*self.__liquid_density
-
-    logging.debug("liquidTemperature after scaling = " + str(liquidTemperature))
-    logging.debug("flowRateKgPerSec = " + str(flowRateKgPerSec))
+    logging.debug("liquidTemperature after scaling = " + str(liquidTemperature[0].tolist()))
+    logging.debug("flowRateKgPerSec = " + str(flow_kg_per_sec(self.__FR, self.__liquid_density)))
     logging.debug("heatCapacity = " + str(self.__heatCapacity))
 
     logging.debug("regionTemp = " + str(regionTemp))
     logging.debug("tempCorrections = " + str(tempCorrections))
 
-    impedances = []
-
-    if not len(regionTemp)+1==len(liquidTemperature):
-      logging.error("The number of temperature profile data points does not match the number of regions.")
-      raise Exception("The number of temperature profile data points does not match the number of regions.")
-
-    heat = []
-
-    for i in range(0,len(regionTemp)):
-      #divide by two to get the heat only for one part
-      heat.append(abs(liquidTemperature[i] - liquidTemperature[i+1])*self.__heatCapacity*0.5*flowRateKgPerSec)
-
-    #heat correction: first two segments have the same heat as the third one
     if heatCorrection:
       logging.debug("Applying the heat correction.")
-      heat[0] = heat[2]
-      heat[1] = heat[2]
-    
-    logging.debug("heat = " + str(heat))
-
-    for i in range(0,len(regionTemp)):
-      #divide by two to get the heat only for one part
-      averageTempDiff = abs((liquidTemperature[i]+liquidTemperature[i+1])/2 - regionTemp[i] - tempCorrections[i])
-      impedances.append(averageTempDiff/heat[i])
+    impedances = segment_impedances(regionTemp, tempCorrections, liquidTemperature, self.__heatCapacity, self.__FR, self.__liquid_density, heatCorrection)[0].tolist()
 
     logging.debug("impedances = " +str(impedances))
 
     return impedances
 
 class Region:
-  def __init__(self,globalImg,xLeft,xRight,yTop,yBottom):
+  def __init__(self,xLeft,xRight,yTop,yBottom):
     self.__xLeft = xLeft
     self.__xRight = xRight
     self.__yTop = yTop
     self.__yBottom = yBottom
-    self.__img = globalImg[int(yTop):int(yBottom),int(xLeft):int(xRight)]
-    self.__averageTemperature = np.mean(self.__img)
+    #the average is computed by the stave, together with those of all its regions
+    self.__averageTemperature = None
+    self.__planIndex = -1
     self.temperatureCorrection = 0.0
     self.__index = -1
 
   def setIndex(self, index):
     self.__index = index
+
+  def setPlanIndex(self, planIndex):
+    self.__planIndex = planIndex
+
+  def getPlanIndex(self):
+    return self.__planIndex
+
+  def setAverageTemperature(self, averageTemperature):
+    self.__averageTemperature = averageTemperature
   
   def getAverageTemperature(self):
     return self.__averageTemperature
@@ -450,24 +792,35 @@ class Region:
 
 #added for implementing the U-bend regions
 class GeneralRegion:
-  def __init__(self, globalImg, regionImg):
-    self.__globalImg = globalImg
+  def __init__(self, rows, cols, regionImg):
+    #regionImg is the mask of the region within its bounding box rows x cols of the scaled image
+    self.__rows = rows
+    self.__cols = cols
     self.__regionImg = regionImg
+    self.__averageTemperature = None
+    self.__planIndex = -1
+    self.temperatureCorrection = 0.0
 
-    selected_regions = globalImg*regionImg
-    self.__selected_regions = selected_regions
-    totalSum = np.sum(selected_regions)
-    numberNonzero = len(np.nonzero(selected_regions)[0])
+  def setPlanIndex(self, planIndex):
+    self.__planIndex = planIndex
 
-    self.__averageTemperature = totalSum/numberNonzero
-    self.temperatureCorrection = 0.0
+  def getPlanIndex(self):
+    return self.__planIndex
+
+  def setAverageTemperature(self, averageTemperature):
+    self.__averageTemperature = averageTemperature
 
   def getAverageTemperature(self):
     return self.__averageTemperature
 
+  def getMask(self):
+    return self.__regionImg
+
   def getPosition(self):
-    return [np.min(np.nonzero(self.__selected_regions)[1]),np.max(np.nonzero(self.__selected_regions)[1]), np.min(np.nonzero(self.__selected_regions)[0]),np.max(np.nonzero(self.__selected_regions)[0])]
+    #the mask is cropped to the region, so its box is the position
+    return [self.__cols.start, self.__cols.stop-1, self.__rows.start, self.__rows.stop-1]
 
   def DrawRegion(self, imgToBeImprinted, thickness):
-    #update the value, not the reference -> use [:]
-    imgToBeImprinted[:] = imgToBeImprinted + 100*self.__regionImg
+    #update the value, not the reference
+    box = imgToBeImprinted[self.__rows.start:self.__rows.stop, self.__cols.start:self.__cols.stop]
+    box += 100*self.__regionImg
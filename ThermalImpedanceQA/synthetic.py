@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+'''
+synthetic.py
+
+About: Deterministic synthetic captures of a stave, for benchmarks (see benchmark.py) and for trying the analysis
+  without a camera. The same arguments (and seed) always give the same capture.
+
+  The temperature map is drawn in the orientation the analysis works in (after prepare_image's flips): one face
+  in the middle of the image, or two faces in its upper and lower half. The cooling pipe runs along the bands of
+  the small regions (layout.PIPE_THERE, on the way from the EoS end, and layout.PIPE_RETURN, back to it) and turns
+  in a U-bend at the far end. The liquid warms up (cold regime) or cools down (hot regime) along the pipe as in the
+  temperature profile of the config, the surface is the closer to the ambient temperature the farther it is from
+  the pipe, and the EoS ear, which sticks out of the stave next to the inlet, is closer still. The frames are this map plus Gaussian noise,
+  converted to ADC counts with the calibration of process_tc_data.DEFAULT_PARAMETERS.
+
+  Usage: python synthetic.py <output.npz> [--regime hot|cold] [--two-face] [--resolution 640x480] [--frames N] [--noise K]
+'''
+
+import sys
+import argparse
+import numpy as np
+
+from layout import NUM_MODULES, PIPE_THERE, PIPE_RETURN, EAR_LENGTH, EAR_HEIGHT
+from process_tc_data import DEFAULT_PARAMETERS
+
+# the process variables of the regimes: liquid temperatures at the inlet and the outlet, the flow rate, and the
+# temperature around the stave
+REGIMES = {
+    'hot': {'temp_in': 45.0, 'temp_out': 40.0, 'flow_rate': 1.5, 'ambient': 20.0},
+    'cold': {'temp_in': -30.0, 'temp_out': -25.0, 'flow_rate': 1.5, 'ambient': 20.0},
+}
+
+# the liquid temperature along the pipe, relative to its inlet and outlet temperature, at the ends of the
+# 2*NUM_MODULES segments (the temperatureProfile of npz-template.cfg)
+TEMPERATURE_PROFILE = (0.0000, 0.0686, 0.1233, 0.1603, 0.1969, 0.2329, 0.2685, 0.3037, 0.3385, 0.3729, 0.4068, 0.4404, 0.4736,
+                       0.5064, 0.5395, 0.5744, 0.6088, 0.6430, 0.6770, 0.7107, 0.7441, 0.7772, 0.8099, 0.8422, 0.8742, 0.9058,
+                       0.9368, 0.9681, 1.0000)
+
+# length:width of the stave (as Stave checks it) and the fraction of the image width it spans
+STAVE_RATIO = 11.957
+STAVE_SPAN = 0.85
+
+# the surface temperature moves from the liquid's towards the ambient by FILM on the pipe, and by SPREAD more per
+# stave width away from it; the ear by EAR_SPREAD more per ear height
+FILM = 0.08
+SPREAD = 0.4
+EAR_SPREAD = 0.3
+
+# the emissivity the frames are made with, the default of the analysis
+EMISSIVITY = 0.92
+
+def temp_to_adc(temperature, params=DEFAULT_PARAMETERS, emissivity=EMISSIVITY):
+    '''
+    The ADC counts the camera reads for a temperature (in degree C): the inverse of process_tc_data.adc_to_temp.
+    '''
+    p = dict(params)
+    p['Emissivity'] = emissivity
+    raw = lambda t: p["R1"] / (p["R2"] * (np.exp(p["B"] / (t + 273.15)) - p["F"])) - p["O"]
+    return (raw(temperature) * p["Emissivity"] * p["Transmissivity"] + p["Transmissivity"] * (1 - p["Emissivity"]) * raw(p["ReflTemp"])
+            + (1 - p["Transmissivity"]) * raw(p["AtomTemp"]))
+
+def _pipe(length, width):
+    # the distance of every pixel of a face (length x width, y from the edge the ear is on) to the pipe, and where
+    # along the pipe the point of it closest to the pixel is, in segments (regions) of the temperature profile:
+    # from 0 at the inlet over NUM_MODULES at the U-bend to 2*NUM_MODULES at the outlet
+    u = np.arange(length)[np.newaxis, :] + 0.5
+    v = np.arange(width)[:, np.newaxis] + 0.5
+    yThere, yReturn = np.mean(PIPE_THERE)*width, np.mean(PIPE_RETURN)*width
+    radius = (yReturn - yThere)/2
+    # the centre of the U-bend stays half a radius away from the far end
+    xBend = length - 1.5*radius
+
+    along = np.minimum(u, xBend)
+    dThere = np.hypot(u - along, v - yThere)
+    dReturn = np.hypot(u - along, v - yReturn)
+    theta = np.clip(np.arctan2(u - xBend, (yThere + yReturn)/2 - v), 0, np.pi)
+    dBend = np.hypot(u - xBend - radius*np.sin(theta), v - (yThere + yReturn)/2 + radius*np.cos(theta))
+
+    distance = np.minimum(np.minimum(dThere, dReturn), dBend)
+    bendStart = NUM_MODULES*xBend/length
+    segment = np.where(distance == dThere, NUM_MODULES*along/length,
+                       np.where(distance == dBend, bendStart + theta/np.pi*2*(NUM_MODULES - bendStart), 2*NUM_MODULES - NUM_MODULES*along/length))
+    return distance, segment
+
+def stave_temperature(shape=(480, 640), regime='hot', twoFace=False, profile=TEMPERATURE_PROFILE):
+    '''
+    The temperature map of the stave(s) in the orientation of the analysis and the boundaries [xLeft, xRight, yTop,
+    yBottom] of the faces in its pixels (top face first). The liquid follows the temperature profile `profile`.
+    '''
+    if regime not in REGIMES:
+        raise Exception("Invalid regime: " + str(regime))
+    process = REGIMES[regime]
+    height, width = shape
+    length = int(round(STAVE_SPAN*width))
+    staveWidth = int(round(length/STAVE_RATIO))
+    earLength, earHeight = int(round(EAR_LENGTH*length)), int(round(EAR_HEIGHT*staveWidth))
+    xLeft = (width - length)//2
+    centres = [0.25, 0.75] if twoFace else [0.5]
+    if staveWidth + 2*earHeight > height*(0.46 if twoFace else 1.0):
+        raise Exception("The image is too small for the stave: " + str(shape))
+
+    ambient = process['ambient']
+    image = np.full(shape, ambient) + 0.5*(np.arange(width)/width - 0.5)
+    distance, segment = _pipe(length, staveWidth)
+    fraction = np.interp(segment, np.arange(len(profile)), profile)/profile[-1]
+    liquid = process['temp_in'] + (process['temp_out'] - process['temp_in'])*fraction
+    face = liquid + (ambient - liquid)*(FILM + SPREAD*np.minimum(distance/staveWidth, 0.5))
+    depth = (np.arange(earHeight)[::-1, np.newaxis] + 0.5)/earHeight
+    ear = process['temp_in'] + (ambient - process['temp_in'])*(FILM + SPREAD*0.5 + EAR_SPREAD*depth)*np.ones((1, earLength))
+
+    boundaries = []
+    for i, centre in enumerate(centres):
+        yTop = int(round(centre*height - staveWidth/2))
+        # the bottom face is the mirror image of the top one, with its ear below it
+        flip = (lambda a: a[::-1]) if i == 1 else (lambda a: a)
+        image[yTop:yTop+staveWidth, xLeft:xLeft+length] = flip(face)
+        if i == 0:
+            image[yTop-earHeight:yTop, xLeft:xLeft+earLength] = ear
+        else:
+            image[yTop+staveWidth:yTop+staveWidth+earHeight, xLeft:xLeft+earLength] = ear[::-1]
+        boundaries.append([xLeft, xLeft+length, yTop, yTop+staveWidth])
+    return image, boundaries
+
+def synthetic_capture(shape=(480, 640), regime='hot', twoFace=False, orientation='L', frames=5, noise=0.05, seed=0, profile=TEMPERATURE_PROFILE):
+    '''
+    A capture of the stave as the camera takes it: the frames (uint16 ADC counts, turned so that the analysis with
+    this orientation turns them back), their calibration metadata, the process variables and the boundaries of
+    the faces in the analysed image (see stave_temperature). noise is the standard deviation of the temperature
+    of a pixel in one frame, in K.
+    '''
+    rng = np.random.default_rng(seed)
+    image, boundaries = stave_temperature(shape, regime, twoFace, profile)
+    # undo the flips of impedanceFromCSV.prepare_image (which turns J images around; the flip of the --adc images
+    # does not apply to captures)
+    if orientation == 'J':
+        image = image[::-1, ::-1]
+
+    meta = dict(DEFAULT_PARAMETERS, Emissivity=EMISSIVITY)
+    stack = np.empty((frames,) + tuple(shape), dtype=np.uint16)
+    for i in range(frames):
+        counts = temp_to_adc(image + rng.normal(0, noise, image.shape))
+        stack[i] = np.clip(np.round(counts), 0, 2**16 - 1)
+    process = {k: v for k, v in REGIMES[regime].items() if k != 'ambient'}
+    return stack, meta, process, boundaries
+
+def write_capture(path, stack, meta, process, samples=10):
+    '''
+    Saves a capture in the acquisition format that impedanceFromCSV.load_image reads: an 'image' object array of
+    (frame, metadata) pairs, and the thermocouple and flow readings ('thermo_data' with the inlet and outlet
+    temperature in its columns 2 and 3, 'flow_data').
+    '''
+    images = np.empty(len(stack), dtype=object)
+    images[:] = [(frame, dict(meta, timestamp=1000.0 + i)) for i, frame in enumerate(stack)]
+    thermo = np.zeros((samples, 4))
+    thermo[:, 2] = process['temp_in']
+    thermo[:, 3] = process['temp_out']
+    np.savez(path, image=images, thermo_data=thermo, flow_data=np.full(samples, process['flow_rate']))
+    return path
+
+def parse_resolution(text):
+    # "640x480" -> (480, 640), the shape of the image
+    width, height = (int(x) for x in text.lower().split("x"))
+    return height, width
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Writes a synthetic capture of a stave.")
+    parser.add_argument("output", help="The .npz file to write")
+    parser.add_argument("--regime", choices=sorted(REGIMES), default="hot")
+    parser.add_argument("--two-face", action="store_true", help="Both faces of the stave in one image")
+    parser.add_argument("--orientation", choices=['J', 'L'], default='L', help="The orientation the capture is analysed with (not used with --two-face)")
+    parser.add_argument("--resolution", type=parse_resolution, default=(480, 640), help="Width x height of the image (default: 640x480)")
+    parser.add_argument("--frames", type=int, default=5, help="Number of frames (default: 5)")
+    parser.add_argument("--noise", type=float, default=0.05, help="Noise of a pixel in one frame, in K (default: 0.05)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    stack, meta, process, boundaries = synthetic_capture(args.resolution, args.regime, args.two_face, None if args.two_face else args.orientation,
+                                                         args.frames, args.noise, args.seed)
+    write_capture(args.output, stack, meta, process)
+    print("Wrote {} ({} frames); the stave edges are at {}".format(args.output, args.frames, boundaries))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+'''
+temperature_cache.py
+
+About: On-disk cache of the temperature maps the analysis works on (after loading, ADC conversion, frame averaging
+  and flips). An entry is addressed by a hash of the input file's content and of the parameters that change the map
+  (emissivity, ADC options, orientation, ...), so a renamed or copied file still hits and an edited one misses.
+  The cache is shared by impedanceFromCSV.py, process_tc_data.py and the GUI, and it is kept below a size limit by
+  evicting the least recently used maps. A long-running process also keeps the maps it used in a MemoryCache.
+'''
+
+import os
+import json
+import hashlib
+import collections
+import numpy as np
+
+from atomicfile import atomic_output
+
+# bump when the way the temperature maps are produced changes, so old entries are no longer used
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".thermal_qa_cache")
+
+def file_digest(path, chunkSize=1<<20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunkSize), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _to_json(value):
+    # numpy scalars (e.g. the process variables read from a npz file) are stored as plain numbers
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Cannot store {!r} in the cache".format(value))
+
+class TemperatureCache:
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, maxBytes=2*1024**3):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, path, **parameters):
+        '''
+        The address of the temperature map of the file `path` produced with `parameters`.
+        '''
+        description = json.dumps({"version": CACHE_VERSION, "file": file_digest(path), "parameters": parameters}, sort_keys=True, default=_to_json)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        '''
+        Returns (temperature map, metadata dict) or None if the map is not cached.
+        '''
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                image = entry["image"]
+                metadata = json.loads(str(entry["metadata"]))
+        except (OSError, ValueError, KeyError):
+            return None
+        # the modification time is the "last used" time for the eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return image, metadata
+
+    def put(self, key, image, metadata=None):
+        metadata = json.dumps(metadata, default=_to_json)
+        # written atomically, so that parallel analyses never read a half-written entry
+        with atomic_output(self._path(key), "wb") as f:
+            np.savez(f, image=np.ascontiguousarray(image), metadata=np.array(metadata))
+        self.evict()
+
+    def evict(self):
+        # remove the least recently used entries until the cache is below its size limit
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.directory, name))
+
+class MemoryCache:
+    '''
+    Temperature maps kept in memory by a long-running process (see server.py), in front of the on-disk cache. An
+    entry is addressed by the path, size and modification time of the file and the parameters, so that looking a
+    map up does not read the file; an edited file misses. get() and put() work like those of TemperatureCache; the
+    least recently used maps are dropped beyond maxBytes.
+    '''
+    def __init__(self, maxBytes=1024**3):
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, path, **parameters):
+        stat = os.stat(path)
+        return json.dumps({"version": CACHE_VERSION, "file": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                           "parameters": parameters}, sort_keys=True, default=_to_json)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, image, metadata=None):
+        # the map is shared by every analysis of the file, so it must not be changed
+        image = np.array(image)
+        image.flags.writeable = False
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[0].nbytes
+        self.entries[key] = (image, metadata)
+        self.size += image.nbytes
+        while self.size > self.maxBytes and len(self.entries) > 1:
+            oldImage, oldMetadata = self.entries.popitem(last=False)[1]
+            self.size -= oldImage.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
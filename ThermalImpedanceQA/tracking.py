@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+'''
+tracking.py
+
+About: Follows a stave from frame to frame instead of searching for it in every frame.
+
+  The stave is found once with the full search (Stave.FindStaveWithin and its ratio check); for the following
+  frames StaveTracker measures how far the stave has shifted since then, by FFT phase correlation
+  (cv2.phaseCorrelate) of a downsampled window around it, starting from the shift of the previous frame. Only
+  when the correlation peak is weak (the frame does not look like a shifted copy of the reference any more), or
+  the shift is implausibly large, the full search runs again, and its frame becomes the new reference. The
+  shift of every frame tells whether the stave physically moved during the run.
+'''
+
+import numpy as np
+import cv2
+
+def _correlation_size(size, level):
+    # the smallest window size from `size` pixels on whose downsampled size is even and a size the DFT takes
+    # as it is: cv2.phaseCorrelate pads the others, which offsets the shifts it finds by up to half a pixel
+    step = 2**level
+    n = max(int(np.ceil(size / step)), 8)
+    while n % 2 or cv2.getOptimalDFTSize(n) != n:
+        n += 1
+    return n * step
+
+def correlation_level(height, width, min_size=64):
+    # the number of halvings that keep the shorter side of a window at least min_size pixels long
+    level = 0
+    while min(height, width) // 2**(level + 1) >= min_size:
+        level += 1
+    return level
+
+class TrackedFrame:
+    '''
+    The outcome of StaveTracker.track() for one frame: the `boundaries` (xLeft, xRight, yTop, yBottom) in pixels
+    of the scaled image, the `shift` (dy, dx) of the stave against the last full search in pixels of the image,
+    the `confidence` of the correlation (1.0 after a full search), whether the stave was `detected` by the full
+    search, and whether it `moved` since the previous frame.
+    '''
+    def __init__(self, boundaries, shift, confidence, detected, moved):
+        self.boundaries = boundaries
+        self.shift = shift
+        self.confidence = confidence
+        self.detected = detected
+        self.moved = moved
+
+class StaveTracker:
+    '''
+    Tracks a stave over images of one shape. `detect(image)` is the full search, returning the boundaries in
+    pixels of the image scaled by `scale`. The window correlated is the stave with `margin` (relative to its
+    width) around it, downsampled `level` times by halving. A correlation with a peak below `min_confidence`,
+    or a shift of more than `max_shift` of the window size, falls back to the full search. Shifts below
+    `tolerance` pixels of the image are taken as noise.
+    '''
+    def __init__(self, detect, scale=10, level=None, margin=0.5, min_confidence=0.3, max_shift=0.25, tolerance=0.25):
+        self.detect = detect
+        self.scale = scale
+        self.level = level
+        self.fixed_level = level is not None
+        self.margin = margin
+        self.min_confidence = min_confidence
+        self.max_shift = max_shift
+        self.tolerance = tolerance
+        self.reference = None
+        self.reference_boundaries = None
+        self.boundaries = None
+        self.offset = (0, 0)
+
+    def _downsampled(self, image, window):
+        # the window (rows, cols slices) of the image at the pyramid level of the correlation
+        roi = np.array(image[window], dtype=np.float64)  # a copy
+        for i in range(self.level):
+            roi = cv2.pyrDown(roi)
+        return roi
+
+    def _window(self, shape, offset):
+        # the correlation window around the reference boundaries, moved by offset (dy, dx) pixels of the image;
+        # None if it does not fit into the image
+        xLeft, xRight, yTop, yBottom = self.reference_boundaries
+        pad = int(np.ceil(self.margin * (yBottom - yTop) / self.scale))
+        y0 = int(np.floor(yTop / self.scale)) - pad + offset[0]
+        x0 = int(np.floor(xLeft / self.scale)) - pad + offset[1]
+        height = _correlation_size(int(np.ceil(yBottom / self.scale)) + pad + offset[0] - y0, self.level)
+        width = _correlation_size(int(np.ceil(xRight / self.scale)) + pad + offset[1] - x0, self.level)
+        if y0 < 0 or x0 < 0 or y0 + height > shape[0] or x0 + width > shape[1]:
+            return None
+        return (slice(y0, y0 + height), slice(x0, x0 + width))
+
+    def reset(self, image, boundaries=None):
+        '''
+        Makes the image the reference, with the stave at `boundaries` or, by default, where the full search finds
+        it; returns the TrackedFrame.
+        '''
+        boundaries = tuple(int(x) for x in (self.detect(image) if boundaries is None else boundaries))
+        moved = self.boundaries is not None and boundaries != self.boundaries
+        self.reference_boundaries = boundaries
+        self.boundaries = boundaries
+        self.offset = (0, 0)
+        self.reference = None
+        if not self.fixed_level:
+            xLeft, xRight, yTop, yBottom = boundaries
+            self.level = correlation_level((yBottom - yTop) / self.scale, (xRight - xLeft) / self.scale)
+        window = self._window(image.shape, self.offset)
+        if window is not None:
+            self.reference = self._downsampled(image, window)
+            self.hanning = cv2.createHanningWindow(self.reference.shape[::-1], cv2.CV_64F)
+        return TrackedFrame(boundaries, (0., 0.), 1.0, True, moved)
+
+    def track(self, image):
+        '''
+        The stave in the next image: returns a TrackedFrame.
+        '''
+        if self.reference is None:
+            return self.reset(image)
+        # start from the shift of the previous frame, in whole pixels
+        step = 2**self.level
+        window = self._window(image.shape, self.offset)
+        if window is None:
+            return self.reset(image)
+        # (cv2.phaseCorrelate applies the Hanning window in place to inputs of a size the DFT takes as they are)
+        (dx, dy), confidence = cv2.phaseCorrelate(self.reference.copy(), self._downsampled(image, window), self.hanning)
+        if confidence < self.min_confidence or max(abs(dy)/self.reference.shape[0], abs(dx)/self.reference.shape[1]) > self.max_shift:
+            return self.reset(image)
+
+        shift = np.array(self.offset) + step*np.array([dy, dx])
+        shift[np.abs(shift) < self.tolerance] = 0.
+        self.offset = tuple(int(round(s)) for s in shift)
+        xLeft, xRight, yTop, yBottom = self.reference_boundaries
+        sy, sx = (int(round(s*self.scale)) for s in shift)
+        boundaries = (xLeft + sx, xRight + sx, yTop + sy, yBottom + sy)
+        moved = boundaries != self.boundaries
+        self.boundaries = boundaries
+        return TrackedFrame(boundaries, tuple(float(s) for s in shift), float(confidence), False, moved)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+'''
+watch.py
+
+About: Watches a run directory while the thermal controller is writing it, and analyses every new capture as soon
+  as it is complete. The impedances of each capture are appended to one table per run, next to the usual outputs
+  of impedanceFromCSV.py in the output directory.
+
+  A file counts as complete once it has not been modified for --settle seconds (and, for .npz files, once its zip
+  directory has been written). Every file is analysed once: the names, sizes and modification times of the
+  analysed files are kept in a state file next to the table, so that a restarted watcher carries on where it
+  stopped. A file that fails to analyse is tried again only when it changes.
+
+  Usage: python watch.py <config> <run directory> [--interval SECONDS] [--settle SECONDS] [--once] [impedanceFromCSV.py options]
+  e.g.   python watch.py ../npz-template.cfg ../trial13/run_004/ -o ../trial13/output -1f --orientation L
+'''
+
+import os
+import csv
+import sys
+import json
+import time
+import zipfile
+import argparse
+import datetime
+import traceback
+
+from atomicfile import atomic_output
+from batch import expand_inputs
+from plots import PlotQueue
+
+def _is_output(path):
+    # the outputs of impedanceFromCSV.py, in case they are written into the watched directory
+    return os.path.splitext(path)[0].endswith("_IMPEDANCES")
+
+def _signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def is_complete(path, settle):
+    '''
+    Whether the file has not changed for `settle` seconds and, for .npz files, is a whole zip archive.
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if time.time() - stat.st_mtime < settle:
+        return False
+    if path.endswith('.npz'):
+        # the zip directory is written last, so a file still being written has none
+        return zipfile.is_zipfile(path)
+    return True
+
+def table_columns(twoFace):
+    faces = ('Top', 'Bottom') if twoFace else ('Top',)
+    columns = ['file', 'modified']
+    for face in faces:
+        columns += ['earImpedance' + face]
+        columns += ['large{}_{}'.format(face, i) for i in range(28)]
+        columns += ['small{}_{}'.format(face, i) for i in range(28)]
+        columns += ['impedanceCombined{}_{}'.format(face, i) for i in range(14)]
+    return columns
+
+def table_row(path, result):
+    row = [os.path.basename(path), datetime.datetime.fromtimestamp(os.stat(path).st_mtime).isoformat()]
+    faces = ('Top', 'Bottom') if result.twoFace else ('Top',)
+    impedances = result.toDict()
+    for face in faces:
+        row += [impedances['earImpedance' + face]]
+        row += list(impedances['large' + face])
+        row += list(impedances['small' + face])
+        row += list(impedances['impedanceCombined' + face])
+    return [str(value) for value in row]
+
+class RunWatcher:
+    '''
+    The watcher of one run directory: poll() analyses the files that are complete and have not been analysed yet.
+    `analysisArgs` are impedanceFromCSV.py options; their output directory holds the table and the state file
+    of the run.
+    '''
+    def __init__(self, directory, configFile, analysisArgs, settle=2.0):
+        import impedanceFromCSV
+        self.directory = directory
+        self.configFile = configFile
+        self.analysisArgs = list(analysisArgs)
+        self.settle = settle
+        self.options = impedanceFromCSV.make_parser().parse_args(["input.npz", configFile] + self.analysisArgs)
+        run = os.path.basename(os.path.normpath(os.path.abspath(directory)))
+        self.tablePath = os.path.join(self.options.outpath, run + "_impedances.csv")
+        self.statePath = os.path.join(self.options.outpath, "." + run + "_watch.json")
+        self.columns = table_columns(not self.options.one_face)
+        os.makedirs(self.options.outpath, exist_ok=True)
+        self.state = self._loadState()
+        # the plots of a file are rendered once its row is in the table
+        self.plots = PlotQueue('deferred')
+
+    def _loadState(self):
+        state = {}
+        if os.path.isfile(self.statePath):
+            with open(self.statePath) as f:
+                state = json.load(f)
+        if not os.path.isfile(self.tablePath):
+            return state
+        with open(self.tablePath, 'rb+') as f:
+            # a row cut short by a crash is dropped, and its file analysed again
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+        with open(self.tablePath, newline='') as f:
+            rows = list(csv.reader(f))
+        if rows and rows[0] != self.columns:
+            raise Exception("The table {} has other columns than this analysis writes (one face vs. two faces?)".format(self.tablePath))
+        # the row is written before the state, so the table has the last word on what has been analysed
+        for row in rows[1:]:
+            name = row[0]
+            if state.get(name, {}).get('status') != 'done':
+                path = os.path.join(self.directory, name)
+                size, mtime = _signature(path) if os.path.isfile(path) else (None, None)
+                state[name] = {'status': 'done', 'size': size, 'mtime_ns': mtime}
+        return state
+
+    def _saveState(self):
+        with atomic_output(self.statePath) as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+
+    def _appendRow(self, row):
+        newTable = not os.path.isfile(self.tablePath) or os.path.getsize(self.tablePath) == 0
+        with open(self.tablePath, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if newTable:
+                writer.writerow(self.columns)
+            writer.writerow(row)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def pending(self):
+        # the files of the run that still need analysing, complete or not
+        files = []
+        for path in expand_inputs([self.directory]):
+            if _is_output(path):
+                continue
+            entry = self.state.get(os.path.basename(path))
+            if entry is None:
+                files.append(path)
+            elif entry['status'] == 'failed':
+                try:
+                    if [entry['size'], entry['mtime_ns']] != list(_signature(path)):
+                        files.append(path)
+                except OSError:
+                    # removed in the meantime
+                    continue
+        return files
+
+    def analyze(self, path):
+        import impedanceFromCSV
+        name = os.path.basename(path)
+        size, mtime = _signature(path)
+        options = impedanceFromCSV.make_parser().parse_args([path, self.configFile] + self.analysisArgs)
+        startTime = time.time()
+        try:
+            result = impedanceFromCSV.analyze_file(options, plots=self.plots)
+        except Exception:
+            self.plots.discard()
+            message = traceback.format_exc()
+            self.state[name] = {'status': 'failed', 'size': size, 'mtime_ns': mtime, 'message': message.strip().splitlines()[-1]}
+            self._saveState()
+            print("[FAILED] {}".format(path))
+            print(message)
+            return False
+        self._appendRow(table_row(path, result))
+        self.state[name] = {'status': 'done', 'size': size, 'mtime_ns': mtime}
+        self._saveState()
+        print("[done] {} ({:.1f} s)".format(path, time.time()-startTime))
+        try:
+            self.plots.flush()
+        except Exception:
+            print("[plots FAILED] {}".format(path))
+            traceback.print_exc()
+        return True
+
+    def poll(self):
+        '''
+        Analyses the complete files among the pending ones; returns the number of files analysed.
+        '''
+        analysed = 0
+        for path in self.pending():
+            if is_complete(path, self.settle):
+                self.analyze(path)
+                analysed += 1
+        return analysed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyses the captures of a run as they arrive. Any further options are passed to impedanceFromCSV.py.")
+    parser.add_argument("config", help="The path to the configuration file")
+    parser.add_argument("directory", help="The run directory to watch")
+    parser.add_argument("--interval", type=float, default=2., help="Seconds between two looks at the directory (default: 2)")
+    parser.add_argument("--settle", type=float, default=2., help="Seconds a file must be unchanged before it is analysed (default: 2)")
+    parser.add_argument("--once", action="store_true", help="Analyse the complete files once and exit, instead of watching")
+    args, analysisArgs = parser.parse_known_args(argv)
+
+    if not os.path.isdir(args.directory):
+        print("{} is not a directory".format(args.directory))
+        return 1
+
+    watcher = RunWatcher(args.directory, args.config, analysisArgs, settle=args.settle)
+    print("Watching {}, writing the impedances to {}".format(args.directory, watcher.tablePath))
+    try:
+        while True:
+            watcher.poll()
+            if args.once:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        # the table and the state are complete after every file, so the watcher can simply be started again
+        print("Stopped.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())